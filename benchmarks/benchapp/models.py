@@ -0,0 +1,15 @@
+from django.db import models
+from django_table_sharding.managers import ShardedModel
+
+
+class Event(ShardedModel):
+    """
+    Synthetic sharded model; shard tables are benchapp_event_<n>.
+    """
+    tenant_id = models.IntegerField(db_index=True)
+    kind = models.CharField(max_length=32)
+    payload = models.TextField()
+    created = models.DateTimeField()
+
+    class Meta:
+        app_label = 'benchapp'
@@ -0,0 +1,328 @@
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path[:0] = [os.path.dirname(os.path.abspath(__file__)), os.path.dirname(os.path.dirname(os.path.abspath(__file__)))]
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'settings')
+
+import django  # noqa: E402
+django.setup()
+
+from django.db import connection  # noqa: E402
+from benchapp.models import Event  # noqa: E402
+from django_table_sharding.catalog import SHARD_CATALOG  # noqa: E402
+from django_table_sharding.ledger import ShardLedger  # noqa: E402
+from django_table_sharding.management.commands.migrate import Command as MigrateCommand  # noqa: E402
+
+
+'''
+
+    Benchmarks for the shard read/write and migration paths.
+
+        python benchmarks/run.py --shards 10 100 1000 10000
+        python benchmarks/run.py --shards 100 --save-baseline
+        python benchmarks/run.py --shards 100 --compare
+
+    Runs against MySQL/MariaDB when BENCH_MYSQL_NAME (and BENCH_MYSQL_USER, _PASSWORD, _HOST, _PORT) is set,
+    otherwise against a SQLite file. Paths that need MySQL SQL (create() uses INSERT IGNORE, the migrate
+    shard phase reads INFORMATION_SCHEMA) are skipped on SQLite.
+
+    For every path and shard count it reports ops/s, p50/p99 latency and the peak Python memory of a
+    separate tracemalloc pass. Baselines are stored per backend in benchmarks/baselines/<backend>.json;
+    --compare exits with status 1 when a path is slower than its baseline by more than --tolerance.
+    Baselines are machine specific: record them on the machine that compares against them.
+
+'''
+
+
+BASELINE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines')
+MEMORY_OPS = 200
+
+
+def backend():
+    return connection.vendor
+
+
+def mysql_only(func):
+    func.mysql_only = True
+    return func
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    if len(values) == 0:
+        return 0.0
+    index = min(len(values) - 1, max(0, int(round(pct / 100.0 * len(values))) - 1))
+    return values[index]
+
+
+def event_row(tenant_id):
+    return {
+        'tenant_id': tenant_id,
+        'kind': random.choice(('click', 'view', 'purchase')),
+        'payload': 'x' * random.randint(20, 200),
+        'created': datetime.datetime(2024, 1, 1) + datetime.timedelta(seconds=random.randint(0, 10 ** 7)),
+    }
+
+
+class Bench:
+    """
+    Creates N shards of the synthetic model and times each path against them.
+    """
+    def __init__(self, shards, ops, rows_per_bulk):
+        self.shards = shards
+        self.ops = ops
+        self.rows_per_bulk = rows_per_bulk
+        self.suffixes = [str(n) for n in range(1, shards + 1)]
+        self.source_table = getattr(Event, '_meta').db_table
+
+    # Setup
+
+    def drop_shards(self):
+        tables = SHARD_CATALOG.list_tables()
+        prefix = Event.objects.shard_table('')
+        with connection.cursor() as cursor:
+            for table in tables:
+                if table.startswith(prefix):
+                    cursor.execute('DROP TABLE %s' % table)
+
+    def setup(self):
+        """
+        Create the source table and the shard tables, with one seeded row per shard.
+        """
+        self.drop_shards()
+        with connection.cursor() as cursor:
+            cursor.execute('DROP TABLE IF EXISTS %s' % self.source_table)
+        with connection.schema_editor() as editor:
+            editor.create_model(Event)
+
+        started = time.perf_counter()
+        if backend() == 'mysql':
+            with connection.cursor() as cursor:
+                for suffix in self.suffixes:
+                    cursor.execute('CREATE TABLE %s LIKE %s' % (Event.objects.shard_table(suffix), self.source_table))
+        else:
+            self.create_sqlite_shards()
+        SHARD_CATALOG.invalidate()
+        print('  created %s shards in %.1fs' % (self.shards, time.perf_counter() - started))
+
+        for suffix in self.suffixes[:min(len(self.suffixes), 1000)]:
+            Event.objects.bulk_create(suffix, [event_row(int(suffix))])
+
+    def create_sqlite_shards(self):
+        """
+        SQLite has no CREATE TABLE ... LIKE: replay the source table's schema SQL under each shard name.
+        """
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT type, name, sql FROM sqlite_master WHERE tbl_name = %s AND sql IS NOT NULL',
+                           [self.source_table])
+            schema = cursor.fetchall()
+            with connection.constraint_checks_disabled():
+                for suffix in self.suffixes:
+                    table = Event.objects.shard_table(suffix)
+                    for kind, name, sql in schema:
+                        sql = sql.replace('"%s"' % self.source_table, '"%s"' % table)
+                        if kind == 'index':
+                            sql = sql.replace('"%s"' % name, '"%s_%s"' % (table, name), 1)
+                        cursor.execute(sql)
+
+    # Paths
+
+    def shard(self):
+        Event.objects.shard(random.choice(self.suffixes))
+
+    def shard_read(self):
+        suffix = random.choice(self.suffixes[:1000])
+        Event.objects.shard(suffix).filter(tenant_id=int(suffix)).first()
+
+    def shard_read_cached(self):
+        suffix = random.choice(self.suffixes[:1000])
+        Event.objects.shard(suffix).filter(tenant_id=int(suffix)).cached().first()
+
+    def shard_exists(self):
+        Event.objects.shard_exists(random.choice(self.suffixes))
+
+    def catalog_load(self):
+        SHARD_CATALOG.load()
+
+    @mysql_only
+    def create(self):
+        suffix = random.choice(self.suffixes)
+        Event.objects.create(suffix, **event_row(int(suffix)))
+
+    def bulk_create(self):
+        suffix = random.choice(self.suffixes)
+        Event.objects.bulk_create(suffix, [event_row(int(suffix)) for _ in range(self.rows_per_bulk)])
+
+    @mysql_only
+    def migrate_shards(self):
+        """
+        The migrate shard phase for one added column, across every shard.
+        """
+        column = 'bench_%s' % random.randint(0, 10 ** 9)
+        with connection.cursor() as cursor:
+            cursor.execute('ALTER TABLE %s ADD COLUMN %s INT NULL' % (self.source_table, column))
+        command = MigrateCommand()
+        command.shard_concurrency = int(os.environ.get('BENCH_SHARD_CONCURRENCY', 4))
+        command.shard_failures = []
+        command.throttle = None
+        command.ledger = ShardLedger()
+        command.ledger.ensure_table()
+        changes = {
+            'model_changes': [(self.source_table, column, '', None, None, None)],
+            'add_unique_togethers': [], 'remove_unique_togethers': [], 'rename_fields': [],
+        }
+        stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+        try:
+            command.migrate_shards('bench-%s' % column, changes)
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+        if len(command.shard_failures) > 0:
+            raise RuntimeError('%s shard(s) failed to migrate' % len(command.shard_failures))
+
+    def paths(self):
+        return [
+            ('shard', self.shard, self.ops),
+            ('shard_read', self.shard_read, self.ops),
+            ('shard_read_cached', self.shard_read_cached, self.ops),
+            ('shard_exists', self.shard_exists, self.ops),
+            ('catalog_load', self.catalog_load, max(3, self.ops // 100)),
+            ('create', self.create, self.ops),
+            ('bulk_create', self.bulk_create, max(10, self.ops // 10)),
+            ('migrate_shards', self.migrate_shards, 1),
+        ]
+
+    # Measuring
+
+    @staticmethod
+    def time_ops(func, count):
+        latencies = []
+        started = time.perf_counter()
+        for _ in range(count):
+            op_started = time.perf_counter()
+            func()
+            latencies.append(time.perf_counter() - op_started)
+        total = time.perf_counter() - started
+        return {
+            'ops': count,
+            'ops_per_second': round(count / total, 2) if total > 0 else 0.0,
+            'p50_ms': round(percentile(latencies, 50) * 1000, 4),
+            'p99_ms': round(percentile(latencies, 99) * 1000, 4),
+        }
+
+    @staticmethod
+    def peak_memory(func, count):
+        tracemalloc.start()
+        try:
+            for _ in range(count):
+                func()
+            return tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    def run(self, only=None):
+        results = dict()
+        for name, func, count in self.paths():
+            if only and name not in only:
+                continue
+            if getattr(func, 'mysql_only', False) and backend() != 'mysql':
+                print('  %-18s skipped (needs MySQL)' % name)
+                continue
+            func()  # warm up
+            result = self.time_ops(func, count)
+            result['peak_kb'] = round(self.peak_memory(func, min(count, MEMORY_OPS)) / 1024.0, 1)
+            results[name] = result
+            print('  %-18s %10.1f ops/s   p50 %9.3f ms   p99 %9.3f ms   peak %8.1f KB' % (
+                name, result['ops_per_second'], result['p50_ms'], result['p99_ms'], result['peak_kb']))
+        return results
+
+
+def baseline_path(path=None):
+    return path or os.path.join(BASELINE_DIR, '%s.json' % backend())
+
+
+def compare(results, baseline, tolerance):
+    """
+    Paths slower than the baseline by more than tolerance (fraction of ops/s, or of p50 latency).
+    p99 is reported but not compared, it is too noisy over a few thousand operations.
+    """
+    regressions = []
+    for shards, paths in results.items():
+        for name, result in paths.items():
+            base = baseline.get('results', {}).get(shards, {}).get(name)
+            if base is None:
+                continue
+            if result['ops_per_second'] < base['ops_per_second'] * (1 - tolerance):
+                regressions.append('%s @ %s shards: %.1f ops/s, baseline %.1f' % (
+                    name, shards, result['ops_per_second'], base['ops_per_second']))
+            elif result['p50_ms'] > base['p50_ms'] * (1 + tolerance):
+                regressions.append('%s @ %s shards: p50 %.3f ms, baseline %.3f' % (
+                    name, shards, result['p50_ms'], base['p50_ms']))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark django-table-sharding hot paths.')
+    parser.add_argument('--shards', type=int, nargs='+', default=[10, 100, 1000])
+    parser.add_argument('--ops', type=int, default=2000, help='Operations per path (fewer for slow paths).')
+    parser.add_argument('--rows-per-bulk', type=int, default=100)
+    parser.add_argument('--path', action='append', default=[], help='Only run this path, can be repeated.')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--save-baseline', nargs='?', const='', default=None,
+                        help='Store the results as the baseline (default benchmarks/baselines/<backend>.json).')
+    parser.add_argument('--compare', nargs='?', const='', default=None,
+                        help='Compare the results with a baseline and exit 1 on regressions.')
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    parser.add_argument('--output', default=None, help='Also write the results to this JSON file.')
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    results = dict()
+    for shards in args.shards:
+        print('%s shards (%s):' % (shards, backend()))
+        bench = Bench(shards, args.ops, args.rows_per_bulk)
+        bench.setup()
+        results[str(shards)] = bench.run(only=args.path)
+        bench.drop_shards()
+
+    report = {
+        'backend': backend(),
+        'python': platform.python_version(),
+        'django': django.get_version(),
+        'machine': platform.machine(),
+        'created': datetime.datetime.now().isoformat(timespec='seconds'),
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+    if args.save_baseline is not None:
+        path = baseline_path(args.save_baseline)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+        print('Baseline saved to %s' % path)
+
+    if args.compare is not None:
+        path = baseline_path(args.compare)
+        with open(path) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if len(regressions) > 0:
+            print('\nRegressions against %s:' % path)
+            for regression in regressions:
+                print('  %s' % regression)
+            sys.exit(1)
+        print('\nNo regressions against %s.' % path)
+
+
+if __name__ == '__main__':
+    main()
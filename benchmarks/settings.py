@@ -0,0 +1,37 @@
+import os
+import tempfile
+
+
+'''
+
+    Benchmark settings. MySQL/MariaDB when BENCH_MYSQL_NAME is set, otherwise a SQLite file.
+
+'''
+
+
+SECRET_KEY = 'benchmarks'
+INSTALLED_APPS = ['django_table_sharding', 'benchapp']
+USE_TZ = False
+DEFAULT_AUTO_FIELD = 'django.db.models.AutoField'
+SHARDING_METRICS_SAMPLE_RATE = 0
+SHARDING_QUERY_CACHE_ENABLED = True
+SHARDING_MODEL_CACHE_SIZE = int(os.environ.get('BENCH_MODEL_CACHE_SIZE', 1024))
+
+if os.environ.get('BENCH_MYSQL_NAME'):
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.mysql',
+            'NAME': os.environ['BENCH_MYSQL_NAME'],
+            'USER': os.environ.get('BENCH_MYSQL_USER', 'root'),
+            'PASSWORD': os.environ.get('BENCH_MYSQL_PASSWORD', ''),
+            'HOST': os.environ.get('BENCH_MYSQL_HOST', '127.0.0.1'),
+            'PORT': os.environ.get('BENCH_MYSQL_PORT', '3306'),
+        }
+    }
+else:
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.environ.get('BENCH_SQLITE_NAME', os.path.join(tempfile.gettempdir(), 'sharding_bench.sqlite3')),
+        }
+    }
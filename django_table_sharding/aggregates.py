@@ -0,0 +1,102 @@
+from django.db.models import Avg, Count, Max, Min, Sum
+from .exceptions import ShardException
+
+
+'''
+
+    Combining partial aggregates computed by each shard.
+
+    Every shard computes its aggregates in SQL, and only the partial results come back:
+        Count -> sum of counts
+        Sum   -> sum of sums
+        Min   -> min of mins
+        Max   -> max of maxes
+        Avg   -> computed as Sum and Count on each shard, then sum / count
+
+'''
+
+
+class PartialAggregate:
+    """
+    One aggregate split into the expressions each shard computes, and how to combine them.
+    """
+    def __init__(self, alias, aggregate):
+        self.alias = alias
+        if getattr(aggregate, 'distinct', False):
+            raise ShardException('Distinct aggregates cannot be combined across shards: %s' % alias)
+
+        if isinstance(aggregate, Avg):
+            self.kind = 'avg'
+            expressions = aggregate.source_expressions
+            self.sum_alias = '%s__shard_sum' % alias
+            self.count_alias = '%s__shard_count' % alias
+            self.shard_aggregates = {
+                self.sum_alias: Sum(*expressions, filter=aggregate.filter),
+                self.count_alias: Count(*expressions, filter=aggregate.filter),
+            }
+        elif isinstance(aggregate, Count):
+            self.kind = 'count'
+            self.shard_aggregates = {alias: aggregate}
+        elif isinstance(aggregate, Sum):
+            self.kind = 'sum'
+            self.shard_aggregates = {alias: aggregate}
+        elif isinstance(aggregate, Min):
+            self.kind = 'min'
+            self.shard_aggregates = {alias: aggregate}
+        elif isinstance(aggregate, Max):
+            self.kind = 'max'
+            self.shard_aggregates = {alias: aggregate}
+        else:
+            raise ShardException('%s cannot be combined across shards: %s' % (
+                aggregate.__class__.__name__, alias))
+
+    def combine(self, rows):
+        """
+        Combine the partial results of every shard (dicts holding the shard aggregate aliases).
+        """
+        if self.kind == 'avg':
+            total = None
+            count = 0
+            for row in rows:
+                if row.get(self.sum_alias) is not None:
+                    total = row[self.sum_alias] if total is None else total + row[self.sum_alias]
+                count += row.get(self.count_alias) or 0
+            if total is None or count == 0:
+                return None
+            return total / count
+
+        values = [row.get(self.alias) for row in rows]
+        if self.kind == 'count':
+            return sum(value or 0 for value in values)
+        values = [value for value in values if value is not None]
+        if len(values) == 0:
+            return None
+        if self.kind == 'sum':
+            total = values[0]
+            for value in values[1:]:
+                total += value
+            return total
+        if self.kind == 'min':
+            return min(values)
+        return max(values)
+
+
+def split_aggregates(args, kwargs):
+    """
+    Turn aggregate()/annotate() arguments into PartialAggregates and the shard expressions to run.
+    """
+    aggregates = dict()
+    for arg in args:
+        try:
+            aggregates[arg.default_alias] = arg
+        except (AttributeError, TypeError) as err:
+            raise ShardException('Complex aggregates require an alias.') from err
+    aggregates.update(kwargs)
+
+    partials = []
+    shard_aggregates = dict()
+    for alias, aggregate in aggregates.items():
+        partial = PartialAggregate(alias, aggregate)
+        partials.append(partial)
+        shard_aggregates.update(partial.shard_aggregates)
+    return partials, shard_aggregates
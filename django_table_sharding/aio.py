@@ -0,0 +1,99 @@
+from .exceptions import ShardException
+from .utils import start_workers
+from functools import lru_cache
+import asyncio
+
+try:
+    from asgiref.sync import sync_to_async
+except ImportError:
+    # Django < 3.0 has no async support.
+    sync_to_async = None
+
+
+'''
+
+    Asyncio API for sharded models.
+
+    Django's database layer is synchronous, so queries still run on threads. Single shard calls
+    (acreate(), abulk_create(), the a* QuerySet methods) run on Django's thread for sync code, like
+    Django's own async methods. Fan out across shards runs on at most `workers` threads of the shared
+    worker pool (see utils.worker_pool), awaited from the event loop, so an async view never blocks the
+    loop however many shards it queries.
+
+    Usage:
+        async for person in Person.objects.ashard(1).filter(age__gte=21):
+            ...
+        await Person.objects.acreate(1, name='Ray', age=30)
+        people = [p async for p in Person.objects.across_shards('all', workers=4).order_by('-age')[:10]]
+
+'''
+
+
+def run_sync(func):
+    """
+    Coroutine function running func on Django's thread for sync code.
+    """
+    if sync_to_async is None:
+        raise ShardException('The async shard API needs Django 3.0 or newer.')
+    return sync_to_async(func)
+
+
+async def async_map(func, items, workers=None):
+    """
+    The async parallel_map(): call func(item) for every item on at most `workers` threads of the worker
+    pool, awaiting them without blocking the event loop. Returns a list of (item, result, exception)
+    in item order.
+    """
+    items = list(items)
+    if len(items) == 0:
+        return []
+    futures, results = start_workers(func, items, workers)
+    await asyncio.gather(*[asyncio.wrap_future(future) for future in futures])
+    return results
+
+
+class AsyncQuerySetMixin:
+    """
+    The async QuerySet methods of Django 4.1+ for older versions: async for, aget(), afirst(), alast(),
+    acount(), aexists(), aaggregate(), aupdate() and adelete().
+    """
+    def __aiter__(self):
+        async def rows():
+            await run_sync(self._fetch_all)()
+            for row in self._result_cache:
+                yield row
+        return rows()
+
+    async def aget(self, *args, **kwargs):
+        return await run_sync(self.get)(*args, **kwargs)
+
+    async def afirst(self):
+        return await run_sync(self.first)()
+
+    async def alast(self):
+        return await run_sync(self.last)()
+
+    async def acount(self):
+        return await run_sync(self.count)()
+
+    async def aexists(self):
+        return await run_sync(self.exists)()
+
+    async def aaggregate(self, *args, **kwargs):
+        return await run_sync(self.aggregate)(*args, **kwargs)
+
+    async def aupdate(self, **kwargs):
+        return await run_sync(self.update)(**kwargs)
+
+    async def adelete(self):
+        return await run_sync(self.delete)()
+
+
+@lru_cache(maxsize=None)
+def asynchronous(queryset_class):
+    """
+    The QuerySet class with async methods: unchanged on Django 4.1+, else with AsyncQuerySetMixin.
+    """
+    if hasattr(queryset_class, '__aiter__'):
+        return queryset_class
+    return type('Async%s' % queryset_class.__name__, (AsyncQuerySetMixin, queryset_class), {})
@@ -0,0 +1,508 @@
+from django.conf import settings
+from django.db import connections, models, transaction
+from .exceptions import ShardException
+from functools import lru_cache
+import csv
+import datetime
+import os
+import tempfile
+import threading
+import time
+import traceback
+
+
+'''
+
+    Multi-row inserts, upserts and updates for shard tables.
+
+    Rows are converted with per-model converters built once from the model's field definitions,
+    grouped by the columns they set, and sent as INSERT ... VALUES (...), (...) statements sized
+    to fit in max_allowed_packet. Caller dicts are never modified.
+
+    Upserts add ON DUPLICATE KEY UPDATE, and updates use one CASE expression per field so many
+    rows are changed with a single UPDATE statement.
+
+    Very large imports stream through a temporary file into LOAD DATA LOCAL INFILE.
+
+'''
+
+
+DEFAULT_MAX_PACKET = 4 * 1024 * 1024
+
+# Fraction of max_allowed_packet a statement may use, leaving room for protocol overhead.
+PACKET_FILL = 0.8
+
+_MAX_PACKET = dict()
+_CONVERTERS = dict()
+_CONVERTERS_LOCK = threading.Lock()
+
+
+def max_allowed_packet(db='default'):
+    """
+    max_allowed_packet of a database connection, read once per alias.
+    The SHARDING_MAX_PACKET setting overrides it.
+    """
+    size = _MAX_PACKET.get(db)
+    if size is None:
+        size = getattr(settings, 'SHARDING_MAX_PACKET', None)
+        if size is None:
+            size = DEFAULT_MAX_PACKET
+            if connections[db].vendor == 'mysql':
+                try:
+                    with connections[db].cursor() as cursor:
+                        cursor.execute('SELECT @@max_allowed_packet')
+                        size = int(cursor.fetchone()[0])
+                except Exception:
+                    print(traceback.format_exc())
+        _MAX_PACKET[db] = size
+    return size
+
+
+def convert_value(v):
+    """
+    Conversion for columns that are not fields on the model.
+    """
+    if isinstance(v, datetime.datetime):
+        return v.strftime('%Y-%m-%d %H:%M:%S')
+    elif isinstance(v, datetime.date):
+        return v.strftime('%Y-%m-%d')
+    elif isinstance(v, datetime.time):
+        return v.strftime('%H:%M:%S')
+    elif isinstance(v, bool):
+        return 1 if v else 0
+    return v
+
+
+class RowConverter:
+    """
+    Converts dicts of field values into (columns, values) for one model and database.
+    Keys can be field names, attnames or column names. For inserts None values are left out so the
+    column default applies, like the rest of the shard manager; upserts keep them to set NULL.
+    """
+    def __init__(self, model, db='default'):
+        connection = connections[db]
+        self.model = model
+        self.fields = dict()
+        self.attnames = dict()
+        for index, field in enumerate(getattr(model, '_meta').concrete_fields):
+            entry = (index, field.column, self._field_converter(field, connection))
+            for key in (field.name, field.attname, field.column):
+                self.fields[key] = entry
+            self.attnames[field.column] = field.attname
+        self.unknown_index = len(self.fields)
+
+    @staticmethod
+    def _field_converter(field, connection):
+        prep = field.get_db_prep_save
+        if field.is_relation:
+            def convert(value):
+                if isinstance(value, models.Model):
+                    value = value.pk
+                return prep(value, connection)
+            return convert
+        return lambda value: prep(value, connection)
+
+    def columns(self, field_names):
+        """
+        Column names of fields, in the order given.
+        """
+        columns = []
+        for field_name in field_names:
+            entry = self.fields.get(field_name)
+            if entry is None:
+                raise ShardException('%s has no field %s.' % (self.model.__name__, field_name))
+            columns.append(entry[1])
+        return tuple(columns)
+
+    def convert(self, dict_fields, keep_none=False):
+        """
+        (columns, values) of a row, with columns in model field order. None values are left out
+        unless keep_none is set.
+        """
+        items = []
+        for key, value in dict_fields.items():
+            if value is None and not keep_none:
+                continue
+            entry = self.fields.get(key)
+            if entry is None:
+                items.append((self.unknown_index, key, convert_value(value)))
+            else:
+                items.append((entry[0], entry[1], entry[2](value)))
+        items.sort(key=lambda item: (item[0], item[1]))
+        return tuple(item[1] for item in items), tuple(item[2] for item in items)
+
+
+def row_converter(model, db='default'):
+    """
+    Cached RowConverter for a model and database alias.
+    """
+    key = (model, db)
+    converter = _CONVERTERS.get(key)
+    if converter is None:
+        with _CONVERTERS_LOCK:
+            converter = _CONVERTERS.get(key)
+            if converter is None:
+                converter = RowConverter(model, db)
+                _CONVERTERS[key] = converter
+    return converter
+
+
+@lru_cache(maxsize=1024)
+def insert_sql(db_table, columns, ignore_conflicts=False, db='default'):
+    """
+    (statement prefix, placeholders for one row) of an INSERT into db_table.
+    """
+    quote_name = connections[db].ops.quote_name
+    prefix = '%s INTO %s (%s) VALUES ' % (
+        'INSERT IGNORE' if ignore_conflicts else 'INSERT',
+        quote_name(db_table), ', '.join(quote_name(column) for column in columns))
+    row_sql = '(%s)' % ', '.join(['%s'] * len(columns))
+    return prefix, row_sql
+
+
+@lru_cache(maxsize=1024)
+def upsert_sql(db_table, columns, update_columns, db='default'):
+    """
+    (statement prefix, placeholders for one row, statement suffix) of an INSERT ... ON DUPLICATE KEY UPDATE.
+    """
+    quote_name = connections[db].ops.quote_name
+    prefix, row_sql = insert_sql(db_table, columns, False, db)
+    suffix = ' ON DUPLICATE KEY UPDATE %s' % ', '.join(
+        '%s = VALUES(%s)' % (quote_name(column), quote_name(column)) for column in update_columns)
+    return prefix, row_sql, suffix
+
+
+def value_size(value):
+    if isinstance(value, (bytes, bytearray)):
+        return len(value) + 3
+    return len(str(value)) + 3
+
+
+def batches(rows, max_rows, max_bytes, base_size, row_overhead, row_size=None):
+    """
+    Split rows (tuples of values) into batches of at most max_rows that fit in max_bytes.
+    row_size(values) overrides the size of a row's values, for statements that bind some values several times.
+    """
+    batch = []
+    size = base_size
+    for values in rows:
+        if row_size is None:
+            row_bytes = row_overhead + sum(value_size(value) for value in values)
+        else:
+            row_bytes = row_overhead + row_size(values)
+        if batch and (len(batch) >= max_rows or size + row_bytes > max_bytes):
+            yield batch
+            batch = []
+            size = base_size
+        batch.append(values)
+        size += row_bytes
+    if batch:
+        yield batch
+
+
+def write_rows(model, db_table, list_of_dicts, batch_size=None, ignore_conflicts=False, update_fields=None,
+               upsert=False, db='default'):
+    """
+    Insert (or upsert) dicts of field values into db_table with multi-row statements.
+    Rows that set different columns go into separate statements. Returns the affected row count.
+    """
+    connection = connections[db]
+    converter = row_converter(model, db)
+    pk_column = getattr(model, '_meta').pk.column
+
+    update_columns = None
+    if update_fields is not None:
+        update_columns = converter.columns(update_fields)
+
+    groups = dict()
+    for dict_fields in list_of_dicts:
+        # An upsert must be able to set a column back to NULL on existing rows.
+        columns, values = converter.convert(dict_fields, keep_none=upsert)
+        groups.setdefault(columns, []).append(values)
+
+    affected = 0
+    try:
+        with transaction.atomic(using=db), connection.cursor() as cursor:
+            for columns, rows in groups.items():
+                if upsert:
+                    if update_columns is None:
+                        group_updates = tuple(column for column in columns if column != pk_column)
+                    else:
+                        group_updates = tuple(column for column in update_columns if column in columns)
+                    if len(group_updates) == 0:
+                        # Nothing to update, so existing rows are left alone.
+                        prefix, row_sql = insert_sql(db_table, columns, True, db)
+                        suffix = ''
+                    else:
+                        prefix, row_sql, suffix = upsert_sql(db_table, columns, group_updates, db)
+                else:
+                    prefix, row_sql = insert_sql(db_table, columns, ignore_conflicts, db)
+                    suffix = ''
+
+                affected += execute_rows(cursor, prefix, row_sql, suffix, columns, rows, batch_size, db)
+    except Exception:
+        raise ShardException(traceback.format_exc())
+    return affected
+
+
+def execute_rows(cursor, prefix, row_sql, suffix, columns, rows, batch_size=None, db='default'):
+    """
+    Execute prefix + (row), (row), ... + suffix for rows of database ready values, in batches that fit
+    in max_allowed_packet. Returns the affected row count.
+    """
+    max_bytes = int(max_allowed_packet(db) * PACKET_FILL)
+    max_rows = connections[db].ops.bulk_batch_size(columns, rows) or len(rows)
+    if batch_size:
+        max_rows = min(max_rows, batch_size)
+    affected = 0
+    for batch in batches(rows, max_rows, max_bytes, len(prefix) + len(suffix), len(row_sql)):
+        sql = prefix + ', '.join([row_sql] * len(batch)) + suffix
+        cursor.execute(sql, [value for values in batch for value in values])
+        affected += max(cursor.rowcount, 0)
+    return affected
+
+
+def insert_values(db_table, columns, rows, batch_size=None, db='default'):
+    """
+    Insert rows of values that are already converted for the database (tuples in column order),
+    without converting them again. Returns the number of rows inserted.
+    """
+    prefix, row_sql = insert_sql(db_table, tuple(columns), False, db)
+    try:
+        with transaction.atomic(using=db), connections[db].cursor() as cursor:
+            return execute_rows(cursor, prefix, row_sql, '', columns, rows, batch_size, db)
+    except Exception:
+        raise ShardException(traceback.format_exc())
+
+
+def insert_rows(model, db_table, list_of_dicts, batch_size=None, ignore_conflicts=False, db='default'):
+    """
+    Insert dicts of field values into db_table. Returns the number of rows inserted.
+    """
+    return write_rows(
+        model, db_table, list_of_dicts, batch_size=batch_size, ignore_conflicts=ignore_conflicts, db=db)
+
+
+def upsert_rows(model, db_table, list_of_dicts, update_fields=None, batch_size=None, db='default'):
+    """
+    INSERT ... ON DUPLICATE KEY UPDATE dicts of field values into db_table. Rows that already exist
+    (by primary key or a unique index) get update_fields overwritten, by default every column they set.
+    None values are written as NULL, also on inserted rows.
+    Returns MySQL's affected row count (1 per inserted row, 2 per updated row).
+    """
+    return write_rows(
+        model, db_table, list_of_dicts, batch_size=batch_size, update_fields=update_fields, upsert=True, db=db)
+
+
+def update_rows(model, db_table, objs, fields, batch_size=None, db='default'):
+    """
+    Update fields of many rows by primary key with CASE expressions, one statement per batch:
+        UPDATE t SET a = CASE id WHEN 1 THEN .. WHEN 2 THEN .. ELSE a END, .. WHERE id IN (1, 2)
+    objs can be model instances or dicts holding the primary key. Returns the number of rows updated.
+    """
+    if len(fields) == 0:
+        raise ShardException('No fields to update.')
+    connection = connections[db]
+    quote_name = connection.ops.quote_name
+    meta = getattr(model, '_meta')
+    converter = row_converter(model, db)
+    pk = meta.pk
+    pk_convert = converter.fields[pk.column][2]
+
+    entries = [converter.fields[column] for column in converter.columns(fields)]
+    attnames = [converter.attnames[entry[1]] for entry in entries]
+
+    rows = []
+    for obj in objs:
+        if isinstance(obj, dict):
+            pk_value = obj.get(pk.attname, obj.get(pk.name, obj.get('pk')))
+            values = []
+            for field_name, attname in zip(fields, attnames):
+                if field_name not in obj and attname not in obj:
+                    raise ShardException('Missing value for %s.' % field_name)
+                values.append(obj[field_name] if field_name in obj else obj[attname])
+        else:
+            pk_value = obj.pk
+            values = [getattr(obj, attname) for attname in attnames]
+        if pk_value is None:
+            raise ShardException('Objects must have a primary key to be updated.')
+        rows.append((pk_convert(pk_value),) + tuple(entry[2](value) for entry, value in zip(entries, values)))
+
+    pk_sql = quote_name(pk.column)
+    max_bytes = int(max_allowed_packet(db) * PACKET_FILL)
+    # Every row binds its pk once per field plus once in the WHERE clause.
+    max_rows = connection.ops.bulk_batch_size(['pk'] * (2 * len(fields) + 1), rows) or len(rows)
+    if batch_size:
+        max_rows = min(max_rows, batch_size)
+
+    def row_size(values):
+        # The pk is sent once per field (WHEN pk THEN value) and once more in the WHERE clause.
+        return value_size(values[0]) * (len(entries) + 1) + sum(value_size(value) for value in values[1:])
+
+    updated = 0
+    try:
+        with transaction.atomic(using=db), connection.cursor() as cursor:
+            for batch in batches(rows, max(max_rows, 1), max_bytes, 100, 20 * len(entries), row_size):
+                assignments = []
+                params = []
+                for index, entry in enumerate(entries, start=1):
+                    column = quote_name(entry[1])
+                    assignments.append('%s = CASE %s %s ELSE %s END' % (
+                        column, pk_sql, ' '.join(['WHEN %s THEN %s'] * len(batch)), column))
+                    for values in batch:
+                        params.extend((values[0], values[index]))
+                params.extend(values[0] for values in batch)
+                sql = 'UPDATE %s SET %s WHERE %s IN (%s)' % (
+                    quote_name(db_table), ', '.join(assignments), pk_sql, ', '.join(['%s'] * len(batch)))
+                cursor.execute(sql, params)
+                updated += max(cursor.rowcount, 0)
+    except Exception:
+        raise ShardException(traceback.format_exc())
+    return updated
+
+
+# MySQL errors raised when LOAD DATA LOCAL INFILE is disabled on the client or server.
+LOCAL_INFILE_ERRORS = (1148, 2068, 3948, 3950)
+
+
+def tsv_value(value):
+    """
+    Format a value for LOAD DATA's default tab separated format.
+    """
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    if isinstance(value, (bytes, bytearray)):
+        value = value.decode('utf-8')
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+def tsv_parse(value):
+    if value == '\\N':
+        return None
+    return value.replace('\\r', '\r').replace('\\n', '\n').replace('\\t', '\t').replace('\\\\', '\\')
+
+
+def default_load_columns(model):
+    """
+    Columns loaded by default: the model's concrete fields without an auto primary key.
+    """
+    meta = getattr(model, '_meta')
+    return tuple(
+        field.column for field in meta.concrete_fields
+        if not (field.primary_key and isinstance(field, models.AutoField)))
+
+
+def write_load_file(model, rows, columns, db='default'):
+    """
+    Stream rows into a temporary tab separated file. Returns (path, rows written).
+    Rows can be dicts (missing keys load as NULL) or sequences in column order.
+    """
+    converter = row_converter(model, db)
+    convert = [converter.fields[column][2] for column in columns]
+    column_index = dict((column, i) for i, column in enumerate(columns))
+    count = 0
+    out = tempfile.NamedTemporaryFile('w', delete=False, suffix='.tsv', encoding='utf-8', newline='')
+    try:
+        with out:
+            for row in rows:
+                if isinstance(row, dict):
+                    values = [None] * len(columns)
+                    for key, value in row.items():
+                        entry = converter.fields.get(key)
+                        i = column_index.get(entry[1] if entry is not None else key)
+                        if i is not None:
+                            values[i] = value
+                else:
+                    values = row
+                out.write('\t'.join(
+                    tsv_value(None if value is None else f(value)) for f, value in zip(convert, values)))
+                out.write('\n')
+                count += 1
+    except BaseException:
+        # Don't leave a half written file behind when a row fails to convert.
+        os.remove(out.name)
+        raise
+    return out.name, count
+
+
+def load_rows(model, db_table, source, columns=None, chunk_size=10000, db='default'):
+    """
+    Load many rows into db_table with LOAD DATA LOCAL INFILE, streaming them through a temporary
+    file first. source is an iterable of dicts or sequences, or a CSV file (path or open file) with
+    a header row of field names. Columns default to the CSV header or the model's concrete fields.
+    If LOAD DATA LOCAL is not permitted (or the database isn't MySQL), the file is read back and
+    loaded with chunked multi-row inserts instead. The file holds values already converted for the
+    database, so they are inserted as they are.
+    Returns {'rows', 'seconds', 'rows_per_second', 'method', 'warnings'}.
+    """
+    connection = connections[db]
+    quote_name = connection.ops.quote_name
+    converter = row_converter(model, db)
+    started = time.time()
+
+    csv_file = None
+    if isinstance(source, str):
+        csv_file = open(source, newline='', encoding='utf-8')
+        reader = csv.reader(csv_file)
+    elif hasattr(source, 'read'):
+        reader = csv.reader(source)
+    else:
+        reader = None
+    try:
+        if reader is not None:
+            header = next(reader)
+            columns = converter.columns(columns or header)
+            source = ([None if value == '' else value for value in row] for row in reader)
+        elif columns is not None:
+            columns = converter.columns(columns)
+        else:
+            columns = default_load_columns(model)
+        path, rows = write_load_file(model, source, columns, db=db)
+    finally:
+        if csv_file is not None:
+            csv_file.close()
+
+    warnings = []
+    method = 'load_data'
+    try:
+        loaded = False
+        if connection.vendor == 'mysql':
+            sql = "LOAD DATA LOCAL INFILE %%s INTO TABLE %s CHARACTER SET utf8mb4 " \
+                  "FIELDS TERMINATED BY '\\t' ESCAPED BY '\\\\' LINES TERMINATED BY '\\n' (%s)" % (
+                      quote_name(db_table), ', '.join(quote_name(column) for column in columns))
+            try:
+                with connection.cursor() as cursor:
+                    cursor.execute(sql, [path])
+                    cursor.execute('SHOW WARNINGS LIMIT 64')
+                    warnings = ['%s %s: %s' % tuple(row) for row in cursor.fetchall()]
+                loaded = True
+            except Exception as err:
+                code = err.args[0] if len(err.args) > 0 else None
+                if code not in LOCAL_INFILE_ERRORS:
+                    raise ShardException(traceback.format_exc())
+                warnings.append('LOAD DATA LOCAL INFILE not permitted, using inserts: %s' % err)
+
+        if not loaded:
+            method = 'insert'
+            with open(path, newline='', encoding='utf-8') as f:
+                chunk = []
+                for line in f:
+                    chunk.append(tuple(tsv_parse(value) for value in line.rstrip('\n').split('\t')))
+                    if len(chunk) >= chunk_size:
+                        insert_values(db_table, columns, chunk, db=db)
+                        chunk = []
+                if chunk:
+                    insert_values(db_table, columns, chunk, db=db)
+    finally:
+        os.remove(path)
+
+    seconds = time.time() - started
+    return {
+        'rows': rows,
+        'seconds': seconds,
+        'rows_per_second': rows / seconds if seconds > 0 else float(rows),
+        'method': method,
+        'warnings': warnings,
+    }
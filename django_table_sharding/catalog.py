@@ -0,0 +1,168 @@
+from django.apps import apps
+from django.conf import settings
+from django.db import connections
+from .exceptions import ShardException
+import threading
+import time
+import traceback
+
+
+'''
+
+    Shard catalog: which shard tables exist, for every sharded model.
+
+    All tables of a database are read with one query and kept in memory for SHARDING_CATALOG_TTL
+    seconds (default 60). Existence checks are exact matches against a set, so checking a shard on the
+    write path costs no database round trip. copy_table() adds new shards to the catalog.
+
+'''
+
+
+def sharded_models():
+    """
+    Every installed model that uses a ShardManager.
+    """
+    return [m for m in apps.get_models() if hasattr(getattr(m, 'objects', None), 'shard_table')]
+
+
+def shard_prefix(model):
+    """
+    Table name prefix of a model's shards: <app_label>_<model>_
+    """
+    return model.objects.shard_table('')
+
+
+class ShardCatalog:
+    """
+    In-process cache of the shard tables in each database, keyed by database alias.
+    """
+    def __init__(self, ttl=None):
+        self.ttl = ttl
+        self._databases = dict()
+        self._lock = threading.RLock()
+
+    def get_ttl(self):
+        if self.ttl is not None:
+            return self.ttl
+        return getattr(settings, 'SHARDING_CATALOG_TTL', 60)
+
+    @staticmethod
+    def list_tables(db='default'):
+        """
+        Every table in the database, with one query.
+        """
+        connection = connections[db]
+        with connection.cursor() as cursor:
+            if connection.vendor == 'mysql':
+                cursor.execute('SELECT TABLE_NAME FROM INFORMATION_SCHEMA.TABLES WHERE TABLE_SCHEMA = DATABASE()')
+                return [row[0] for row in cursor.fetchall()]
+            return connection.introspection.table_names(cursor)
+
+    @staticmethod
+    def match_table(table, prefixes, source_tables):
+        """
+        (model, suffix) of a shard table, using the longest matching shard prefix.
+        Returns (None, None) for tables that are not shards.
+        """
+        if table in source_tables:
+            return None, None
+        for prefix, model in prefixes:
+            if table.startswith(prefix) and len(table) > len(prefix):
+                return model, table[len(prefix):]
+        return None, None
+
+    def _prefixes(self):
+        models = sharded_models()
+        prefixes = sorted(((shard_prefix(m), m) for m in models), key=lambda item: -len(item[0]))
+        # Auto-created many-to-many tables (app_person_friends) share the shard prefix but are not shards.
+        source_tables = set(getattr(m, '_meta').db_table for m in apps.get_models(include_auto_created=True))
+        return prefixes, source_tables
+
+    def model_for_table(self, table):
+        """
+        (model, suffix) of a shard table name, or (None, None). Needs no database.
+        """
+        prefixes, source_tables = self._prefixes()
+        return self.match_table(table, prefixes, source_tables)
+
+    def load(self, db='default'):
+        """
+        Read every shard table of the database into the catalog.
+        """
+        try:
+            tables = self.list_tables(db)
+        except Exception:
+            raise ShardException(traceback.format_exc())
+
+        prefixes, source_tables = self._prefixes()
+        shards = dict()
+        for table in tables:
+            model, suffix = self.match_table(table, prefixes, source_tables)
+            if model is not None:
+                shards.setdefault(model, dict())[suffix] = table
+
+        entry = {'loaded': time.time(), 'shards': shards, 'prefixes': prefixes, 'source_tables': source_tables}
+        with self._lock:
+            self._databases[db] = entry
+        return entry
+
+    def _entry(self, db='default'):
+        with self._lock:
+            entry = self._databases.get(db)
+        if entry is None or time.time() - entry['loaded'] > self.get_ttl():
+            entry = self.load(db)
+        return entry
+
+    def exists(self, model, table_suffix, db='default'):
+        """
+        True if the shard table of a model exists (exact match).
+        """
+        return str(table_suffix) in self._entry(db)['shards'].get(model, dict())
+
+    def suffixes(self, model, db='default'):
+        """
+        Suffixes of every shard of a model, numeric suffixes in numeric order.
+        """
+        suffixes = self._entry(db)['shards'].get(model, dict()).keys()
+        return sorted(suffixes, key=lambda s: (not s.isdigit(), int(s) if s.isdigit() else 0, s))
+
+    def tables(self, model, db='default'):
+        """
+        Shard tables of a model, in suffix order.
+        """
+        shards = self._entry(db)['shards'].get(model, dict())
+        return [shards[suffix] for suffix in self.suffixes(model, db)]
+
+    def tables_for_source(self, db_table, db='default'):
+        """
+        Shard tables of the model whose source table is db_table.
+        """
+        for model in sharded_models():
+            if getattr(model, '_meta').db_table == db_table:
+                return self.tables(model, db)
+        return []
+
+    def add_table(self, table, db='default'):
+        """
+        Record a table that was just created, without reloading the catalog.
+        """
+        with self._lock:
+            entry = self._databases.get(db)
+            if entry is None:
+                return
+            model, suffix = self.match_table(table, entry['prefixes'], entry['source_tables'])
+            if model is not None:
+                entry['shards'].setdefault(model, dict())[suffix] = table
+
+    def invalidate(self, db=None):
+        """
+        Forget the cached tables of one database, or of every database.
+        """
+        with self._lock:
+            if db is None:
+                self._databases.clear()
+            else:
+                self._databases.pop(db, None)
+
+
+SHARD_CATALOG = ShardCatalog()
@@ -0,0 +1,3 @@
+
+class ShardException(Exception):
+    pass
@@ -0,0 +1,147 @@
+from django.conf import settings
+from django.db import connections
+import hashlib
+import json
+import threading
+import time
+
+
+'''
+
+    Shard migration ledger.
+
+    Before Django applies the source migrations, the shard changes they need are stored as a pending
+    run, keyed by a fingerprint of the migrations and changes. Every shard that finishes its changes is
+    recorded in the same table, so a migrate that stopped halfway continues with the remaining shards,
+    even though Django already marked the source migrations as applied.
+
+    One row per run (shard_table = '') and one row per finished shard operation.
+
+'''
+
+
+RUN_OPERATION = 'run'
+
+# (alias, table) of ledger tables known to exist, so CREATE TABLE runs once per alias and process.
+_ENSURED = set()
+_ENSURED_LOCK = threading.Lock()
+
+
+def ledger_table():
+    return getattr(settings, 'SHARDING_LEDGER_TABLE', 'django_table_sharding_ledger')
+
+
+def fingerprint(migrations, changes):
+    """
+    sha1 of the migrations and the shard changes they queued.
+    """
+    payload = json.dumps([list(migrations), changes], sort_keys=True, default=str)
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+
+class ShardLedger:
+    """
+    Reads and writes the ledger table of one database.
+    """
+    def __init__(self, db='default'):
+        self.db = db
+        self.table = ledger_table()
+
+    def ensure_table(self):
+        """
+        Create the ledger table, once per database alias.
+        """
+        key = (self.db, self.table)
+        if key in _ENSURED:
+            return
+        with _ENSURED_LOCK:
+            if key in _ENSURED:
+                return
+            self.create_table()
+            _ENSURED.add(key)
+
+    def create_table(self):
+        with connections[self.db].cursor() as cursor:
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS %s (
+                    fingerprint VARCHAR(40) NOT NULL,
+                    shard_table VARCHAR(64) NOT NULL,
+                    operation VARCHAR(64) NOT NULL,
+                    status VARCHAR(16) NOT NULL,
+                    migrations TEXT,
+                    changes TEXT,
+                    created DOUBLE PRECISION NOT NULL,
+                    PRIMARY KEY (fingerprint, shard_table, operation)
+                )''' % self.table)
+
+    def record_run(self, run_fingerprint, migrations, changes):
+        """
+        Store the shard changes of a migrate run before the source migrations are applied.
+        """
+        self.ensure_table()
+        with connections[self.db].cursor() as cursor:
+            cursor.execute(
+                'REPLACE INTO %s (fingerprint, shard_table, operation, status, migrations, changes, created) '
+                'VALUES (%%s, %%s, %%s, %%s, %%s, %%s, %%s)' % self.table,
+                [run_fingerprint, '', RUN_OPERATION, 'pending', json.dumps(list(migrations)),
+                 json.dumps(changes, default=str), time.time()])
+
+    def pending_runs(self):
+        """
+        [(fingerprint, migrations, changes)] of every run whose shards are not all migrated, oldest first.
+        """
+        self.ensure_table()
+        with connections[self.db].cursor() as cursor:
+            cursor.execute(
+                'SELECT fingerprint, migrations, changes FROM %s WHERE shard_table = %%s AND operation = %%s '
+                'AND status = %%s ORDER BY created' % self.table, ['', RUN_OPERATION, 'pending'])
+            rows = cursor.fetchall()
+        return [(row[0], json.loads(row[1]), json.loads(row[2])) for row in rows]
+
+    def done(self, run_fingerprint):
+        """
+        Set of (shard_table, operation) already finished for a run, read with one query.
+        """
+        with connections[self.db].cursor() as cursor:
+            cursor.execute(
+                'SELECT shard_table, operation FROM %s WHERE fingerprint = %%s AND shard_table != %%s '
+                'AND status = %%s' % self.table, [run_fingerprint, '', 'done'])
+            return set((row[0], row[1]) for row in cursor.fetchall())
+
+    def mark_done(self, run_fingerprint, shard_table, operation):
+        """
+        Record a finished shard operation. Operations on other databases name the database: alter@<alias>.
+        """
+        with connections[self.db].cursor() as cursor:
+            cursor.execute(
+                'REPLACE INTO %s (fingerprint, shard_table, operation, status, created) '
+                'VALUES (%%s, %%s, %%s, %%s, %%s)' % self.table,
+                [run_fingerprint, shard_table, operation, 'done', time.time()])
+
+    def record_copy(self, run_fingerprint, shard_table, first, last):
+        """
+        Record that rows with primary keys from first to last were copied into a shard (resharding).
+        """
+        pk_range = json.dumps([first, last], default=str)
+        operation = 'copy:%s' % hashlib.sha1(pk_range.encode('utf-8')).hexdigest()
+        with connections[self.db].cursor() as cursor:
+            cursor.execute(
+                'REPLACE INTO %s (fingerprint, shard_table, operation, status, changes, created) '
+                'VALUES (%%s, %%s, %%s, %%s, %%s, %%s)' % self.table,
+                [run_fingerprint, shard_table, operation, 'done', pk_range, time.time()])
+
+    def copied_ranges(self, run_fingerprint, shard_table):
+        """
+        [(first, last)] primary key ranges recorded with record_copy().
+        """
+        with connections[self.db].cursor() as cursor:
+            cursor.execute(
+                'SELECT changes FROM %s WHERE fingerprint = %%s AND shard_table = %%s AND operation LIKE %%s'
+                % self.table, [run_fingerprint, shard_table, 'copy:%'])
+            return [tuple(json.loads(row[0])) for row in cursor.fetchall()]
+
+    def finish_run(self, run_fingerprint):
+        with connections[self.db].cursor() as cursor:
+            cursor.execute(
+                'UPDATE %s SET status = %%s WHERE fingerprint = %%s AND shard_table = %%s AND operation = %%s'
+                % self.table, ['done', run_fingerprint, '', RUN_OPERATION])
@@ -1,9 +1,18 @@
-
 from django.core.management.commands.migrate import Command as MigrationCommand
 from django.apps import apps
+from django.conf import settings
 from django.db import connection, connections
 from django.db.migrations.executor import MigrationExecutor
+from django_table_sharding.catalog import SHARD_CATALOG, sharded_models
+from django_table_sharding.ledger import ShardLedger, fingerprint
+from django_table_sharding.metrics import measure
+from django_table_sharding.online import Throttle, run_online
+from django_table_sharding.placement import placement_databases
+from django_table_sharding.schema import AlterPlan, SchemaSnapshot, column_definition
+from concurrent.futures import ThreadPoolExecutor
+import copy
 import re
+import threading
 import traceback
 
 
@@ -26,7 +35,37 @@ class InvalidMigrationException(Exception):
 
 class Command(MigrationCommand):
 
+    def add_arguments(self, parser):
+        super(Command, self).add_arguments(parser)
+        parser.add_argument(
+            '--shard-concurrency', type=int, default=getattr(settings, 'SHARDING_MIGRATE_CONCURRENCY', 1),
+            help='Number of shards to alter at the same time, each on its own connection.')
+        parser.add_argument(
+            '--online', action='store_true', default=getattr(settings, 'SHARDING_MIGRATE_ONLINE', False),
+            help='Alter shards with ALGORITHM=INSTANT/INPLACE, LOCK=NONE where MySQL allows it, and throttle '
+                 'between shards.')
+        parser.add_argument(
+            '--max-threads-running', type=int, default=getattr(settings, 'SHARDING_THROTTLE_THREADS_RUNNING', None),
+            help='Online mode: wait between shards while Threads_running is above this.')
+        parser.add_argument(
+            '--max-replica-lag', type=int, default=getattr(settings, 'SHARDING_THROTTLE_REPLICA_LAG', None),
+            help='Online mode: wait between shards while a SHARDING_THROTTLE_REPLICAS database lags more seconds.')
+        parser.add_argument(
+            '--pause-file', default=getattr(settings, 'SHARDING_MIGRATE_PAUSE_FILE', None),
+            help='Online mode: wait between shards while this file exists (SIGUSR1/SIGUSR2 also pause/resume).')
+        parser.add_argument(
+            '--shards-only', action='store_true',
+            help='Only finish recorded shard migrations, without running the Django migrations.')
+
     def handle(self, *args, **options):
+        self.shard_concurrency = max(1, options.get('shard_concurrency') or 1)
+        self.shard_failures = []
+        self.throttle = None
+        if options.get('online'):
+            self.throttle = Throttle(
+                db=options['database'], max_threads_running=options.get('max_threads_running'),
+                max_replica_lag=options.get('max_replica_lag'), pause_file=options.get('pause_file'))
+            self.throttle.install_signals()
 
         # Work out which apps and models have migrations...
         # (taken from original django migrate)
@@ -125,328 +164,423 @@ class Command(MigrationCommand):
                             if db_table != '':
                                 add_unique_togethers.append((db_table, field_list))
 
+        db = options['database']
+        changes = {
+            'model_changes': model_changes,
+            'add_unique_togethers': add_unique_togethers,
+            'remove_unique_togethers': remove_unique_togethers,
+            'rename_fields': rename_fields,
+        }
+        self.ledger = ShardLedger(db)
         if len(model_changes) == 0 and len(add_unique_togethers) == 0 and len(remove_unique_togethers) == 0 and \
                 len(rename_fields) == 0:
             print('  No shard migrations to apply.\n')
+        elif not options.get('shards_only'):
+            # Record the shard changes before Django marks the source migrations as applied,
+            # so an interrupted run can be finished later.
+            migrations = ['%s.%s' % (p[0].app_label, p[0].name) for p in plan]
+            self.ledger.record_run(fingerprint(migrations, changes), migrations, changes)
 
         # Run Django supplied migrate command.
-        super(Command, self).handle(*args, **options)
+        if not options.get('shards_only'):
+            super(Command, self).handle(*args, **options)
 
-        # Go through our sharded model changes, and apply them to all sharded tables, after migration has finished.
-        if len(model_changes) > 0:
-            print('\nMigrating shards...')
-            for change in model_changes:
-                self.copy_table_changes(change[0], change[1], change[2], change[3], change[4], change[5], db=options['database'])
-            print('Finished!\n')
+        # Read the shard tables of every database fresh, once, for every shard change below.
+        SHARD_CATALOG.invalidate()
 
-        # Add all unique together constraints to sharded tables.
-        if len(add_unique_togethers) > 0:
-            print('\nMigrating unique together on shards...')
-            for change in add_unique_togethers:
-                self.copy_unique_together(change[0], change[1], db=options['database'])
-            print('Finished!\n')
+        # Finish every recorded run whose shards are not all migrated yet, oldest first.
+        for run, migrations, run_changes in self.ledger.pending_runs():
+            self.migrate_shards(run, run_changes, db=db)
 
-        if len(remove_unique_togethers) > 0:
-            print('\nMigrating remove unique together on shards...')
-            for change in remove_unique_togethers:
-                self.remove_unique_together(change[0], db=options['database'])
-            print('Finished!\n')
+        self.report_shards()
+
+    def migrate_shards(self, run, changes, db='default'):
+        """
+        Plan and apply the shard changes of one recorded run on every database holding shards, skipping
+        shards the ledger has as done. Shards on other databases are compared with the source tables of db.
+        """
+        done = self.ledger.done(run)
+        failures = len(self.shard_failures)
+
+        model_changes = changes['model_changes']
+        add_unique_togethers = changes['add_unique_togethers']
+        remove_unique_togethers = changes['remove_unique_togethers']
+        rename_fields = changes['rename_fields']
+        source_tables = set([change[0] for change in model_changes + add_unique_togethers +
+                             remove_unique_togethers + rename_fields])
+        if len(source_tables) == 0:
+            self.ledger.finish_run(run)
+            return
 
-        if len(rename_fields) > 0:
-            print('\nMigrating field name change on shards...')
+        self.snapshots = dict()
+        try:
+            source = self.get_snapshot(db, list(source_tables))
+        except:
+            print(traceback.format_exc())
+            source = SchemaSnapshot(db)
+
+        for node in placement_databases(sharded_models(), db=db):
+            self.ledger_operation = 'alter' if node == db else 'alter@%s' % node
+            self.skip_tables = set(table for table, operation in done if operation == self.ledger_operation)
+            if len(self.skip_tables) > 0:
+                print('\nResuming shard migration %s on %s, %s shard(s) already done.' % (
+                    run[:12], node, len(self.skip_tables)))
+
+            # Load the schema of every source table we change and all of its shards in a few queries.
+            if node != db:
+                snapshot = SchemaSnapshot(node)
+                for db_table in source_tables:
+                    snapshot.tables[db_table] = copy.deepcopy(source.table(db_table))
+                self.snapshots[node] = snapshot
+            snapshot_tables = []
+            for db_table in source_tables:
+                snapshot_tables.extend(self.get_sharded_tables(None, db_table, db=node))
+            try:
+                self.get_snapshot(node, snapshot_tables)
+            except:
+                print(traceback.format_exc())
+
+            # Plan every queued change first, so each shard gets all of its changes in one ALTER TABLE.
+            # Renames go first, since the other changes already use the new column names. Unique together
+            # indexes go last and are diffed against the migrated source table, so a run that adds and
+            # later removes one (or the other way around) ends with the source table's final set.
+            self.plan = AlterPlan()
             for change in rename_fields:
-                self.rename_fields(change[0], change[1], change[2], db=options['database'])
+                self.plan_shard_changes('rename %s' % change[1], self.rename_fields, change[0], change[1], change[2],
+                                        db=node)
+            for change in model_changes:
+                self.plan_shard_changes('change %s' % change[1], self.copy_table_changes, change[0], change[1],
+                                        change[2], change[3], change[4], change[5], db=node)
+            unique_together_tables = [change[0] for change in remove_unique_togethers + add_unique_togethers]
+            for db_table in dict.fromkeys(unique_together_tables):
+                self.plan_shard_changes('unique together', self.copy_unique_togethers, db_table, db=node)
+
+            print('\nMigrating shards on %s...' % node)
+            self.apply_plan(run, db=node)
             print('Finished!\n')
 
+        if len(self.shard_failures) == failures:
+            self.ledger.finish_run(run)
+        self.skip_tables = set()
+
+    def for_each_shard(self, tables, operation, func, db='default'):
+        """
+        Call func(table, cursor) for every shard table on shard_concurrency threads of a pool of its own
+        (not the shared worker pool, so --shard-concurrency isn't capped by SHARDING_POOL_SIZE), each with
+        its own connection. Progress is printed as shards finish, and failures are kept for the report at
+        the end of the migration instead of stopping the other shards.
+        """
+        total = len(tables)
+        progress = {'done': 0}
+        lock = threading.Lock()
+
+        def run(table):
+            try:
+                with connections[db].cursor() as cursor:
+                    func(table, cursor)
+                status = 'ok'
+            except Exception as err:
+                status = 'FAILED'
+                with lock:
+                    self.shard_failures.append((table, operation, err))
+                raise
+            finally:
+                with lock:
+                    progress['done'] += 1
+                    print('  [%s/%s] %s %s: %s' % (progress['done'], total, operation, table, status))
+
+        def run_closing(table):
+            try:
+                run(table)
+                return table
+            except Exception:
+                return None
+            finally:
+                # The pool is discarded after this migration step, so its threads don't keep connections.
+                connections[db].close()
+
+        workers = min(getattr(self, 'shard_concurrency', 1), total)
+        if workers <= 1:
+            finished = []
+            for table in tables:
+                try:
+                    run(table)
+                    finished.append(table)
+                except Exception:
+                    pass
+            return finished
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='shard-ddl') as pool:
+            return [table for table in pool.map(run_closing, tables) if table is not None]
+
+    def report_shards(self):
+        """
+        Print every shard operation that failed during this migration.
+        """
+        failures = getattr(self, 'shard_failures', [])
+        if len(failures) == 0:
+            return
+        print('\n%s shard operation(s) failed:' % len(failures))
+        for table, operation, err in failures:
+            lines = str(err).strip().splitlines() or [err.__class__.__name__]
+            print('  %s (%s): %s' % (table, operation, self.normalize_spaces(lines[-1])))
+        print('')
+
+    def get_snapshot(self, db, tables):
+        """
+        Schema snapshot of the database, loading any tables it doesn't hold yet in one batch.
+        """
+        if getattr(self, 'snapshots', None) is None:
+            self.snapshots = dict()
+        snapshot = self.snapshots.get(db)
+        if snapshot is None:
+            snapshot = SchemaSnapshot(db)
+            self.snapshots[db] = snapshot
+        return snapshot.load(tables)
+
+    def plan_shard_changes(self, operation, func, *args, **kwargs):
+        """
+        Add the clauses of one queued change to the plan. A change that can't be planned is
+        reported at the end of the migration, like a failed shard.
+        """
+        try:
+            func(*args, **kwargs)
+        except Exception as err:
+            print(traceback.format_exc())
+            self.shard_failures.append((args[0], operation, err))
+
+    def apply_plan(self, run, db='default'):
+        """
+        Run the planned ALTER TABLE statement of every shard, so each shard is rebuilt at most once.
+        Finished shards are recorded in the ledger under the run's fingerprint.
+        """
+        statements = self.plan.statements()
+        if len(statements) == 0:
+            print('  Shards already match their source tables.')
+            return
+
+        def alter(table, cursor):
+            if self.throttle is not None:
+                # Online mode: wait for a quiet moment, then use the cheapest algorithm MySQL accepts.
+                self.throttle.wait()
+            model, table_suffix = SHARD_CATALOG.model_for_table(table)
+            with measure(model, table_suffix, 'ddl'):
+                if self.throttle is None:
+                    self.run_sql(cursor, statements[table], raise_errors=True)
+                else:
+                    run_online(statements[table], lambda sql: self.run_sql(cursor, sql, raise_errors=True))
+            self.ledger.mark_done(run, table, self.ledger_operation)
+
+        self.for_each_shard(list(statements.keys()), 'alter', alter, db=db)
+        if self.throttle is not None and self.throttle.waited > 0:
+            print('  Throttled for %.1fs in total.' % self.throttle.waited)
+
     def rename_fields(self, db_table, old_field, new_field, db='default'):
-        cursor = connections[db].cursor()
-        tables = self.get_sharded_tables(cursor, db_table)
-
-        # Could not find the field name, it must be a foreign key.
-        rows = self.run_sql(cursor, """
-            SELECT COLUMN_TYPE, COLUMN_NAME FROM INFORMATION_SCHEMA.COLUMNS 
-            WHERE TABLE_NAME = '%s' AND COLUMN_NAME = '%s';""" % (db_table, new_field))
-        if len(rows) > 0:
-            column_type = rows[0][0]
+        tables = self.get_sharded_tables(None, db_table, db=db)
+        snapshot = self.get_snapshot(db, [db_table] + tables)
+
+        source = snapshot.column(db_table, new_field)
+        if source is not None:
+            column_type = source['type']
             for table in tables:
-                rows = self.run_sql(cursor, 'ALTER TABLE %s CHANGE %s %s %s;' % (
-                    table, old_field, new_field, column_type))
+                if snapshot.column(table, old_field) is None:
+                    # Already renamed.
+                    continue
+                self.plan.change_column(table, old_field, new_field, column_type)
+                snapshot.rename_column(table, old_field, new_field, column_type)
 
     def copy_table_changes(self, db_table, field_name, default_value, max_length, fk_table, fk_pk, db='default'):
         """
-        Copy all changes from the source db table on field that has changed.
+        Plan all changes from the source db table on field that has changed.
         This will also call compare_indexes().
         """
         # Get all tables that need to be altered
-        cursor = connections[db].cursor()
-
-        tables = self.get_sharded_tables(cursor, db_table)
+        tables = self.get_sharded_tables(None, db_table, db=db)
 
         if len(tables) == 0:
             print('No sharded tables for %s.' % db_table)
             return
 
-        created = False
-        dropped = False
-        foreign_key = False
-
         # Get info on field that was altered. If it was dropped, we drop the column from all other tables.
-        try:
-            rows = self.run_sql(cursor, """
-                SELECT COLUMN_NAME,COLUMN_TYPE,IS_NULLABLE FROM INFORMATION_SCHEMA.COLUMNS 
-                WHERE TABLE_NAME = '%s' AND COLUMN_NAME = '%s';""" % (db_table, field_name))
-            if len(rows) == 0:
-                # Could not find the field name, it must be a foreign key.
-                rows = self.run_sql(cursor, """
-                    SELECT COLUMN_NAME,COLUMN_TYPE,IS_NULLABLE FROM INFORMATION_SCHEMA.COLUMNS 
-                    WHERE TABLE_NAME = '%s' AND COLUMN_NAME = '%s_id';""" % (db_table, field_name))
-                if len(rows) > 0:
-                    field_name = '%s_id' % field_name
-                    foreign_key = True
-
-            if len(rows) > 0:
-                column_name = rows[0][0]
-                data_type = rows[0][1]
-                nullable = rows[0][2]
-
-                # Fix: (1681, 'Integer display width is deprecated and will be removed in a future release.')
-                # if 'int(' in data_type and data_type[:3] == 'int':
-                #     pattern = re.compile(r'[\d\(\)]+')
-                #     data_type = pattern.sub('', data_type)
-
-                if nullable == 'YES':
-                    for table in tables:
-                        # check to make sure column doesn't already exist.
-                        rows = self.run_sql(cursor, '''
-                            SELECT * FROM INFORMATION_SCHEMA.COLUMNS 
-                            WHERE TABLE_NAME = "%s" AND COLUMN_NAME="%s";''' % (table, field_name))
-                        if len(rows) == 0:
-                            rows = self.run_sql(cursor, 'ALTER TABLE %s ADD COLUMN %s %s;' % (
-                                table, column_name, data_type))
-                            created = True
-                else:
-                    if default_value is True:
-                        for table in tables:
-                            rows = self.run_sql(cursor, '''
-                                SELECT * FROM INFORMATION_SCHEMA.COLUMNS 
-                                WHERE TABLE_NAME = "%s" AND COLUMN_NAME="%s";''' % (table, field_name))
-                            if len(rows) == 0:
-                                rows = self.run_sql(cursor, 'ALTER TABLE %s ADD COLUMN %s %s DEFAULT "1";' % (
-                                    table, column_name, data_type))
-                                created = True
-                    elif default_value is False:
-                        for table in tables:
-                            rows = self.run_sql(cursor, '''
-                                SELECT * FROM INFORMATION_SCHEMA.COLUMNS 
-                                WHERE TABLE_NAME = "%s" AND COLUMN_NAME="%s";''' % (table, field_name))
-                            if len(rows) == 0:
-                                rows = self.run_sql(cursor, 'ALTER TABLE %s ADD COLUMN %s %s DEFAULT "0";' % (
-                                    table, column_name, data_type))
-                                created = True
-                    else:
-                        for table in tables:
-                            rows = self.run_sql(cursor, '''
-                                SELECT * FROM INFORMATION_SCHEMA.COLUMNS 
-                                WHERE TABLE_NAME = "%s" AND COLUMN_NAME="%s";''' % (table, field_name))
-                            if len(rows) == 0:
-                                if 'datetime' not in data_type and 'NOT_PROVIDED' not in str(default_value):
-                                    # if this is not a datetimefield, set the default value from
-                                    # migration operation.
-                                    rows = self.run_sql(cursor, 'ALTER TABLE %s ADD COLUMN %s %s DEFAULT "%s";' % (
-                                        table, column_name, data_type, default_value))
-                                else:
-                                    # Django will handle auto_add and auto_add_now. MySQL 5.6 does not allow
-                                    # setting default value.
-                                    rows = self.run_sql(cursor, 'ALTER TABLE %s ADD COLUMN %s %s;' % (
-                                        table, column_name, data_type))
-                                created = True
+        # If we can't find the field name, it must be a foreign key (<field>_id).
+        snapshot = self.get_snapshot(db, [db_table] + tables)
+        column_name, source = snapshot.find_column(db_table, field_name)
+        foreign_key = column_name is not None and column_name != field_name
+
+        if source is not None:
+            field_name = column_name
+            data_type = source['type']
+
+            # Fix: (1681, 'Integer display width is deprecated and will be removed in a future release.')
+            # if 'int(' in data_type and data_type[:3] == 'int':
+            #     pattern = re.compile(r'[\d\(\)]+')
+            #     data_type = pattern.sub('', data_type)
+
+            if source['nullable']:
+                definition = data_type
+            elif default_value is True:
+                definition = '%s DEFAULT "1"' % data_type
+            elif default_value is False:
+                definition = '%s DEFAULT "0"' % data_type
+            elif 'datetime' not in data_type and 'NOT_PROVIDED' not in str(default_value):
+                # if this is not a datetimefield, set the default value from
+                # migration operation.
+                definition = '%s DEFAULT "%s"' % (data_type, default_value)
+            else:
+                # Django will handle auto_add and auto_add_now. MySQL 5.6 does not allow
+                # setting default value.
+                definition = data_type
+
+            for table in tables:
+                # check to make sure column doesn't already exist.
+                created = False
+                if snapshot.column(table, field_name) is None:
+                    self.plan.add_column(table, field_name, definition)
+                    snapshot.add_column(table, field_name, source)
+                    created = True
 
                 # We added a field to our databases, lets see if we added an index from the original mysql table.
-                self.compare_indexes(cursor, db_table, tables, field_name)
+                self.compare_indexes(db_table, [table], field_name, db=db)
 
-            else:
-                # Field has been dropped from original db, lets drop the field on all shards.
-                # Because column doesn't exist in source database, we must check field in both ways,
-                # on the first sharded table: field_name, and field_name_id
-                rows = self.run_sql(cursor, '''
-                    SELECT * FROM INFORMATION_SCHEMA.COLUMNS 
-                    WHERE TABLE_NAME = "%s" AND COLUMN_NAME="%s";''' % (tables[0], field_name))
-                if len(rows) == 0:
-                    rows = self.run_sql(cursor, '''
-                        SELECT * FROM INFORMATION_SCHEMA.COLUMNS 
-                        WHERE TABLE_NAME = "%s" AND COLUMN_NAME="%s_id";''' % (tables[0], field_name))
-                    if len(rows) > 0:
-                        field_name = '%s_id' % field_name
-                for table in tables:
-                    rows = self.run_sql(cursor, """
-                        SELECT CONSTRAINT_NAME FROM INFORMATION_SCHEMA.KEY_COLUMN_USAGE 
-                        WHERE COLUMN_NAME='%s' AND REFERENCED_TABLE_NAME IS NOT NULL AND TABLE_NAME='%s';""" % (
-                        field_name, table))
-                    if len(rows) > 0:
-                        constraint_name = rows[0][0]
-                        rows = self.run_sql(cursor, 'ALTER TABLE %s DROP FOREIGN KEY %s' % (table, constraint_name))
-                    rows = self.run_sql(cursor, 'ALTER TABLE %s DROP COLUMN %s;' % (table, field_name))
-                dropped = True
-        except:
-            print(traceback.format_exc())
+                if created is False:
+                    self.copy_column_definition(db_table, table, field_name, default_value, max_length, db=db)
 
-        # If we got a max_length in the migration operation, lets set it on the model.
-        if max_length is not None and created is False and dropped is False:
-            rows = self.run_sql(cursor, """
-                SELECT COLUMN_NAME,COLUMN_TYPE FROM INFORMATION_SCHEMA.COLUMNS 
-                WHERE TABLE_NAME = '%s' AND COLUMN_NAME = '%s';""" % (db_table, field_name))
-            if len(rows) > 0:
-                column_name = rows[0][0]
-                column_type = rows[0][1]
-                for table in tables:
-                    rows = self.run_sql(cursor, "ALTER TABLE %s MODIFY %s %s;" % (table, column_name, column_type))
+                # Handle foreign keys.
+                if foreign_key is True and fk_pk is not None:
+                    if len(snapshot.foreign_keys_on(table, field_name)) == 0:
+                        self.plan.add_foreign_key(table, field_name, fk_table, fk_pk)
+                        snapshot.add_foreign_key(table, '%s_%s_fk' % (table, field_name), field_name, fk_table, fk_pk)
 
-        # If we got a default value set, but that was the only change to the model, lets set the default value.
-        if default_value != '' and created is False and dropped is False:
-            rows = self.run_sql(cursor, """
-                SELECT COLUMN_NAME,COLUMN_TYPE FROM INFORMATION_SCHEMA.COLUMNS 
-                WHERE TABLE_NAME = '%s' AND COLUMN_NAME = '%s';""" % (db_table, field_name))
-            if len(rows) > 0:
-                column_name = rows[0][0]
-                column_type = rows[0][1]
-                for table in tables:
-                    if default_value is True:
-                        default_value = '1'
-                    elif default_value is False:
-                        default_value = '0'
-                    if default_value is not None:
-                        if 'datetime' not in column_type and 'NOT_PROVIDED' not in str(default_value):
-                            rows = self.run_sql(cursor, "ALTER TABLE %s ALTER %s SET DEFAULT '%s';" % (
-                                table, column_name, default_value))
-                    else:
-                        # default value is null.
-                        rows = self.run_sql(cursor, "ALTER TABLE %s MODIFY %s %s;" % (table, column_name, column_type))
-
-        # Handle foreign keys.
-        if foreign_key is True and dropped is False and fk_pk is not None:
+        else:
+            # Field has been dropped from original db, lets drop the field on all shards.
+            # Because column doesn't exist in source database, we must check field in both ways,
+            # on each sharded table: field_name, and field_name_id
             for table in tables:
-                rows = self.run_sql(cursor, """
-                    SELECT CONSTRAINT_NAME FROM INFORMATION_SCHEMA.KEY_COLUMN_USAGE 
-                    WHERE COLUMN_NAME='%s' AND REFERENCED_TABLE_NAME IS NOT NULL 
-                    AND TABLE_NAME='%s';""" % (field_name, table))
-                if len(rows) == 0:
-                    rows = self.run_sql(cursor, 'ALTER TABLE %s ADD FOREIGN KEY (%s) REFERENCES %s(%s);' % (
-                        table, field_name, fk_table, fk_pk))
-
-        # Close the connection when we are finished with entire process.
-        try:
-            cursor.close()
-        except:
-            print(traceback.format_exc())
+                column, definition = snapshot.find_column(table, field_name)
+                if column is None:
+                    # Already dropped.
+                    continue
+                for constraint_name in snapshot.foreign_keys_on(table, column):
+                    self.plan.drop_foreign_key(table, constraint_name)
+                    snapshot.drop_foreign_key(table, constraint_name)
+                self.plan.drop_column(table, column)
+                snapshot.drop_column(table, column)
+
+    def copy_column_definition(self, db_table, table, field_name, default_value, max_length, db='default'):
+        """
+        Copy the column type (max_length) and default value of an existing column from the source table.
+        Nothing is planned when the shard already matches the snapshot of the source.
+        """
+        snapshot = self.get_snapshot(db, [db_table, table])
+        source = snapshot.column(db_table, field_name)
+        shard = snapshot.column(table, field_name)
+        if source is None or shard is None:
+            return
+        column_type = source['type']
+
+        # If we got a max_length in the migration operation, lets set it on the model.
+        modify = max_length is not None and shard['type'] != column_type
+        default = shard['default']
 
-    def compare_indexes(self, cursor, db_table, tables, field_name):
+        # If we got a default value set, but that was the only change to the model, lets set the default value.
+        if default_value != '':
+            if default_value is True:
+                default_value = '1'
+            elif default_value is False:
+                default_value = '0'
+            if default_value is not None:
+                if 'datetime' not in column_type and 'NOT_PROVIDED' not in str(default_value) and \
+                        str(default).strip("'") != str(default_value):
+                    default = str(default_value)
+                    modify = True
+            elif default is not None:
+                # default value is null.
+                default = None
+                modify = True
+
+        if modify:
+            # MODIFY resets the default and ON UPDATE, so the ones we keep are part of the definition.
+            extra = shard.get('extra', '')
+            if default != shard['default']:
+                extra = re.sub('DEFAULT_GENERATED', '', extra, flags=re.IGNORECASE).strip()
+            changes = {'type': column_type, 'nullable': True, 'default': default, 'extra': extra}
+            self.plan.modify_column(table, field_name, column_definition(changes))
+            snapshot.modify_column(table, field_name, **changes)
+
+    def compare_indexes(self, db_table, tables, field_name, db='default'):
         """
-        Compare indexes on main table with that of the shards. If index does not exist, create it.
-        (We do not need to pass db parameter here, because we already have a cursor.)
+        Compare indexes on main table with that of the shards. If index does not exist, plan it.
+        Indexes are compared in the schema snapshot, so shards that already match are not altered.
         """
-        # First we get all indexes on our old db.
-        # SHOW INDEX FROM api_lead WHERE COLUMN_NAME="phone_number" AND KEY_NAME NOT LIKE '%_uniq';
-        rows = self.run_sql(cursor, '''
-            SHOW INDEX FROM %s 
-            WHERE COLUMN_NAME="%s" AND KEY_NAME NOT LIKE "%%_uniq";''' % (db_table, field_name))
-        if len(rows) > 0:
-            # unique field returned from original table.
-            unique_row = rows[0][1]
+        snapshot = self.get_snapshot(db, [db_table] + list(tables))
+        # First we get all indexes on the column of our old db (without unique together indexes).
+        source_indexes = snapshot.indexes_on(db_table, field_name)
+        if len(source_indexes) > 0:
+            unique = any(index['unique'] for index in source_indexes.values())
             for table in tables:
                 # Check to make sure the index doesn't already exist.
-                rows = self.run_sql(cursor, '''
-                    SHOW INDEX FROM %s WHERE COLUMN_NAME="%s" 
-                    AND KEY_NAME NOT LIKE "%%_uniq";''' % (table, field_name))
-                if len(rows) > 0:
-                    # we have an index to change.
-                    rows = self.run_sql(cursor, 'ALTER TABLE %s DROP INDEX %s' % (table, field_name))
-                # non unique so 1 is really no index.
-                if str(unique_row) == '1':
-                    rows = self.run_sql(cursor, 'ALTER TABLE %s ADD INDEX (%s);' % (table, field_name))
-                else:
-                    rows = self.run_sql(cursor, 'ALTER TABLE %s ADD UNIQUE (%s)' % (table, field_name))
-        elif len(rows) == 0:
+                shard_indexes = snapshot.indexes_on(table, field_name)
+                if any(index['unique'] == unique for index in shard_indexes.values()):
+                    continue
+                # we have an index to change.
+                for index_name in shard_indexes:
+                    self.plan.drop_index(table, index_name)
+                    snapshot.drop_index(table, index_name)
+                self.plan.add_index(table, field_name, [field_name], unique=unique)
+                snapshot.add_index(table, field_name, [field_name], unique=unique)
+        else:
             # Remove existing index, if we no longer have an index in table.
             for table in tables:
-                rows = self.run_sql(cursor, '''
-                    SHOW INDEX FROM %s WHERE COLUMN_NAME="%s" AND 
-                    KEY_NAME NOT LIKE "%%_uniq";''' % (table, field_name))
-                if len(rows) > 0:
-                    rows = self.run_sql(cursor, 'ALTER TABLE %s DROP INDEX %s' % (table, field_name))
+                for index_name in snapshot.indexes_on(table, field_name):
+                    self.plan.drop_index(table, index_name)
+                    snapshot.drop_index(table, index_name)
 
-    def remove_unique_together(self, db_table, db='default'):
+    def copy_unique_togethers(self, db_table, db='default'):
         """
-        Removes unique together for all unique together constraints and shards.
+        Make the unique together indexes of every shard match the source table: indexes the source
+        doesn't have (any more) are dropped, and missing ones are added as <columns>_uniq.
         """
-        cursor = connections[db].cursor()
-        tables = self.get_sharded_tables(cursor, db_table)
+        tables = self.get_sharded_tables(None, db_table, db=db)
+        snapshot = self.get_snapshot(db, [db_table] + tables)
+        source_indexes = snapshot.table(db_table)['indexes']
+        unique_togethers = [tuple(source_indexes[name]['columns'])
+                            for name in snapshot.unique_together_indexes(db_table)]
 
         for table in tables:
-            rows = self.run_sql(cursor, '''
-                SELECT CONSTRAINT_NAME FROM INFORMATION_SCHEMA.TABLE_CONSTRAINTS 
-                WHERE TABLE_NAME = "%s" AND CONSTRAINT_TYPE = "UNIQUE" AND CONSTRAINT_NAME LIKE "%%_uniq";''' % table)
-            if len(rows) > 0:
-                constraint_name = rows[0][0]
-                rows = self.run_sql(cursor, 'ALTER TABLE %s DROP INDEX %s' % (table, constraint_name))
-
-        # Close the connection
-        try:
-            cursor.close()
-        except:
-            print(traceback.format_exc())
-
-    def copy_unique_together(self, db_table, field_list, db='default'):
+            shard_indexes = snapshot.table(table)['indexes']
+            existing = set()
+            for constraint_name in snapshot.unique_together_indexes(table):
+                columns = tuple(shard_indexes[constraint_name]['columns'])
+                if columns in unique_togethers and columns not in existing:
+                    existing.add(columns)
+                    continue
+                self.plan.drop_index(table, constraint_name)
+                snapshot.drop_index(table, constraint_name)
+            for columns in unique_togethers:
+                if columns in existing:
+                    continue
+                # We add _uniq so it is not confused with other indexes like Django does.
+                index_name = '%s_uniq' % '_'.join(columns)
+                self.plan.add_index(table, index_name, list(columns), unique=True)
+                snapshot.add_index(table, index_name, list(columns), unique=True)
+
+    def get_sharded_tables(self, cursor, db_table, db='default'):
         """
-        Copies unique together constraint from source database table to all shards.
+        All shard tables of a source table, from the shard catalog (exact matches only).
+        Shards the ledger has as done for the current run are left out.
         """
-        cursor = connections[db].cursor()
-        index_name = '_'.join(field_list)
-        # We add _uniq so it is not confused with other indexes like Django does.
-        index_name = '%s_uniq' % index_name
-
-        tables = self.get_sharded_tables(cursor, db_table)
-
-        real_field_list = []
-        for field_name in field_list:
-            rows = self.run_sql(cursor, """
-                SELECT COLUMN_NAME,COLUMN_TYPE,IS_NULLABLE FROM INFORMATION_SCHEMA.COLUMNS 
-                WHERE TABLE_NAME = '%s' AND COLUMN_NAME = '%s';""" % (db_table, field_name))
-            real_field = field_name
-            if len(rows) == 0:
-                # Could not find the field name, it must be a foreign key.
-                rows = self.run_sql(cursor, """
-                    SELECT COLUMN_NAME,COLUMN_TYPE,IS_NULLABLE FROM INFORMATION_SCHEMA.COLUMNS 
-                    WHERE TABLE_NAME = '%s' AND COLUMN_NAME = '%s_id';""" % (db_table, field_name))
-                if len(rows) > 0:
-                    real_field = '%s_id' % field_name
-            else:
-                real_field = field_name
-            real_field_list.append(real_field)
-
-        field_names = ','.join(real_field_list)
-        for table in tables:
-            rows = self.run_sql(cursor, 'CREATE UNIQUE INDEX %s ON %s(%s);' % (index_name, table, field_names))
-
-        # Close the sql connection.
-        try:
-            cursor.close()
-        except:
-            print(traceback.format_exc())
-
-    def get_sharded_tables(self, cursor, db_table):
         tables = []
         try:
-            rows = self.run_sql(cursor, 'SHOW TABLES LIKE "%s%%"' % db_table)
-            if len(rows) > 0:
-                tables = [row[0] for row in rows if row[0] != db_table]
+            tables = SHARD_CATALOG.tables_for_source(db_table, db=db)
         except:
             print(traceback.format_exc())
-        return tables
+        skip_tables = getattr(self, 'skip_tables', set())
+        return [table for table in tables if table not in skip_tables]
 
-    def run_sql(self, cursor, sql):
+    def run_sql(self, cursor, sql, raise_errors=False):
         """
         Execute sql on a given cursor.
         (db does not need to be past, since we are using corresponding cursor.)
+        With raise_errors, failures are raised for the shard report instead of printed.
         """
         try:
             # For debugging.
@@ -455,6 +589,8 @@ class Command(MigrationCommand):
             rows = cursor.fetchall()
             return rows
         except:
+            if raise_errors:
+                raise
             print(traceback.format_exc())
         return []
 
@@ -0,0 +1,85 @@
+from django.apps import apps
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.module_loading import import_string
+from django_table_sharding.exceptions import ShardException
+from django_table_sharding.online import Throttle
+from django_table_sharding.resharding import Resharder
+
+
+'''
+
+    Split or rebalance a shard by moving its rows into other shards.
+
+    python manage.py reshard app.Person 3 --to 7 8 --chunk-size 2000 --max-threads-running 40 --delete
+
+    Rows are routed by primary key hash over the targets, by the model's shard router (--by-shard-key),
+    or by a function (--route path.to.function, called with the row dict and the primary key name).
+
+'''
+
+
+class Command(BaseCommand):
+    help = 'Move the rows of a shard into one or more target shards, in verified primary key chunks.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('model', help='Sharded model, as app_label.ModelName.')
+        parser.add_argument('source', help='Table suffix of the shard to split.')
+        parser.add_argument('--to', nargs='+', required=True, help='Table suffixes of the target shards.')
+        parser.add_argument(
+            '--route', default=None,
+            help='Dotted path of a function (row, pk_name) returning the target suffix of a row.')
+        parser.add_argument(
+            '--by-shard-key', action='store_true', help="Route rows with the model's shard_key and shard_router.")
+        parser.add_argument('--chunk-size', type=int, default=1000, help='Rows read and written per chunk.')
+        parser.add_argument('--sleep', type=float, default=0, help='Seconds to sleep between chunks.')
+        parser.add_argument(
+            '--max-threads-running', type=int, default=getattr(settings, 'SHARDING_THROTTLE_THREADS_RUNNING', None),
+            help='Wait between chunks while Threads_running is above this.')
+        parser.add_argument(
+            '--max-replica-lag', type=int, default=getattr(settings, 'SHARDING_THROTTLE_REPLICA_LAG', None),
+            help='Wait between chunks while a SHARDING_THROTTLE_REPLICAS database lags more seconds.')
+        parser.add_argument(
+            '--pause-file', default=getattr(settings, 'SHARDING_MIGRATE_PAUSE_FILE', None),
+            help='Wait between chunks while this file exists (SIGUSR1/SIGUSR2 also pause/resume).')
+        parser.add_argument(
+            '--delete', action='store_true', help='Delete the moved rows from the source shard afterwards.')
+        parser.add_argument('--database', default=None, help='Database of the source shard (default: placement).')
+
+    def handle(self, *args, **options):
+        try:
+            model = apps.get_model(options['model'])
+        except (LookupError, ValueError) as err:
+            raise CommandError(str(err))
+        if not hasattr(model.objects, 'shard_table'):
+            raise CommandError('%s is not a sharded model.' % options['model'])
+
+        route = None
+        if options['route']:
+            route = import_string(options['route'])
+        elif options['by_shard_key']:
+            def route(row, pk_name):
+                return model.objects.route_row(row)
+
+        resharder = Resharder(
+            model, options['source'], options['to'], route=route, chunk_size=max(1, options['chunk_size']),
+            sleep=options['sleep'], db=options['database'])
+        resharder.throttle = Throttle(
+            db=resharder.source_db, max_threads_running=options['max_threads_running'],
+            max_replica_lag=options['max_replica_lag'], pause_file=options['pause_file'])
+        resharder.throttle.install_signals()
+
+        print('Moving rows of %s from shard %s to %s...' % (
+            model.__name__, options['source'], ', '.join(resharder.targets)))
+        try:
+            report = resharder.run(delete=options['delete'])
+        except ShardException as err:
+            raise CommandError(str(err))
+
+        print('\n%s row(s) copied in %s chunk(s), %s kept, %s deleted in %ss.' % (
+            report['copied'], report['chunks'], report['kept'], report['deleted'], report['seconds']))
+        for target, rows in sorted(report['targets'].items()):
+            print('  %s: %s row(s)' % (model.objects.shard_table(target), rows))
+        if report['unverified'] > 0:
+            raise CommandError('%s moved row(s) changed since they were copied and were not deleted, run again.' % (
+                report['unverified']))
@@ -0,0 +1,138 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django_table_sharding.catalog import SHARD_CATALOG, sharded_models
+from django_table_sharding.online import run_online
+from django_table_sharding.placement import placement_databases
+from django_table_sharding.schema import AlterPlan, SchemaSnapshot
+from django_table_sharding.utils import parallel_map
+import copy
+import traceback
+
+
+'''
+
+    Schema drift check for shard tables.
+
+    Reads the schema of every source table and all of its shards in a few batched INFORMATION_SCHEMA
+    queries, fingerprints the normalized schemas, and groups shards by fingerprint. Shards that don't
+    match their source table are listed with the ALTER TABLE that repairs them, which --apply runs.
+
+    Exits with an error when drift is found and not repaired, so it can run on every deploy.
+
+'''
+
+
+class Command(BaseCommand):
+    help = 'Check that every shard table has the same schema as its source table.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--database', default='default',
+            help='Database with the source tables. Shards on every database in shard_placement are checked.')
+        parser.add_argument(
+            '--model', action='append', default=[],
+            help='Only check this model (app_label.ModelName), can be repeated.')
+        parser.add_argument(
+            '--apply', action='store_true', help='Run the repair plan of every drifted shard.')
+        parser.add_argument(
+            '--online', action='store_true', default=getattr(settings, 'SHARDING_MIGRATE_ONLINE', False),
+            help='Repair with ALGORITHM=INSTANT/INPLACE, LOCK=NONE where MySQL allows it.')
+        parser.add_argument(
+            '--shard-concurrency', type=int, default=getattr(settings, 'SHARDING_MIGRATE_CONCURRENCY', 1),
+            help='Number of shards to repair at the same time, each on its own connection.')
+
+    def handle(self, *args, **options):
+        db = options['database']
+        models = sharded_models()
+        if len(options['model']) > 0:
+            labels = set(label.lower() for label in options['model'])
+            models = [m for m in models if getattr(m, '_meta').label_lower in labels]
+
+        SHARD_CATALOG.invalidate()
+        source = SchemaSnapshot(db)
+        source.load([getattr(model, '_meta').db_table for model in models])
+
+        # Shards on every database are compared with the source tables of --database.
+        plans = dict()
+        checked = 0
+        drifted = 0
+        for node in placement_databases(models, db=db):
+            shards = dict()
+            for model in models:
+                shards[getattr(model, '_meta').db_table] = SHARD_CATALOG.tables(model, db=node)
+
+            snapshot = source if node == db else SchemaSnapshot(node)
+            if node != db:
+                for db_table in shards:
+                    snapshot.tables[db_table] = copy.deepcopy(source.table(db_table))
+            snapshot.load([table for tables in shards.values() for table in tables])
+
+            plan = AlterPlan()
+            for db_table, tables in sorted(shards.items()):
+                if len(tables) == 0:
+                    continue
+                checked += len(tables)
+                print('[%s] ' % node, end='')
+                for table in self.check_model(snapshot, db_table, tables):
+                    snapshot.repair(db_table, table, plan)
+
+            plans[node] = plan.statements()
+            for table, sql in plans[node].items():
+                print('  repair %s on %s: %s' % (table, node, sql))
+            drifted += len(plans[node])
+
+        print('\n%s shard(s) checked, %s drifted.' % (checked, drifted))
+        if drifted == 0:
+            return
+
+        if not options['apply']:
+            raise CommandError('%s shard(s) drifted from their source table, run with --apply to repair.' % drifted)
+
+        failures = []
+        for node, statements in plans.items():
+            failures.extend(self.apply(statements, node, options['online'], options['shard_concurrency']))
+        SHARD_CATALOG.invalidate()
+        if len(failures) > 0:
+            raise CommandError('%s shard repair(s) failed.' % len(failures))
+        print('Repaired %s shard(s).' % drifted)
+
+    @staticmethod
+    def check_model(snapshot, db_table, tables):
+        """
+        Print the shards of a source table grouped by fingerprint. Returns the drifted shards.
+        """
+        source = snapshot.fingerprint(db_table)
+        groups = dict()
+        for table in tables:
+            groups.setdefault(snapshot.fingerprint(table), []).append(table)
+
+        print('%s: %s shard(s), %s fingerprint(s)' % (db_table, len(tables), len(groups)))
+        drifted = []
+        for fingerprint, group in sorted(groups.items(), key=lambda item: (item[0] != source, -len(item[1]))):
+            if fingerprint == source:
+                print('  %s (source): %s shard(s)' % (fingerprint[:12], len(group)))
+                continue
+            print('  %s: %s shard(s): %s' % (fingerprint[:12], len(group), ', '.join(group[:20]) +
+                                             (', ...' if len(group) > 20 else '')))
+            drifted.extend(group)
+        return drifted
+
+    @staticmethod
+    def apply(statements, db, online, concurrency):
+        """
+        Run the repair statements. Returns [(table, error)] of the shards that failed.
+        """
+        def repair(table):
+            with connections[db].cursor() as cursor:
+                if online:
+                    run_online(statements[table], cursor.execute)
+                else:
+                    cursor.execute(statements[table])
+
+        failures = []
+        for table, result, err in parallel_map(repair, list(statements.keys()), max(1, concurrency or 1)):
+            if err is not None:
+                print('  %s: FAILED\n%s' % (table, ''.join(traceback.format_exception_only(type(err), err))))
+                failures.append((table, err))
+        return failures
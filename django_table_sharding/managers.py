@@ -1,165 +1,387 @@
+from django.conf import settings
 from django.db import connections
 from django.db import models
-from .utils import copy_model, chunks
-import random
-import datetime
+from .aio import asynchronous, run_sync
+from .exceptions import ShardException
+from .bulk import insert_rows, insert_sql, load_rows, row_converter, update_rows, upsert_rows
+from .catalog import SHARD_CATALOG
+from .metrics import METRICS, instrumented, measure
+from .placement import replica_reads, shard_database, shard_databases
+from .replicas import record_write
+from .provisioning import ensure_shard, preprovision
+from .querycache import QUERY_CACHE, cacheable, invalidate_shard, invalidating
+from .scatter import MultiShardQuerySet
+from .utils import ShardModelCache, parallel_map, run_in_background
+import logging
 import traceback
-import threading
-import multiprocessing
 
 
-class ShardException(Exception):
-    pass
+logger = logging.getLogger(__name__)
 
 
-THREAD_LOCK = threading.Lock()
-FORK_LOCK = multiprocessing.Lock()
+def error_summary(err):
+    """
+    'ExceptionType: message' of the error that failed a shard. A ShardException raised with the
+    traceback of another error is unwrapped to that error.
+    """
+    while isinstance(err, ShardException) and err.__context__ is not None:
+        err = err.__context__
+    return '%s: %s' % (type(err).__name__, err)
+
+
+# Shard model classes are built once per (model, suffix, db) and reused by every shard() call.
+SHARD_MODEL_CACHE = ShardModelCache(getattr(settings, 'SHARDING_MODEL_CACHE_SIZE', 1024))
+SHARD_MODEL_CACHE.on_lookup = METRICS.record_cache
 
 
 # Specific model manager to not only work with sharding, but also to work with migrations.
 class ShardManager(models.Manager):
 
-    def shard(self, table_suffix, db='default'):
+    def shard_table(self, table_suffix):
         """
-        Use a shard of the table and set it to the model.
-        Usage: Model.objects.shard(1).all()
+        Name of the sharded table for a suffix: <app_label>_<model>_<suffix>
         """
-        global THREAD_LOCK, FORK_LOCK
         meta = getattr(self.model, '_meta')
-        db_table = '%s_%s_%s' % (
-            str(meta.app_label),
-            str(self.model.__name__.lower()), table_suffix)
-        model_name = 'ShardedModel-%s' % random.randint(999999999, 9999999999999999)
-        with THREAD_LOCK and FORK_LOCK:
-            self.model = copy_model(
-                model_name,
-                self.model,
-                db_table,
-                options={'db_table': db_table, 'auto_created': False}
-            )
-        return super(ShardManager, self).using(db)
-
-    def create(self, table_suffix, db='default', **kwargs):
-        meta = getattr(self.model, '_meta')
-        db_table = '%s_%s_%s' % (
+        return '%s_%s_%s' % (
             str(meta.app_label),
             str(self.model.__name__.lower()), table_suffix)
 
-        delete_keys = []
-        for k, v in kwargs.items():
-            if isinstance(v, datetime.datetime):
-                kwargs[k] = v.strftime('%Y-%m-%d %H:%M:%S')
-            elif isinstance(v, datetime.date):
-                kwargs[k] = v.strftime('%Y-%m-%d')
-            elif isinstance(v, datetime.time):
-                kwargs[k] = v.strftime('%H:%M:%S')
-            elif isinstance(v, bool):
-                if v is True:
-                    kwargs[k] = 1
-                else:
-                    kwargs[k] = 0
-            elif v is None:
-                delete_keys.append(k)
-
-        for delete in delete_keys:
-            del kwargs[delete]
-
-        placeholders = ', '.join(['%s'] * len(kwargs.values()))
-        columns = ', '.join(kwargs.keys())
-        tuple_list = tuple(kwargs.values())
+    def route(self, value):
+        """
+        Table suffix for a shard key value, using the model's shard_router.
+        """
+        router = getattr(self.model, 'shard_router', None)
+        if router is None:
+            raise ShardException('%s does not define a shard_router.' % self.model.__name__)
+        try:
+            return router.route(value)
+        except (KeyError, TypeError, ValueError) as err:
+            raise ShardException('Could not route shard key %r: %s' % (value, err)) from err
+
+    def route_row(self, dict_fields):
+        """
+        Table suffix for a dict of field values, using the model's shard_key field.
+        """
+        shard_key = getattr(self.model, 'shard_key', None)
+        if shard_key is None:
+            raise ShardException('%s does not define a shard_key.' % self.model.__name__)
+        if shard_key not in dict_fields:
+            raise ShardException('Shard key "%s" missing from field values.' % shard_key)
+        return self.route(dict_fields[shard_key])
+
+    def shard_database(self, table_suffix, db=None):
+        """
+        Database alias holding a shard, from the model's shard_placement unless db is passed.
+        """
+        return shard_database(self.model, table_suffix, db=db)
+
+    def for_key(self, value, db=None):
+        """
+        Use the shard that the shard key value routes to.
+        Usage: Model.objects.for_key(tenant_id).all()
+        """
+        return self.shard(self.route(value), db=db)
+
+    def shard(self, table_suffix, db=None):
+        """
+        Return a QuerySet bound to the shard model of the table. The manager itself is never
+        modified, so concurrent shard() calls from different threads do not interfere.
+        Without db, reads may go to a replica and writes to the primary (see replicas.py).
+        Usage: Model.objects.shard(1).all()
+        """
+        return self._shard_queryset(cacheable(instrumented(self._queryset_class)), table_suffix, db)
+
+    def ashard(self, table_suffix, db=None):
+        """
+        shard() for async code: the QuerySet supports async for and the a* methods (acount(), afirst(), ...).
+        Building it doesn't touch the database, so it isn't awaited.
+        Usage: async for row in Model.objects.ashard(1).filter(age__gte=21): ...
+        """
+        return self._shard_queryset(asynchronous(cacheable(instrumented(self._queryset_class))), table_suffix, db)
+
+    def _shard_queryset(self, queryset_class, table_suffix, db=None):
+        using = db
+        db = self.shard_database(table_suffix, db)
+        db_table = self.shard_table(table_suffix)
+        shard_model = SHARD_MODEL_CACHE.get(self.model, table_suffix, db_table, db=db)
+        if using is None and not replica_reads(db):
+            using = db
+        return queryset_class(model=shard_model, using=using, hints=self._hints)
+
+    def shard_suffixes(self, db=None):
+        """
+        Suffixes of every shard: the router's suffixes, or the shard tables found in the databases
+        holding the model's shards.
+        """
+        router = getattr(self.model, 'shard_router', None)
+        if router is not None:
+            return router.suffixes()
+        databases = shard_databases(self.model, db=db)
+        if len(databases) == 1:
+            return SHARD_CATALOG.suffixes(self.model, db=databases[0])
+        return [suffix for alias in databases for suffix in SHARD_CATALOG.suffixes(self.model, db=alias)
+                if self.shard_database(suffix, db) == alias]
+
+    def across_shards(self, suffixes='all', db=None, workers=None):
+        """
+        Run the same query against several shards concurrently and combine the results.
+        'all' is resolved to the current shards when the query is evaluated, so it can be built in async code.
+        Usage: Model.objects.across_shards([1, 2, 3]).filter(age__gte=21).order_by('-age')[:10]
+        """
+        return MultiShardQuerySet(self, suffixes, db=db, workers=workers)
+
+    def iter_shards(self, suffixes='all', chunk_size=2000, db=None):
+        """
+        Stream every row of one or many shards in chunks, without loading a whole table into memory.
+        Usage: for person in Model.objects.iter_shards([1, 2], chunk_size=5000): ...
+        """
+        if suffixes != 'all' and not isinstance(suffixes, (list, tuple, set)):
+            suffixes = [suffixes]
+        return self.across_shards(suffixes, db=db).iterator(chunk_size=chunk_size)
+
+    def create(self, table_suffix=None, db=None, **kwargs):
+        """
+        Insert one row into a shard. Without a table_suffix the row is routed by its shard key.
+        """
+        if table_suffix is None:
+            table_suffix = self.route_row(kwargs)
+        db = self.shard_database(table_suffix, db)
+        db_table = self.shard_table(table_suffix)
+        record_write(self.model, table_suffix)
+
+        columns, values = row_converter(self.model, db).convert(kwargs)
+        prefix, row_sql = insert_sql(db_table, columns, True, db)
 
         try:
-            with connections[db].cursor() as cursor:
+            with connections[db].cursor() as cursor, invalidating(self.model, table_suffix), \
+                    measure(self.model, table_suffix, 'write') as m:
                 try:
-                    cursor.execute("INSERT IGNORE INTO %s ( %s ) VALUES ( %s )" % (
-                        db_table, columns, placeholders), tuple_list)
+                    cursor.execute(prefix + row_sql, values)
+                    m.rows = max(cursor.rowcount, 0)
                 except:
                     print(traceback.format_exc())
         except:
             raise ShardException(traceback.format_exc())
 
-    def bulk_create(self, table_suffix, list_of_dicts, batch_size=1, ignore_conflicts=False, db='default'):
-        if len(list_of_dicts) == 0:
+    def bulk_create(self, table_suffix=None, list_of_dicts=None, batch_size=None, ignore_conflicts=False,
+                    db=None):
+        """
+        Insert many rows into a shard with multi-row INSERT statements sized to max_allowed_packet.
+        batch_size optionally caps the rows per statement. The dicts passed in are not modified.
+        Without a table_suffix every row is routed by its shard key, and the rows are inserted one
+        shard at a time. Returns the number of rows inserted.
+        """
+        if not list_of_dicts:
             raise ShardException('List of dict field values not defined.')
 
-        meta = getattr(self.model, '_meta')
-        db_table = '%s_%s_%s' % (
-            str(meta.app_label),
-            str(self.model.__name__.lower()), table_suffix)
+        if table_suffix is None:
+            shard_rows = dict()
+            for dict_fields in list_of_dicts:
+                shard_rows.setdefault(self.route_row(dict_fields), []).append(dict_fields)
+            inserted = 0
+            for suffix, rows in shard_rows.items():
+                inserted += self.bulk_create(
+                    suffix, rows, batch_size=batch_size, ignore_conflicts=ignore_conflicts, db=db)
+            return inserted
+
+        db = self.shard_database(table_suffix, db)
+        db_table = self.shard_table(table_suffix)
+        record_write(self.model, table_suffix)
+        with invalidating(self.model, table_suffix), measure(self.model, table_suffix, 'write') as m:
+            m.rows = insert_rows(
+                self.model, db_table, list_of_dicts, batch_size=batch_size, ignore_conflicts=ignore_conflicts, db=db)
+        return m.rows
+
+    async def acreate(self, table_suffix=None, db=None, **kwargs):
+        """
+        create() for async code.
+        """
+        return await run_sync(self.create)(table_suffix, db=db, **kwargs)
 
+    async def abulk_create(self, table_suffix=None, list_of_dicts=None, batch_size=None, ignore_conflicts=False,
+                           db=None):
+        """
+        bulk_create() for async code. Returns the number of rows inserted.
+        """
+        return await run_sync(self.bulk_create)(
+            table_suffix, list_of_dicts, batch_size=batch_size, ignore_conflicts=ignore_conflicts, db=db)
+
+    def bulk_create_routed(self, list_of_dicts, key=None, create_missing=False, batch_size=None,
+                           ignore_conflicts=False, db=None, workers=None):
+        """
+        Split one mixed batch of rows across shards and insert every shard's rows concurrently,
+        each shard on its own connection. key is a callable returning a row's table suffix, or the
+        name of the field to route on; by default rows are routed by the model's shard_key.
+        With create_missing, shard tables that don't exist yet are created with ensure_shard().
+        A failing shard does not stop the others, failures are reported per shard with the error's
+        type and message (the traceback is logged):
+            {'inserted': 10, 'failed': 2, 'shards': {'1': {'rows': 10, 'inserted': 10, 'error': None}, ...}}
+        """
+        if key is None:
+            route = self.route_row
+        elif callable(key):
+            route = key
+        else:
+            def route(dict_fields):
+                return self.route(dict_fields[key])
+
+        shard_rows = dict()
         for dict_fields in list_of_dicts:
-            delete_keys = []
-            for k, v in dict_fields.items():
-                if isinstance(v, datetime.datetime):
-                    dict_fields[k] = v.strftime('%Y-%m-%d %H:%M:%S')
-                elif isinstance(v, datetime.date):
-                    dict_fields[k] = v.strftime('%Y-%m-%d')
-                elif isinstance(v, datetime.time):
-                    dict_fields[k] = v.strftime('%H:%M:%S')
-                elif isinstance(v, bool):
-                    if v is True:
-                        dict_fields[k] = 1
-                    else:
-                        dict_fields[k] = 0
-                elif v is None:
-                    delete_keys.append(k)
-            for delete in delete_keys:
-                del dict_fields[delete]
-
-        placeholders = ', '.join(['%s'] * len(list_of_dicts[0]))
-        columns = ', '.join(list_of_dicts[0].keys())
-
-        n_chunks = chunks(list_of_dicts, batch_size)
-        for chunk in n_chunks:
-            tuple_list = [tuple(d.values()) for d in chunk]
-            if ignore_conflicts is False:
-                with connections[db].cursor() as cursor:
-                    try:
-                        cursor.executemany("INSERT INTO %s ( %s ) VALUES ( %s )" % (
-                            db_table, columns, placeholders), tuple_list)
-                    except:
-                        raise ShardException(traceback.format_exc())
+            shard_rows.setdefault(str(route(dict_fields)), []).append(dict_fields)
+
+        def write(table_suffix):
+            if create_missing:
+                self.ensure_shard(table_suffix, db=db)
+            return self.bulk_create(
+                table_suffix, shard_rows[table_suffix], batch_size=batch_size, ignore_conflicts=ignore_conflicts,
+                db=db)
+
+        report = {'inserted': 0, 'failed': 0, 'shards': dict()}
+        for table_suffix, inserted, err in parallel_map(write, list(shard_rows.keys()), workers):
+            # Workers record their writes in a copy of this context, record them here too.
+            record_write(self.model, table_suffix)
+            rows = len(shard_rows[table_suffix])
+            if err is None:
+                report['inserted'] += inserted
             else:
-                with connections[db].cursor() as cursor:
-                    try:
-                        cursor.executemany("INSERT IGNORE INTO %s ( %s ) VALUES ( %s )" % (
-                            db_table, columns, placeholders), tuple_list)
-                    except:
-                        raise ShardException(traceback.format_exc())
+                report['failed'] += rows
+                logger.error('Could not insert %s rows into shard %s.', rows, table_suffix, exc_info=err)
+            report['shards'][table_suffix] = {
+                'rows': rows,
+                'inserted': inserted or 0,
+                'error': error_summary(err) if err is not None else None,
+            }
+        return report
 
-    def shard_exists(self, table_suffix, db='default'):
+    def bulk_upsert(self, table_suffix, list_of_dicts, update_fields=None, batch_size=None, db=None):
         """
-        Check if sharded table exists.
+        Insert rows into a shard, updating rows that already exist with INSERT ... ON DUPLICATE KEY UPDATE.
+        update_fields limits which fields are overwritten on existing rows (default every field set).
+        None values set NULL.
         """
-        meta = getattr(self.model, '_meta')
-        db_table = '%s_%s_%s' % (
-            str(meta.app_label),
-            str(self.model.__name__.lower()), table_suffix)
-        try:
-            with connections[db].cursor() as cursor:
-                cursor.execute('SHOW TABLES LIKE "%s%%"' % db_table)
-                rows = cursor.fetchall()
-                if len(rows) > 0:
-                    return True
-        except:
-            pass
-        return False
+        if not list_of_dicts:
+            raise ShardException('List of dict field values not defined.')
+        record_write(self.model, table_suffix)
+        with invalidating(self.model, table_suffix), measure(self.model, table_suffix, 'write') as m:
+            m.rows = upsert_rows(
+                self.model, self.shard_table(table_suffix), list_of_dicts, update_fields=update_fields,
+                batch_size=batch_size, db=self.shard_database(table_suffix, db))
+        return m.rows
+
+    def bulk_update(self, table_suffix, objs, fields, batch_size=None, db=None):
+        """
+        Update fields of many rows in a shard with batched CASE updates, by primary key.
+        objs can be model instances or dicts with the primary key and field values.
+        """
+        if not objs:
+            return 0
+        record_write(self.model, table_suffix)
+        with invalidating(self.model, table_suffix), measure(self.model, table_suffix, 'write') as m:
+            m.rows = update_rows(self.model, self.shard_table(table_suffix), objs, fields, batch_size=batch_size,
+                                 db=self.shard_database(table_suffix, db))
+        return m.rows
+
+    def bulk_load(self, table_suffix, source, columns=None, chunk_size=10000, db=None):
+        """
+        Load a very large number of rows into a shard with LOAD DATA LOCAL INFILE, falling back to
+        chunked multi-row inserts when that is not permitted. source is an iterable of dicts or
+        sequences, or a CSV file with a header row. Reports rows, seconds, rows_per_second and warnings.
+        Requires 'local_infile': 1 in the database OPTIONS and local_infile enabled on the server.
+        """
+        record_write(self.model, table_suffix)
+        with invalidating(self.model, table_suffix), measure(self.model, table_suffix, 'write') as m:
+            report = load_rows(
+                self.model, self.shard_table(table_suffix), source, columns=columns, chunk_size=chunk_size,
+                db=self.shard_database(table_suffix, db))
+            m.rows = report['rows']
+        return report
+
+    def shard_exists(self, table_suffix, db=None):
+        """
+        Check if sharded table exists, using the shard catalog (no database round trip when cached).
+        """
+        return SHARD_CATALOG.exists(self.model, table_suffix, db=self.shard_database(table_suffix, db))
+
+    async def ashard_exists(self, table_suffix, db=None):
+        """
+        shard_exists() for async code.
+        """
+        return await run_sync(self.shard_exists)(table_suffix, db=db)
+
+    def ensure_shard(self, table_suffix, db=None):
+        """
+        Create the shard table if it doesn't exist yet. Concurrent callers in a process share one
+        creation, and processes coordinate with GET_LOCK. Returns True if the table was created.
+        """
+        return ensure_shard(self.model, table_suffix, db=db)
+
+    def preprovision_shards(self, count, db=None, background=False):
+        """
+        Create the next count shards ahead of demand, so first writes never wait on DDL.
+        With background=True this runs on its own thread and a Future of the created suffixes is returned.
+        """
+        if background:
+            return run_in_background(preprovision, self.model, count, db=db)
+        return preprovision(self.model, count, db=db)
+
+    @staticmethod
+    def shard_metrics():
+        """
+        Per-shard query counts, latency histograms, rows written and cache hits (see metrics.py).
+        """
+        return METRICS.snapshot()
+
+    @staticmethod
+    def shard_cache_stats():
+        """
+        Hit, miss and eviction counters of the shard model class cache.
+        """
+        return SHARD_MODEL_CACHE.stats()
+
+    def invalidate_shard_cache(self, table_suffix):
+        """
+        Make every cached query result of a shard stale, e.g. after writing to it with raw SQL.
+        """
+        invalidate_shard(self.model, table_suffix)
 
     @staticmethod
-    def copy_table(source_table, destination_table, db='default'):
+    def query_cache_stats():
+        """
+        Hit and miss counters of the shard query result cache (see querycache.py).
+        """
+        return QUERY_CACHE.stats()
+
+    @staticmethod
+    def copy_table(source_table, destination_table, db=None):
         """
         Copy original table to new sharded table. Keeps all indexes and unique together.
+        Without db, the table is created on the database its shard is placed on.
         """
+        model, table_suffix = SHARD_CATALOG.model_for_table(destination_table)
+        if db is None:
+            db = shard_database(model, table_suffix)
+        if model is not None:
+            record_write(model, table_suffix)
         try:
             with connections[db].cursor() as cursor:
                 cursor.execute('CREATE TABLE IF NOT EXISTS %s LIKE %s;' % (destination_table, source_table))
+            SHARD_CATALOG.add_table(destination_table, db=db)
         except:
-            pass
+            SHARD_CATALOG.invalidate(db)
+        if model is not None:
+            invalidate_shard(model, table_suffix)
 
 
 class ShardedModel(models.Model):
 
     objects = ShardManager()
 
+    # Optional routing: the field holding the shard key, and a router from django_table_sharding.routing.
+    shard_key = None
+    shard_router = None
+
+    # Optional placement: {table suffix: database alias}, or a callable(table_suffix) returning the alias.
+    shard_placement = None
+
     class Meta:
         abstract = True
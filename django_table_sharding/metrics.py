@@ -0,0 +1,273 @@
+from django.conf import settings
+from django.dispatch import Signal
+from functools import lru_cache
+import json
+import random
+import threading
+import time
+
+
+'''
+
+    Per-shard instrumentation.
+
+    For every model and table suffix: query counts and latency histograms of reads, writes and DDL,
+    rows written, and shard model class cache hits. Reads and writes are sampled at
+    SHARDING_METRICS_SAMPLE_RATE (default 0.1, 0 turns them off) and counted with weight 1 / rate, so
+    the hot path usually pays for one random() call. DDL is always recorded.
+
+    Every recorded operation is sent as the shard_operation signal. METRICS.snapshot() returns the
+    numbers as a dict, METRICS.prometheus() in the Prometheus text format, and METRICS.hot_shards()
+    the busiest shards.
+
+'''
+
+
+# Sent for every recorded (sampled) operation: model, table_suffix, kind ('read', 'write' or 'ddl'),
+# seconds and rows.
+shard_operation = Signal()
+
+# Latency histogram bucket upper bounds, in seconds.
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float('inf'))
+
+KINDS = ('read', 'write', 'ddl')
+
+
+def sample_rate():
+    return getattr(settings, 'SHARDING_METRICS_SAMPLE_RATE', 0.1)
+
+
+def model_label(model):
+    return getattr(model, '_meta').label_lower
+
+
+class Measure:
+    """
+    Times one shard operation when it is sampled. Set .rows inside the block for writes.
+        with measure(Person, 1, 'write') as m:
+            m.rows = insert_rows(...)
+    """
+    __slots__ = ('model', 'table_suffix', 'kind', 'weight', 'rows', 'started')
+
+    def __init__(self, model, table_suffix, kind, weight):
+        self.model = model
+        self.table_suffix = table_suffix
+        self.kind = kind
+        self.weight = weight
+        self.rows = 0
+        self.started = None
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        METRICS.record(self.model, self.table_suffix, self.kind, time.perf_counter() - self.started,
+                       rows=self.rows, weight=self.weight)
+        return False
+
+
+class _Unsampled:
+    """
+    Stand-in for operations that are not sampled; does nothing.
+    """
+    __slots__ = ('rows',)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        return False
+
+
+def measure(model, table_suffix, kind):
+    """
+    Context manager timing a shard operation, for a sample of calls. Nothing is recorded without a model.
+    """
+    if model is None:
+        return _Unsampled()
+    rate = sample_rate() if kind != 'ddl' else 1.0
+    if rate <= 0 or (rate < 1 and random.random() >= rate):
+        return _Unsampled()
+    return Measure(model, table_suffix, kind, 1.0 / rate)
+
+
+class ShardMetrics:
+    """
+    Counters and histograms keyed by (model label, table suffix).
+    """
+    def __init__(self):
+        self._shards = dict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def new_stats():
+        stats = dict((kind, {'count': 0.0, 'seconds': 0.0, 'buckets': [0.0] * len(BUCKETS)}) for kind in KINDS)
+        stats.update({'rows_written': 0.0, 'cache_hits': 0, 'cache_misses': 0})
+        return stats
+
+    def _stats(self, model, table_suffix):
+        key = (model_label(model), str(table_suffix))
+        stats = self._shards.get(key)
+        if stats is None:
+            stats = self._shards[key] = self.new_stats()
+        return stats
+
+    def record(self, model, table_suffix, kind, seconds, rows=0, weight=1.0):
+        with self._lock:
+            stats = self._stats(model, table_suffix)
+            kind_stats = stats[kind]
+            kind_stats['count'] += weight
+            kind_stats['seconds'] += seconds * weight
+            for i, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    kind_stats['buckets'][i] += weight
+                    break
+            if kind == 'write':
+                stats['rows_written'] += (rows or 0) * weight
+        shard_operation.send(
+            sender=self.__class__, model=model, table_suffix=str(table_suffix), kind=kind, seconds=seconds, rows=rows)
+
+    def record_cache(self, model, table_suffix, hit):
+        """
+        Hook for the shard model class cache. Counted exactly, it is a dict increment.
+        """
+        with self._lock:
+            stats = self._stats(model, table_suffix)
+            stats['cache_hits' if hit else 'cache_misses'] += 1
+
+    def reset(self):
+        with self._lock:
+            self._shards.clear()
+
+    def snapshot(self):
+        """
+        {'sample_rate': .., 'buckets': [..], 'shards': {'app.person:1': stats}}, with cumulative buckets.
+        """
+        with self._lock:
+            shards = dict()
+            for (label, table_suffix), stats in self._shards.items():
+                copied = dict(stats)
+                for kind in KINDS:
+                    buckets, total = [], 0.0
+                    for value in stats[kind]['buckets']:
+                        total += value
+                        buckets.append(round(total, 3))
+                    copied[kind] = {'count': round(stats[kind]['count'], 3),
+                                    'seconds': round(stats[kind]['seconds'], 6), 'buckets': buckets}
+                copied['rows_written'] = round(stats['rows_written'], 3)
+                shards['%s:%s' % (label, table_suffix)] = copied
+        return {'sample_rate': sample_rate(), 'buckets': [str(b) for b in BUCKETS], 'shards': shards}
+
+    def json(self):
+        return json.dumps(self.snapshot(), sort_keys=True)
+
+    def hot_shards(self, n=10, by='seconds', kinds=('read', 'write')):
+        """
+        The n busiest shards by total query 'seconds' or query 'count': [(shard, value), ...].
+        """
+        totals = []
+        for shard, stats in self.snapshot()['shards'].items():
+            totals.append((shard, round(sum(stats[kind][by] for kind in kinds), 6)))
+        totals.sort(key=lambda item: -item[1])
+        return totals[:n]
+
+    def report(self, n=10):
+        """
+        Printable top-n hot shard report.
+        """
+        lines = ['%-40s %12s %12s %14s' % ('shard', 'queries', 'seconds', 'rows written')]
+        shards = self.snapshot()['shards']
+        for shard, seconds in self.hot_shards(n):
+            stats = shards[shard]
+            lines.append('%-40s %12.0f %12.3f %14.0f' % (
+                shard, stats['read']['count'] + stats['write']['count'], seconds, stats['rows_written']))
+        return '\n'.join(lines)
+
+    def prometheus(self):
+        """
+        Every metric in the Prometheus text exposition format.
+        """
+        snapshot = self.snapshot()
+        lines = [
+            '# HELP sharding_queries_total Shard queries (estimated from samples).',
+            '# TYPE sharding_queries_total counter',
+        ]
+        histogram = [
+            '# HELP sharding_query_seconds Shard query latency.',
+            '# TYPE sharding_query_seconds histogram',
+        ]
+        rows = [
+            '# HELP sharding_rows_written_total Rows written to shards by bulk calls.',
+            '# TYPE sharding_rows_written_total counter',
+        ]
+        cache = [
+            '# HELP sharding_model_cache_total Shard model class cache lookups.',
+            '# TYPE sharding_model_cache_total counter',
+        ]
+        for shard, stats in sorted(snapshot['shards'].items()):
+            label, table_suffix = shard.split(':', 1)
+            labels = 'model="%s",suffix="%s"' % (label, table_suffix)
+            for kind in KINDS:
+                if stats[kind]['count'] == 0:
+                    continue
+                kind_labels = '%s,kind="%s"' % (labels, kind)
+                lines.append('sharding_queries_total{%s} %s' % (kind_labels, stats[kind]['count']))
+                for bound, value in zip(BUCKETS, stats[kind]['buckets']):
+                    histogram.append('sharding_query_seconds_bucket{%s,le="%s"} %s' % (
+                        kind_labels, '+Inf' if bound == float('inf') else bound, value))
+                histogram.append('sharding_query_seconds_sum{%s} %s' % (kind_labels, stats[kind]['seconds']))
+                histogram.append('sharding_query_seconds_count{%s} %s' % (kind_labels, stats[kind]['count']))
+            rows.append('sharding_rows_written_total{%s} %s' % (labels, stats['rows_written']))
+            cache.append('sharding_model_cache_total{%s,result="hit"} %s' % (labels, stats['cache_hits']))
+            cache.append('sharding_model_cache_total{%s,result="miss"} %s' % (labels, stats['cache_misses']))
+        return '\n'.join(lines + histogram + rows + cache) + '\n'
+
+
+METRICS = ShardMetrics()
+
+
+class InstrumentedQuerySetMixin:
+    """
+    Times reads and queryset writes of shard models (the classes shard() returns).
+    """
+    def _measure(self, kind):
+        source = getattr(self.model, '_shard_source', None)
+        if source is None:
+            return _Unsampled()
+        return measure(source, self.model._shard_suffix, kind)
+
+    def _fetch_all(self):
+        if self._result_cache is not None:
+            return super()._fetch_all()
+        with self._measure('read'):
+            return super()._fetch_all()
+
+    def count(self):
+        with self._measure('read'):
+            return super().count()
+
+    def exists(self):
+        with self._measure('read'):
+            return super().exists()
+
+    def aggregate(self, *args, **kwargs):
+        with self._measure('read'):
+            return super().aggregate(*args, **kwargs)
+
+    def update(self, **kwargs):
+        with self._measure('write') as m:
+            m.rows = super().update(**kwargs)
+            return m.rows
+
+    def delete(self):
+        with self._measure('write'):
+            return super().delete()
+
+
+@lru_cache(maxsize=None)
+def instrumented(queryset_class):
+    """
+    Subclass of a QuerySet class with InstrumentedQuerySetMixin, built once per class.
+    """
+    return type('Instrumented%s' % queryset_class.__name__, (InstrumentedQuerySetMixin, queryset_class), {})
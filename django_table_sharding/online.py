@@ -0,0 +1,169 @@
+from django.conf import settings
+from django.db import connections
+import os
+import signal
+import threading
+import time
+
+
+'''
+
+    Online DDL for shard migrations.
+
+    Shard ALTERs ask MySQL for the cheapest algorithm first (INSTANT, then INPLACE with LOCK=NONE),
+    and only fall back to a locking table copy when MySQL refuses. Between shards the migration waits
+    while the server is busy (Threads_running) or replicas are behind, and while it is paused with a
+    pause file or SIGUSR1 (SIGUSR2 resumes).
+
+'''
+
+
+# MySQL refuses an algorithm or lock level with these error codes:
+# 1800 unknown algorithm (INSTANT before MySQL 8.0), 1845/1846 operation not supported.
+REFUSED_ERRORS = (1800, 1845, 1846)
+
+# Cheapest first. The last entry runs the ALTER without hints.
+ALGORITHMS = (
+    'ALGORITHM=INSTANT',
+    'ALGORITHM=INPLACE, LOCK=NONE',
+    'ALGORITHM=COPY, LOCK=SHARED',
+    None,
+)
+
+
+def error_code(err):
+    """
+    MySQL error code of a database error (Django keeps the driver's args), or None.
+    """
+    args = getattr(err, 'args', ())
+    if len(args) > 0 and isinstance(args[0], int):
+        return args[0]
+    return None
+
+
+def online_statements(sql):
+    """
+    The ALTER TABLE statement with each algorithm hint, cheapest first.
+    """
+    sql = sql.strip().rstrip(';')
+    return ['%s, %s;' % (sql, hint) if hint is not None else '%s;' % sql for hint in ALGORITHMS]
+
+
+def run_online(sql, execute):
+    """
+    Run an ALTER TABLE with the cheapest algorithm MySQL accepts, calling execute(statement).
+    Returns the statement that succeeded.
+    """
+    statements = online_statements(sql)
+    for statement in statements[:-1]:
+        try:
+            execute(statement)
+            return statement
+        except Exception as err:
+            if error_code(err) not in REFUSED_ERRORS:
+                raise
+    execute(statements[-1])
+    return statements[-1]
+
+
+def threads_running(db='default'):
+    """
+    Threads_running of the server behind a database alias.
+    """
+    with connections[db].cursor() as cursor:
+        cursor.execute("SHOW GLOBAL STATUS LIKE 'Threads_running'")
+        row = cursor.fetchone()
+    return int(row[1]) if row is not None else 0
+
+
+def replica_lag(db):
+    """
+    Seconds a replica is behind its source, None if it isn't replicating.
+    """
+    with connections[db].cursor() as cursor:
+        try:
+            cursor.execute('SHOW REPLICA STATUS')
+        except Exception:
+            # Before MySQL 8.0.22.
+            cursor.execute('SHOW SLAVE STATUS')
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        status = dict(zip([column[0] for column in cursor.description], row))
+    lag = status.get('Seconds_Behind_Source', status.get('Seconds_Behind_Master'))
+    return int(lag) if lag is not None else None
+
+
+class Throttle:
+    """
+    Waits between shards until the database is quiet enough and the migration isn't paused.
+    A limit of None turns that check off.
+    """
+    def __init__(self, db='default', max_threads_running=None, max_replica_lag=None, replicas=None,
+                 pause_file=None, interval=None):
+        self.db = db
+        self.max_threads_running = max_threads_running
+        self.max_replica_lag = max_replica_lag
+        self.replicas = list(replicas) if replicas is not None else \
+            list(getattr(settings, 'SHARDING_THROTTLE_REPLICAS', []))
+        self.pause_file = pause_file
+        self.interval = interval if interval is not None else getattr(settings, 'SHARDING_THROTTLE_INTERVAL', 1.0)
+        self.paused = threading.Event()
+        self.waited = 0.0
+        self._lock = threading.Lock()
+
+    def install_signals(self):
+        """
+        SIGUSR1 pauses and SIGUSR2 resumes the migration. Only possible from the main thread.
+        """
+        if threading.current_thread() is not threading.main_thread() or not hasattr(signal, 'SIGUSR1'):
+            return False
+        signal.signal(signal.SIGUSR1, lambda signum, frame: self.paused.set())
+        signal.signal(signal.SIGUSR2, lambda signum, frame: self.paused.clear())
+        return True
+
+    def threads_running(self):
+        return threads_running(self.db)
+
+    @staticmethod
+    def replica_lag(db):
+        return replica_lag(db)
+
+    def reason(self):
+        """
+        Why the migration should wait right now, or None.
+        """
+        if self.paused.is_set():
+            return 'paused by signal'
+        if self.pause_file and os.path.exists(self.pause_file):
+            return 'paused by %s' % self.pause_file
+        if self.max_threads_running is not None:
+            running = self.threads_running()
+            if running > self.max_threads_running:
+                return 'Threads_running %s > %s' % (running, self.max_threads_running)
+        if self.max_replica_lag is not None:
+            for replica in self.replicas:
+                lag = self.replica_lag(replica)
+                if lag is not None and lag > self.max_replica_lag:
+                    return 'replica %s is %ss behind' % (replica, lag)
+        return None
+
+    def wait(self):
+        """
+        Block until no throttle condition holds. Returns the seconds waited.
+        """
+        with self._lock:
+            started = time.time()
+            last_reason = None
+            reason = self.reason()
+            while reason is not None:
+                if reason != last_reason:
+                    print('  throttled: %s' % reason)
+                    last_reason = reason
+                time.sleep(self.interval)
+                reason = self.reason()
+            if last_reason is not None:
+                print('  resumed after %.1fs' % (time.time() - started))
+            waited = time.time() - started
+            self.waited += waited
+            return waited
@@ -0,0 +1,100 @@
+from django.conf import settings
+from django.db import router
+from .replicas import REPLICA_SELECTOR, record_write, replica_aliases
+
+
+'''
+
+    Shard placement: which database alias holds each shard of a model.
+
+    A sharded model can set shard_placement to
+        - a dict of table suffix -> database alias (suffixes not in the dict stay on the default database),
+        - a callable taking the table suffix and returning a database alias.
+
+    Every ShardManager method resolves the database of a shard through placement when db is not passed,
+    and migrate applies shard changes on every database that holds shards. Reads can go to replicas of
+    the shard's database, see django_table_sharding.replicas.
+
+'''
+
+
+def default_database():
+    return getattr(settings, 'SHARDING_DEFAULT_DATABASE', 'default')
+
+
+def shard_database(model, table_suffix, db=None):
+    """
+    Database alias of a model's shard. An explicit db always wins.
+    """
+    if db is not None:
+        return db
+    placement = getattr(model, 'shard_placement', None)
+    if placement is None:
+        return default_database()
+    if callable(placement):
+        return placement(str(table_suffix)) or default_database()
+    return placement.get(str(table_suffix), placement.get(table_suffix, default_database()))
+
+
+def shard_databases(model, db=None):
+    """
+    Every database alias that can hold shards of a model.
+    Computed placements are evaluated for the router's suffixes, or cover every configured database
+    that isn't a replica (DDL must only run on primaries, replicas get it through replication).
+    """
+    if db is not None:
+        return [db]
+    placement = getattr(model, 'shard_placement', None)
+    if placement is None:
+        return [default_database()]
+    if callable(placement):
+        router = getattr(model, 'shard_router', None)
+        if router is None:
+            replicas = replica_aliases()
+            return [alias for alias in settings.DATABASES if alias not in replicas]
+        aliases = [shard_database(model, suffix) for suffix in router.suffixes()]
+    else:
+        aliases = list(placement.values())
+    return list(dict.fromkeys([default_database()] + aliases))
+
+
+def placement_databases(models, db=None):
+    """
+    Every database alias holding shards of any of the models, the default database first.
+    """
+    aliases = [db or default_database()]
+    for model in models:
+        aliases.extend(shard_databases(model))
+    return list(dict.fromkeys(aliases))
+
+
+class ShardPlacementRouter:
+    """
+    Database router for shard models (the classes shard() returns). Writes, e.g. instance.save(), go to
+    the database the shard is placed on; reads go to one of its replicas when SHARDING_REPLICAS lists any
+    (see django_table_sharding.replicas). Add 'django_table_sharding.placement.ShardPlacementRouter'
+    to DATABASE_ROUTERS.
+    """
+    @staticmethod
+    def db_for_read(model, **hints):
+        primary = getattr(model, '_shard_db', None)
+        if primary is None:
+            return None
+        return REPLICA_SELECTOR.read_database(model._shard_source, model._shard_suffix, primary)
+
+    @staticmethod
+    def db_for_write(model, **hints):
+        primary = getattr(model, '_shard_db', None)
+        if primary is not None:
+            record_write(model._shard_source, model._shard_suffix)
+        return primary
+
+
+def replica_reads(primary):
+    """
+    True if reads of shards on a primary are routed to replicas: it has replicas, and
+    ShardPlacementRouter is installed to send writes back to the primary.
+    """
+    if len(REPLICA_SELECTOR.replicas(primary)) == 0:
+        return False
+    return any(isinstance(r, ShardPlacementRouter) for r in router.routers)
@@ -0,0 +1,137 @@
+from concurrent.futures import Future
+from django.conf import settings
+from django.db import connections
+from .catalog import SHARD_CATALOG
+from .exceptions import ShardException
+from .placement import shard_database, shard_databases
+import hashlib
+import threading
+import traceback
+
+
+'''
+
+    Lazy shard provisioning.
+
+    ensure_shard() creates a shard table the first time it is needed:
+        - callers in the same process wait on one in-flight creation instead of each running DDL,
+        - processes coordinate through MySQL GET_LOCK, so only one of them runs CREATE TABLE,
+        - existing shards are answered from the shard catalog without a database round trip.
+
+'''
+
+
+_INFLIGHT = dict()
+_INFLIGHT_LOCK = threading.Lock()
+
+
+def lock_name(db_table):
+    """
+    GET_LOCK name for a shard table (MySQL lock names are limited to 64 characters).
+    """
+    name = 'shard:%s' % db_table
+    if len(name) > 64:
+        name = 'shard:%s' % hashlib.md5(db_table.encode('utf-8')).hexdigest()
+    return name
+
+
+def table_exists(cursor, connection, db_table):
+    """
+    Exact check against the database, bypassing the catalog.
+    """
+    if connection.vendor == 'mysql':
+        cursor.execute(
+            'SELECT 1 FROM INFORMATION_SCHEMA.TABLES WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s',
+            [db_table])
+        return cursor.fetchone() is not None
+    return db_table in connection.introspection.table_names(cursor)
+
+
+def create_shard_table(source_table, db_table, db='default'):
+    """
+    Create db_table like source_table while holding a cross-process lock on its name.
+    Returns True if this call created the table.
+    """
+    connection = connections[db]
+    timeout = getattr(settings, 'SHARDING_PROVISION_LOCK_TIMEOUT', 30)
+    created = False
+    try:
+        with connection.cursor() as cursor:
+            locked = False
+            if connection.vendor == 'mysql':
+                cursor.execute('SELECT GET_LOCK(%s, %s)', [lock_name(db_table), timeout])
+                if cursor.fetchone()[0] != 1:
+                    raise ShardException('Timed out waiting for the provisioning lock of %s.' % db_table)
+                locked = True
+            try:
+                if not table_exists(cursor, connection, db_table):
+                    cursor.execute('CREATE TABLE IF NOT EXISTS %s LIKE %s;' % (db_table, source_table))
+                    created = True
+            finally:
+                if locked:
+                    cursor.execute('SELECT RELEASE_LOCK(%s)', [lock_name(db_table)])
+    except ShardException:
+        raise
+    except Exception:
+        raise ShardException(traceback.format_exc())
+    SHARD_CATALOG.add_table(db_table, db=db)
+    return created
+
+
+def ensure_shard(model, table_suffix, db=None):
+    """
+    Make sure the shard table of a model exists, creating it at most once across concurrent callers.
+    Returns True if the table was created by this call or by a concurrent caller it waited for.
+    Without db, the table is created on the database its shard is placed on.
+    """
+    db = shard_database(model, table_suffix, db=db)
+    if SHARD_CATALOG.exists(model, table_suffix, db=db):
+        return False
+
+    db_table = model.objects.shard_table(table_suffix)
+    key = (db_table, db)
+    with _INFLIGHT_LOCK:
+        future = _INFLIGHT.get(key)
+        owner = future is None
+        if owner:
+            future = Future()
+            _INFLIGHT[key] = future
+    if not owner:
+        return future.result()
+
+    try:
+        created = create_shard_table(getattr(model, '_meta').db_table, db_table, db=db)
+        future.set_result(created)
+        return created
+    except Exception as err:
+        future.set_exception(err)
+        raise
+    finally:
+        with _INFLIGHT_LOCK:
+            _INFLIGHT.pop(key, None)
+
+
+def next_suffixes(model, count, db=None):
+    """
+    The next count shard suffixes that don't exist yet: the router's missing suffixes, or the
+    numbers after the highest numeric suffix, across every database holding the model's shards.
+    """
+    existing = [suffix for alias in shard_databases(model, db=db) for suffix in SHARD_CATALOG.suffixes(model, db=alias)]
+    router = getattr(model, 'shard_router', None)
+    if router is not None:
+        existing = set(existing)
+        return [suffix for suffix in router.suffixes() if suffix not in existing][:count]
+    numbers = [int(suffix) for suffix in existing if suffix.isdigit()]
+    start = max(numbers) + 1 if len(numbers) > 0 else 1
+    return [str(n) for n in range(start, start + count)]
+
+
+def preprovision(model, count, db=None):
+    """
+    Create the next count shards ahead of demand. Returns the suffixes created.
+    """
+    created = []
+    for suffix in next_suffixes(model, count, db=db):
+        if ensure_shard(model, suffix, db=db):
+            created.append(suffix)
+    return created
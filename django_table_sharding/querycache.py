@@ -0,0 +1,323 @@
+from django.conf import settings
+from django.core.cache import caches
+from django.core.exceptions import EmptyResultSet
+from django.db.models.query import FlatValuesListIterable, ModelIterable, ValuesIterable, ValuesListIterable
+from django.db.models.base import ModelState
+from django.db.models.signals import post_delete, post_save
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import lru_cache
+import hashlib
+import logging
+import random
+import re
+import threading
+import time
+
+
+'''
+
+    Shard-scoped query result cache.
+
+    Enable the cache with SHARDING_QUERY_CACHE_ENABLED = True, then opt in per QuerySet with cached():
+
+        Person.objects.shard(5).filter(team_id=3).cached()          # SHARDING_QUERY_CACHE_TIMEOUT seconds
+        Person.objects.shard(5).filter(team_id=3).cached(timeout=10)
+
+    Results are stored in an in-process LRU (SHARDING_QUERY_CACHE_SIZE entries, default 1000) and in the
+    Django cache named by SHARDING_QUERY_CACHE (default 'default', None for in-process only), keyed by
+    model, suffix, normalized SQL and params. Every entry is tagged with its shard's generation, and
+    every write to a shard (manager writes, save(), delete(), QuerySet update() and delete(), copy_table
+    and resharding) bumps that shard's generation, so only that shard's entries go stale.
+
+    Generations live in the Django cache, so writes in one process invalidate the entries of every
+    process; each process re-reads a shard's generation at most every SHARDING_QUERY_CACHE_CHECK_INTERVAL
+    seconds (default 1). Writes that bypass this package (raw SQL, other applications) are not seen:
+    call ShardManager.invalidate_shard_cache() after them.
+
+    While the cache is disabled (the default), cached() queries run uncached and writes don't touch the
+    cache at all. Cache errors while invalidating are logged, they never fail the write.
+
+'''
+
+
+logger = logging.getLogger(__name__)
+
+
+CACHEABLE_ITERABLES = (ModelIterable, ValuesIterable, ValuesListIterable, FlatValuesListIterable)
+
+
+def enabled():
+    return getattr(settings, 'SHARDING_QUERY_CACHE_ENABLED', False)
+
+
+def default_timeout():
+    return getattr(settings, 'SHARDING_QUERY_CACHE_TIMEOUT', 60)
+
+
+def shard_label(model, table_suffix):
+    return '%s:%s' % (getattr(model, '_meta').label_lower, table_suffix)
+
+
+def normalize_sql(sql):
+    return re.sub(r'\s+', ' ', sql).strip()
+
+
+class ShardQueryCache:
+    """
+    Two tier result cache with per-shard generations.
+    """
+    def __init__(self):
+        self.hits = 0
+        self.local_hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._generations = dict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def shared():
+        """
+        The Django cache backing the shared tier, or None.
+        """
+        alias = getattr(settings, 'SHARDING_QUERY_CACHE', 'default')
+        if alias is None:
+            return None
+        return caches[alias]
+
+    @staticmethod
+    def generation_key(shard):
+        return 'sharding:generation:%s' % shard
+
+    def generation(self, shard):
+        """
+        Current generation of a shard, re-read from the shared cache every check interval.
+        A missing generation starts at a random value, so entries tagged before the shared cache
+        lost it never match again.
+        """
+        interval = getattr(settings, 'SHARDING_QUERY_CACHE_CHECK_INTERVAL', 1)
+        with self._lock:
+            known = self._generations.get(shard)
+        if known is not None and time.time() - known[1] < interval:
+            return known[0]
+        shared = self.shared()
+        if shared is None:
+            generation = known[0] if known is not None else 0
+        else:
+            key = self.generation_key(shard)
+            generation = shared.get(key)
+            if generation is None:
+                shared.add(key, random.randint(1, 2 ** 31), None)
+                generation = shared.get(key, 0)
+        with self._lock:
+            self._generations[shard] = (generation, time.time())
+        return generation
+
+    def invalidate(self, model, table_suffix):
+        """
+        Bump the generation of a shard: every cached result of it goes stale.
+        Does nothing while the cache is disabled. If the shared cache fails, the error is logged and
+        only this process's generation is bumped.
+        """
+        if not enabled():
+            return
+        shard = shard_label(model, table_suffix)
+        generation = None
+        try:
+            shared = self.shared()
+            if shared is not None:
+                key = self.generation_key(shard)
+                try:
+                    generation = shared.incr(key)
+                except ValueError:
+                    # Not in the cache (yet, or any more): start over at a random generation.
+                    generation = random.randint(1, 2 ** 31)
+                    shared.set(key, generation, None)
+        except Exception:
+            logger.exception('Could not invalidate the cached results of shard %s.', shard)
+            generation = None
+        with self._lock:
+            if generation is None:
+                known = self._generations.get(shard)
+                generation = (known[0] if known is not None else 0) + 1
+            self._generations[shard] = (generation, time.time())
+
+    def get(self, shard, key):
+        """
+        (generation, rows) of a cached result; rows is None on a miss. The generation is the one to
+        tag the result with when it is stored after the query.
+        """
+        generation = self.generation(shard)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == generation and entry[1] > time.time():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                self.local_hits += 1
+                return generation, entry[2]
+        shared = self.shared()
+        value = shared.get(key) if shared is not None else None
+        if value is not None and value[0] == generation:
+            self._store_local(key, generation, value[1], value[2])
+            with self._lock:
+                self.hits += 1
+            return generation, value[2]
+        with self._lock:
+            self.misses += 1
+        return generation, None
+
+    def set(self, key, generation, rows, timeout):
+        expires = time.time() + timeout
+        self._store_local(key, generation, expires, rows)
+        shared = self.shared()
+        if shared is not None:
+            shared.set(key, (generation, expires, rows), timeout)
+
+    def _store_local(self, key, generation, expires, rows):
+        with self._lock:
+            self._entries[key] = (generation, expires, rows)
+            self._entries.move_to_end(key)
+            while len(self._entries) > getattr(settings, 'SHARDING_QUERY_CACHE_SIZE', 1000):
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        """
+        Drop the in-process tier. Shared entries expire or go stale with their generation.
+        """
+        with self._lock:
+            self._entries.clear()
+            self._generations.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'hits': self.hits,
+                'local_hits': self.local_hits,
+                'misses': self.misses,
+            }
+
+
+QUERY_CACHE = ShardQueryCache()
+
+
+def invalidate_shard(model, table_suffix):
+    QUERY_CACHE.invalidate(model, table_suffix)
+
+
+@contextmanager
+def invalidating(model, table_suffix):
+    """
+    Invalidate a shard's cached results after the writes in the block, also when they fail half way.
+    """
+    try:
+        yield
+    finally:
+        invalidate_shard(model, table_suffix)
+
+
+def invalidate_instance(sender, **kwargs):
+    """
+    post_save / post_delete receiver for shard model instances.
+    """
+    source = getattr(sender, '_shard_source', None)
+    if source is not None:
+        invalidate_shard(source, sender._shard_suffix)
+
+
+post_save.connect(invalidate_instance, dispatch_uid='django_table_sharding.querycache.save')
+post_delete.connect(invalidate_instance, dispatch_uid='django_table_sharding.querycache.delete')
+
+
+class CachedQuerySetMixin:
+    """
+    cached() for shard QuerySets, and shard invalidation on QuerySet update() and delete().
+    """
+    _shard_cache_timeout = None
+
+    def cached(self, timeout=None):
+        """
+        Serve this query's results from the shard query cache, for timeout seconds.
+        Without SHARDING_QUERY_CACHE_ENABLED the query runs uncached.
+        """
+        clone = self._chain()
+        clone._shard_cache_timeout = timeout if timeout is not None else default_timeout()
+        return clone
+
+    def _clone(self):
+        clone = super()._clone()
+        clone._shard_cache_timeout = self._shard_cache_timeout
+        return clone
+
+    def _shard_cache_key(self):
+        """
+        Cache key of the query, or None if it can't be cached (related objects, locking, named rows).
+        """
+        if self._iterable_class not in CACHEABLE_ITERABLES or self.query.select_related or \
+                self._prefetch_related_lookups or self.query.select_for_update:
+            return None
+        try:
+            sql, params = self.query.get_compiler(using=self.model._shard_db).as_sql()
+        except EmptyResultSet:
+            return None
+        digest = hashlib.sha1(('%s|%s|%r|%s' % (
+            self._iterable_class.__name__, self.model._shard_db, params, normalize_sql(sql))).encode('utf-8'))
+        return 'sharding:query:%s:%s' % (self._shard_label(), digest.hexdigest())
+
+    def _shard_label(self):
+        return shard_label(self.model._shard_source, self.model._shard_suffix)
+
+    def _dump_rows(self, rows):
+        """
+        Picklable copy of the results: shard model classes can't be pickled, so instances are
+        stored as their attribute dicts.
+        """
+        if self._iterable_class is ModelIterable:
+            return [dict((k, v) for k, v in obj.__dict__.items() if k != '_state') for obj in rows]
+        if self._iterable_class is ValuesIterable:
+            return [dict(row) for row in rows]
+        return list(rows)
+
+    def _load_rows(self, rows):
+        if self._iterable_class is ModelIterable:
+            objs = []
+            for attributes in rows:
+                obj = self.model.__new__(self.model)
+                obj.__dict__.update(attributes)
+                obj._state = ModelState()
+                obj._state.adding = False
+                obj._state.db = self.model._shard_db
+                objs.append(obj)
+            return objs
+        if self._iterable_class is ValuesIterable:
+            return [dict(row) for row in rows]
+        return list(rows)
+
+    def _fetch_all(self):
+        if self._result_cache is not None or self._shard_cache_timeout is None or not enabled():
+            return super()._fetch_all()
+        key = self._shard_cache_key()
+        if key is None:
+            return super()._fetch_all()
+        generation, rows = QUERY_CACHE.get(self._shard_label(), key)
+        if rows is not None:
+            self._result_cache = self._load_rows(rows)
+            return
+        super()._fetch_all()
+        QUERY_CACHE.set(key, generation, self._dump_rows(self._result_cache), self._shard_cache_timeout)
+
+    def update(self, **kwargs):
+        with invalidating(self.model._shard_source, self.model._shard_suffix):
+            return super().update(**kwargs)
+
+    def delete(self):
+        with invalidating(self.model._shard_source, self.model._shard_suffix):
+            return super().delete()
+
+
+@lru_cache(maxsize=None)
+def cacheable(queryset_class):
+    """
+    Subclass of a QuerySet class with CachedQuerySetMixin, built once per class.
+    """
+    return type('Cacheable%s' % queryset_class.__name__, (CachedQuerySetMixin, queryset_class), {})
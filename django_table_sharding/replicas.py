@@ -0,0 +1,169 @@
+from django.conf import settings
+from .online import replica_lag, threads_running
+import contextvars
+import random
+import threading
+import time
+
+
+'''
+
+    Replica reads for shards.
+
+    SHARDING_REPLICAS maps a primary database alias to its replicas, as aliases or with weights:
+
+        SHARDING_REPLICAS = {
+            'default': [{'alias': 'replica1', 'weight': 3}, 'replica2'],
+            'node2': ['node2_replica'],
+        }
+
+    With ShardPlacementRouter in DATABASE_ROUTERS, reads of a shard go to one of its primary's replicas
+    and writes go to the primary. Replicas are picked by weight or by the lowest sampled Threads_running
+    (SHARDING_REPLICA_SELECTION = 'weighted' or 'least_loaded'), skipping replicas lagging more than
+    SHARDING_REPLICA_MAX_LAG seconds. Lag and load are sampled at most every SHARDING_REPLICA_CHECK_INTERVAL
+    seconds per replica.
+
+    After a write to a shard, reads of that shard in the same thread or request go to the primary for
+    SHARDING_READ_YOUR_WRITES seconds (default 5). ReadYourWritesMiddleware scopes this to a request.
+
+'''
+
+
+_recent_writes = contextvars.ContextVar('shard_recent_writes', default=None)
+
+
+def replica_aliases():
+    """
+    Every database alias configured as a replica (SHARDING_REPLICAS and SHARDING_THROTTLE_REPLICAS).
+    """
+    aliases = set(getattr(settings, 'SHARDING_THROTTLE_REPLICAS', []))
+    for replicas in getattr(settings, 'SHARDING_REPLICAS', {}).values():
+        aliases.update(replica['alias'] if isinstance(replica, dict) else replica for replica in replicas)
+    return aliases
+
+
+def shard_key(model, table_suffix):
+    return getattr(model, '_meta').label_lower, str(table_suffix)
+
+
+def record_write(model, table_suffix):
+    """
+    Remember a write to a shard, so the next reads of it in this thread or request use the primary.
+    """
+    writes = _recent_writes.get()
+    if writes is None:
+        writes = dict()
+        _recent_writes.set(writes)
+    writes[shard_key(model, table_suffix)] = time.time()
+
+
+def recently_written(model, table_suffix):
+    writes = _recent_writes.get()
+    if not writes:
+        return False
+    written = writes.get(shard_key(model, table_suffix))
+    return written is not None and time.time() - written < getattr(settings, 'SHARDING_READ_YOUR_WRITES', 5)
+
+
+def reset_writes():
+    """
+    Start a new read-your-writes scope. Returns a token for restore_writes().
+    """
+    return _recent_writes.set(dict())
+
+
+def restore_writes(token):
+    _recent_writes.reset(token)
+
+
+class ReadYourWritesMiddleware:
+    """
+    Scopes the read-your-writes window to one request.
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        token = reset_writes()
+        try:
+            return self.get_response(request)
+        finally:
+            restore_writes(token)
+
+
+class ReplicaSelector:
+    """
+    Picks the database to read a shard from.
+    """
+    def __init__(self):
+        self._samples = dict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def replicas(primary):
+        """
+        [(alias, weight)] of the replicas of a primary alias.
+        """
+        replicas = []
+        for replica in getattr(settings, 'SHARDING_REPLICAS', {}).get(primary, []):
+            if isinstance(replica, dict):
+                replicas.append((replica['alias'], replica.get('weight', 1)))
+            else:
+                replicas.append((replica, 1))
+        return replicas
+
+    def sample(self, alias):
+        """
+        (lag, threads_running) of a replica, cached for SHARDING_REPLICA_CHECK_INTERVAL seconds.
+        A replica that can't be sampled has unknown lag and load (None, None).
+        """
+        interval = getattr(settings, 'SHARDING_REPLICA_CHECK_INTERVAL', 5)
+        with self._lock:
+            cached = self._samples.get(alias)
+        if cached is not None and time.time() - cached[0] < interval:
+            return cached[1]
+        try:
+            sample = (replica_lag(alias), threads_running(alias))
+        except Exception:
+            sample = (None, None)
+        with self._lock:
+            self._samples[alias] = (time.time(), sample)
+        return sample
+
+    def candidates(self, primary):
+        """
+        [(alias, weight, threads_running)] of the replicas that are within the lag threshold.
+        """
+        max_lag = getattr(settings, 'SHARDING_REPLICA_MAX_LAG', None)
+        least_loaded = getattr(settings, 'SHARDING_REPLICA_SELECTION', 'weighted') == 'least_loaded'
+        candidates = []
+        for alias, weight in self.replicas(primary):
+            if max_lag is None and not least_loaded:
+                candidates.append((alias, weight, None))
+                continue
+            lag, running = self.sample(alias)
+            if max_lag is not None and (lag is None or lag > max_lag):
+                continue
+            candidates.append((alias, weight, running))
+        return candidates
+
+    def read_database(self, model, table_suffix, primary):
+        """
+        Replica to read a shard from, or the primary when the shard was just written to, it has no
+        replicas, or every replica lags too much.
+        """
+        if recently_written(model, table_suffix):
+            return primary
+        candidates = self.candidates(primary)
+        if len(candidates) == 0:
+            return primary
+        if getattr(settings, 'SHARDING_REPLICA_SELECTION', 'weighted') == 'least_loaded':
+            return min(candidates, key=lambda c: (c[2] if c[2] is not None else float('inf'), -c[1]))[0]
+        return random.choices([c[0] for c in candidates], weights=[c[1] for c in candidates])[0]
+
+    def clear(self):
+        with self._lock:
+            self._samples.clear()
+
+
+REPLICA_SELECTOR = ReplicaSelector()
@@ -0,0 +1,252 @@
+from django.db import connections, transaction
+from .bulk import insert_rows, upsert_rows
+from .exceptions import ShardException
+from .ledger import ShardLedger
+from .querycache import invalidating
+from .routing import stable_hash
+import hashlib
+import time
+
+
+'''
+
+    Shard split / rebalance: move rows from one shard to one or more target shards.
+
+    Rows are read from the source shard in primary key order, one chunk at a time, and routed to a target
+    suffix. Rows missing from the target are inserted. A row the target already has is left alone when it
+    matches the source row, and is only overwritten when this reshard copied it on an earlier run (the
+    copied primary key ranges are recorded in the ledger), so a re-run picks up where it stopped and
+    refreshes rows that changed in the meantime. Any other existing row is a primary key collision and
+    stops the reshard: primary keys must be unique across the shards of a model.
+
+    Every chunk is verified by reading it back from the targets and comparing row counts and checksums.
+    Moved rows are only deleted from the source in a second pass that locks each batch, verifies it
+    again and deletes it in the same transaction.
+
+'''
+
+
+def modulo_route(targets):
+    """
+    Route rows over the targets by the hash of their primary key.
+    """
+    targets = [str(target) for target in targets]
+
+    def route(row, pk_name):
+        return targets[stable_hash(row[pk_name]) % len(targets)]
+    return route
+
+
+def row_checksum(rows, columns):
+    """
+    md5 of rows (dicts) over columns, independent of the order the rows were read in.
+    """
+    digest = hashlib.md5()
+    for line in sorted('\x1f'.join(str(row[column]) for column in columns) for row in rows):
+        digest.update(line.encode('utf-8'))
+        digest.update(b'\x1e')
+    return digest.hexdigest()
+
+
+class Resharder:
+    """
+    Moves the rows of one shard of a model into target shards.
+    route(row, pk_name) returns the target suffix of a row (a dict of field values); rows routed to
+    the source suffix stay where they are.
+    """
+    def __init__(self, model, source_suffix, targets, route=None, chunk_size=1000, throttle=None, sleep=0,
+                 db=None):
+        self.model = model
+        self.manager = model.objects
+        self.source_suffix = str(source_suffix)
+        self.targets = [str(target) for target in targets]
+        self.route = route or modulo_route(self.targets)
+        self.chunk_size = chunk_size
+        self.throttle = throttle
+        self.sleep = sleep
+        self.source_db = self.manager.shard_database(self.source_suffix, db)
+        self.ledger = ShardLedger(self.source_db)
+
+        meta = getattr(model, '_meta')
+        self.pk_name = meta.pk.attname
+        self.pk_to_python = meta.pk.to_python
+        self.columns = [field.attname for field in meta.concrete_fields]
+        self.fingerprint = hashlib.sha1(('reshard:%s:%s:%s' % (
+            meta.label_lower, self.source_suffix, ','.join(sorted(self.targets)))).encode('utf-8')).hexdigest()
+
+    def create_targets(self):
+        """
+        Create every target shard that doesn't exist yet with copy_table().
+        """
+        source_table = getattr(self.model, '_meta').db_table
+        for target in self.targets:
+            if not self.manager.shard_exists(target):
+                self.manager.copy_table(
+                    source_table, self.manager.shard_table(target), db=self.manager.shard_database(target))
+
+    def chunks(self):
+        """
+        Rows of the source shard in primary key order, chunk_size at a time, without OFFSET.
+        """
+        last = None
+        while True:
+            self.wait()
+            queryset = self.manager.shard(self.source_suffix, db=self.source_db).order_by(self.pk_name)
+            if last is not None:
+                queryset = queryset.filter(pk__gt=last)
+            rows = list(queryset.values(*self.columns)[:self.chunk_size])
+            if len(rows) == 0:
+                return
+            last = rows[-1][self.pk_name]
+            yield rows
+
+    def wait(self):
+        if self.throttle is not None:
+            self.throttle.wait()
+        if self.sleep:
+            time.sleep(self.sleep)
+
+    def split(self, rows):
+        """
+        {target suffix: rows} of the rows leaving the source shard.
+        """
+        moves = dict()
+        for row in rows:
+            target = str(self.route(row, self.pk_name))
+            if target == self.source_suffix:
+                continue
+            if target not in self.targets:
+                raise ShardException('Row %s routed to %s, which is not a target shard.' % (
+                    row[self.pk_name], target))
+            moves.setdefault(target, []).append(row)
+        return moves
+
+    def target_rows(self, target, pks):
+        # Read from the target's primary: a replica may not have the rows just copied yet.
+        return list(self.manager.shard(target, db=self.manager.shard_database(target))
+                    .filter(pk__in=pks).values(*self.columns))
+
+    def verify(self, target, rows):
+        """
+        True if the target shard holds exactly these rows.
+        """
+        copied = self.target_rows(target, [row[self.pk_name] for row in rows])
+        return len(copied) == len(rows) and row_checksum(copied, self.columns) == row_checksum(rows, self.columns)
+
+    def matching(self, target, rows):
+        """
+        Primary keys of the rows that the target shard holds with the same values.
+        """
+        copied = dict((row[self.pk_name], row_checksum([row], self.columns))
+                      for row in self.target_rows(target, [row[self.pk_name] for row in rows]))
+        return [row[self.pk_name] for row in rows
+                if copied.get(row[self.pk_name]) == row_checksum([row], self.columns)]
+
+    def copied_before(self, target):
+        """
+        Function telling if a primary key is in a range this reshard copied into target on an earlier run.
+        """
+        ranges = [(self.pk_to_python(first), self.pk_to_python(last))
+                  for first, last in self.ledger.copied_ranges(self.fingerprint, self.manager.shard_table(target))]
+
+        def copied(pk):
+            return any(first <= pk <= last for first, last in ranges)
+        return copied
+
+    def write(self, target, group, copied_before):
+        """
+        Insert the rows of a chunk the target doesn't have, and refresh the ones this reshard copied before.
+        Raises ShardException, before writing anything, when the target holds a different row with the
+        same primary key.
+        """
+        existing = dict((row[self.pk_name], row) for row in self.target_rows(target, [r[self.pk_name] for r in group]))
+        inserts = []
+        refreshes = []
+        for row in group:
+            current = existing.get(row[self.pk_name])
+            if current is None:
+                inserts.append(row)
+            elif row_checksum([current], self.columns) == row_checksum([row], self.columns):
+                continue
+            elif copied_before(row[self.pk_name]):
+                refreshes.append(row)
+            else:
+                raise ShardException(
+                    'Shard %s already has a different row with primary key %s, primary keys must be unique '
+                    'across shards.' % (target, row[self.pk_name]))
+
+        db_table = self.manager.shard_table(target)
+        db = self.manager.shard_database(target)
+        with invalidating(self.model, target):
+            if len(inserts) > 0:
+                insert_rows(self.model, db_table, inserts, db=db)
+            if len(refreshes) > 0:
+                upsert_rows(self.model, db_table, refreshes, db=db)
+
+    def copy(self, report=None):
+        """
+        Copy every row routed away from the source shard into its target, verifying each chunk.
+        """
+        report = report if report is not None else self.new_report()
+        self.ledger.ensure_table()
+        copied_before = dict((target, self.copied_before(target)) for target in self.targets)
+        for rows in self.chunks():
+            report['chunks'] += 1
+            moves = self.split(rows)
+            report['kept'] += len(rows) - sum(len(group) for group in moves.values())
+            for target, group in moves.items():
+                self.write(target, group, copied_before[target])
+                if not self.verify(target, group):
+                    raise ShardException('Chunk ending at %s does not match in shard %s (count or checksum).' % (
+                        rows[-1][self.pk_name], target))
+                self.ledger.record_copy(self.fingerprint, self.manager.shard_table(target),
+                                        group[0][self.pk_name], group[-1][self.pk_name])
+                report['copied'] += len(group)
+                report['targets'][target] = report['targets'].get(target, 0) + len(group)
+            print('  chunk %s: %s row(s) up to pk %s, %s moved' % (
+                report['chunks'], len(rows), rows[-1][self.pk_name], sum(len(group) for group in moves.values())))
+        return report
+
+    def delete_moved(self, report=None):
+        """
+        Delete the rows that were moved from the source shard, in batches. Each batch is locked with
+        SELECT ... FOR UPDATE, verified in its target again and deleted in the same transaction, so rows
+        can't change between the check and the delete. Rows that changed since they were copied are left
+        in place and counted.
+        """
+        report = report if report is not None else self.new_report()
+        source_table = self.manager.shard_table(self.source_suffix)
+        for chunk in self.chunks():
+            with transaction.atomic(using=self.source_db), invalidating(self.model, self.source_suffix):
+                rows = list(self.manager.shard(self.source_suffix, db=self.source_db).select_for_update()
+                            .filter(pk__in=[row[self.pk_name] for row in chunk]).order_by(self.pk_name)
+                            .values(*self.columns))
+                pks = []
+                for target, group in self.split(rows).items():
+                    verified = self.matching(target, group)
+                    pks.extend(verified)
+                    report['unverified'] += len(group) - len(verified)
+                if len(pks) == 0:
+                    continue
+                with connections[self.source_db].cursor() as cursor:
+                    cursor.execute('DELETE FROM %s WHERE %s IN (%s)' % (
+                        source_table, getattr(self.model, '_meta').pk.column, ', '.join(['%s'] * len(pks))), pks)
+                    report['deleted'] += max(cursor.rowcount, 0)
+        return report
+
+    @staticmethod
+    def new_report():
+        return {'chunks': 0, 'copied': 0, 'kept': 0, 'deleted': 0, 'unverified': 0, 'targets': dict()}
+
+    def run(self, delete=False):
+        """
+        Create the targets, copy the rows and optionally delete the moved rows from the source shard.
+        Returns a report of the rows copied, kept and deleted, and the seconds taken.
+        """
+        started = time.time()
+        self.create_targets()
+        report = self.copy()
+        if delete:
+            self.delete_moved(report)
+        report['seconds'] = round(time.time() - started, 3)
+        return report
@@ -0,0 +1,150 @@
+from bisect import bisect_right
+import hashlib
+import zlib
+
+
+'''
+
+    Shard routers map a shard key value to a table suffix.
+    Every router precomputes its mapping when it is created, so routing a key is O(1) or O(log n).
+
+    Usage:
+
+        class Person(ShardedModel):
+            tenant_id = models.IntegerField()
+
+            shard_key = 'tenant_id'
+            shard_router = ModuloRouter(16)
+
+        Person.objects.for_key(42).all()
+
+'''
+
+
+def stable_hash(value):
+    """
+    Hash that is the same in every process (unlike hash() for strings).
+    Integers hash to themselves so modulo routing stays predictable.
+    """
+    if isinstance(value, bool):
+        return int(value)
+    if isinstance(value, int):
+        return value
+    if not isinstance(value, bytes):
+        value = str(value).encode('utf-8')
+    return zlib.crc32(value)
+
+
+class ShardRouter:
+    """
+    Base class for routing strategies.
+    """
+    def route(self, value):
+        raise NotImplementedError('Shard routers must implement route().')
+
+    def suffixes(self):
+        """All suffixes this router can return, for fan out across every shard."""
+        raise NotImplementedError('Shard routers must implement suffixes().')
+
+
+class ModuloRouter(ShardRouter):
+    """
+    suffix = hash(key) % num_shards, offset by start. O(1).
+    """
+    def __init__(self, num_shards, start=0):
+        if num_shards < 1:
+            raise ValueError('ModuloRouter needs at least one shard.')
+        self.num_shards = num_shards
+        self._suffixes = [str(start + i) for i in range(num_shards)]
+
+    def route(self, value):
+        return self._suffixes[stable_hash(value) % self.num_shards]
+
+    def suffixes(self):
+        return list(self._suffixes)
+
+
+class ConsistentHashRouter(ShardRouter):
+    """
+    Consistent hash ring with virtual nodes. Adding a shard only moves about 1/n of the keys.
+    The ring is built once and looked up with a binary search. O(log n).
+    """
+    def __init__(self, suffixes, replicas=100):
+        if len(suffixes) == 0:
+            raise ValueError('ConsistentHashRouter needs at least one suffix.')
+        self._suffixes = [str(s) for s in suffixes]
+        ring = []
+        for suffix in self._suffixes:
+            for i in range(replicas):
+                ring.append((self._hash('%s-%s' % (suffix, i)), suffix))
+        ring.sort()
+        self._ring_keys = [point for point, _ in ring]
+        self._ring_suffixes = [suffix for _, suffix in ring]
+
+    @staticmethod
+    def _hash(value):
+        if not isinstance(value, bytes):
+            value = str(value).encode('utf-8')
+        return int.from_bytes(hashlib.md5(value).digest()[:8], 'big')
+
+    def route(self, value):
+        index = bisect_right(self._ring_keys, self._hash(value))
+        if index == len(self._ring_keys):
+            index = 0
+        return self._ring_suffixes[index]
+
+    def suffixes(self):
+        return list(self._suffixes)
+
+
+class RangeRouter(ShardRouter):
+    """
+    Routes by ranges of the key. ranges is a list of (upper_bound, suffix), where upper_bound is
+    exclusive and None means unbounded. O(log n).
+        RangeRouter([(1000, 1), (5000, 2), (None, 3)])
+    """
+    def __init__(self, ranges):
+        bounded = sorted((bound, str(suffix)) for bound, suffix in ranges if bound is not None)
+        unbounded = [str(suffix) for bound, suffix in ranges if bound is None]
+        if len(unbounded) > 1:
+            raise ValueError('RangeRouter can only have one unbounded range.')
+        self._bounds = [bound for bound, _ in bounded]
+        self._range_suffixes = [suffix for _, suffix in bounded]
+        self._overflow = unbounded[0] if unbounded else None
+
+    def route(self, value):
+        index = bisect_right(self._bounds, value)
+        if index < len(self._bounds):
+            return self._range_suffixes[index]
+        if self._overflow is None:
+            raise KeyError('No shard range for key %r.' % (value,))
+        return self._overflow
+
+    def suffixes(self):
+        suffixes = list(dict.fromkeys(self._range_suffixes))
+        if self._overflow is not None and self._overflow not in suffixes:
+            suffixes.append(self._overflow)
+        return suffixes
+
+
+class LookupRouter(ShardRouter):
+    """
+    Routes with an explicit key -> suffix table, for example tenants pinned to shards. O(1).
+    """
+    def __init__(self, mapping, default=None):
+        self._mapping = dict((key, str(suffix)) for key, suffix in mapping.items())
+        self._default = str(default) if default is not None else None
+
+    def route(self, value):
+        suffix = self._mapping.get(value)
+        if suffix is None:
+            if self._default is None:
+                raise KeyError('No shard for key %r.' % (value,))
+            return self._default
+        return suffix
+
+    def suffixes(self):
+        suffixes = list(dict.fromkeys(self._mapping.values()))
+        if self._default is not None and self._default not in suffixes:
+            suffixes.append(self._default)
+        return suffixes
@@ -0,0 +1,462 @@
+from .aggregates import split_aggregates
+from .aio import async_map, run_sync
+from .exceptions import ShardException
+from .utils import parallel_map, run_in_background
+from itertools import islice
+import heapq
+
+
+'''
+
+    Scatter-gather queries across many shards.
+
+    The same filtered query runs against every shard table concurrently, on at most `workers` threads
+    of the shared worker pool, each with its own connections. Ordered results are combined with a k-way merge,
+    and LIMIT/OFFSET is pushed down so each shard returns at most OFFSET + LIMIT rows.
+
+    iterator() streams rows in constant memory, using keyset pagination on the primary key and
+    prefetching the first chunk of the next shard while the current one is consumed.
+
+    Aggregates are computed by every shard in SQL and combined from the partial results.
+
+    In async code the shards are queried from the event loop with async for, acount() and aaggregate(),
+    on at most `workers` threads (see aio.py).
+
+    Usage:
+        Person.objects.across_shards('all').filter(age__gte=21).order_by('-age')[:10]
+        Person.objects.across_shards('all').aggregate(total=Sum('age'), average=Avg('age'))
+        Person.objects.across_shards('all').values('team').annotate(people=Count('id'))
+        [person async for person in Person.objects.across_shards('all', workers=4).filter(age__gte=21)]
+
+    Worker threads use their own connections, so they do not see uncommitted changes from an
+    open transaction in the calling thread.
+
+    Ordered rows are merged in Python: strings compare by code point, not by the column's collation.
+    With MySQL's case or accent insensitive collations (the default) the shards return strings in an
+    order Python doesn't share, so a merged order_by() on a string field can interleave rows wrongly and
+    a sliced query can return the wrong top N. Order by numeric, date or binary collated fields to merge.
+
+'''
+
+
+class OrderKey:
+    """
+    Sort key for merging rows ordered by several fields with mixed directions.
+    NULL sorts before any value, like MySQL. Strings compare by code point, not by collation.
+    """
+    __slots__ = ('values', 'descending')
+
+    def __init__(self, values, descending):
+        self.values = values
+        self.descending = descending
+
+    def __lt__(self, other):
+        for a, b, desc in zip(self.values, other.values, self.descending):
+            if a == b:
+                continue
+            if a is None:
+                less = True
+            elif b is None:
+                less = False
+            else:
+                less = a < b
+            return not less if desc else less
+        return False
+
+
+class MultiShardQuerySet:
+    """
+    Lazy query over several shards of one model. Chainable QuerySet methods are recorded and
+    replayed on every shard's QuerySet when the results are evaluated.
+    """
+    chainable = (
+        'filter', 'exclude', 'order_by', 'values', 'values_list', 'only', 'defer',
+        'select_related', 'annotate', 'distinct', 'extra',
+    )
+
+    def __init__(self, manager, suffixes, db=None, workers=None):
+        self.manager = manager
+        self._suffixes = suffixes if suffixes == 'all' else list(suffixes)
+        self.db = db
+        self.workers = workers
+        self._operations = []
+        self._low_mark = 0
+        self._high_mark = None
+        self._result_cache = None
+
+    def __getattr__(self, name):
+        if name in self.chainable:
+            def method(*args, **kwargs):
+                clone = self._clone()
+                clone._operations.append((name, args, kwargs))
+                return clone
+            return method
+        raise AttributeError(name)
+
+    def __repr__(self):
+        return '<MultiShardQuerySet %s shards=%s>' % (self.manager.model.__name__, self._suffixes)
+
+    @property
+    def suffixes(self):
+        """
+        The shards to query. 'all' is resolved when the query is evaluated.
+        """
+        if self._suffixes == 'all':
+            self._suffixes = self.manager.shard_suffixes(db=self.db)
+        return self._suffixes
+
+    def _clone(self):
+        clone = self.__class__(self.manager, self._suffixes, db=self.db, workers=self.workers)
+        clone._operations = list(self._operations)
+        clone._low_mark = self._low_mark
+        clone._high_mark = self._high_mark
+        return clone
+
+    def __getitem__(self, k):
+        if isinstance(k, int):
+            if k < 0:
+                raise ShardException('Negative indexing is not supported.')
+            return list(self[k:k + 1])[0]
+        if not isinstance(k, slice) or k.step is not None:
+            raise ShardException('Only integer indexes and slices without a step are supported.')
+        if (k.start is not None and k.start < 0) or (k.stop is not None and k.stop < 0):
+            raise ShardException('Negative indexing is not supported.')
+        clone = self._clone()
+        start = k.start or 0
+        clone._low_mark = self._low_mark + start
+        if k.stop is not None:
+            stop = self._low_mark + k.stop
+            if self._high_mark is not None:
+                stop = min(stop, self._high_mark)
+            clone._high_mark = max(stop, clone._low_mark)
+        return clone
+
+    def __iter__(self):
+        self._fetch_all()
+        return iter(self._result_cache)
+
+    def __len__(self):
+        self._fetch_all()
+        return len(self._result_cache)
+
+    def __bool__(self):
+        self._fetch_all()
+        return bool(self._result_cache)
+
+    def __aiter__(self):
+        async def rows():
+            await self._afetch_all()
+            for row in self._result_cache:
+                yield row
+        return rows()
+
+    def shard_queryset(self, table_suffix):
+        """
+        The QuerySet for one shard with every recorded operation applied (without slicing).
+        """
+        queryset = self.manager.shard(table_suffix, db=self.db)
+        default_ordering = self._default_ordering()
+        if default_ordering:
+            # Shard models don't copy Meta.ordering, order each shard like Django orders the model.
+            queryset = queryset.order_by(*default_ordering)
+        for name, args, kwargs in self._operations:
+            queryset = getattr(queryset, name)(*args, **kwargs)
+        return queryset
+
+    def _fetch_chunk(self, table_suffix, last_pk, chunk_size):
+        """
+        Next chunk of a shard after last_pk. Returns (rows, last pk of the chunk).
+        The chunk's primary keys are read first from the index, then the rows in that pk range,
+        so this works for model instances, values() and values_list() alike.
+        """
+        queryset = self.shard_queryset(table_suffix)
+        if last_pk is not None:
+            queryset = queryset.filter(pk__gt=last_pk)
+        pks = list(queryset.order_by('pk').values_list('pk', flat=True)[:chunk_size])
+        if len(pks) == 0:
+            return [], None
+        return list(queryset.filter(pk__lte=pks[-1]).order_by('pk')), pks[-1]
+
+    def iterator(self, chunk_size=2000, prefetch=True):
+        """
+        Stream every row of every shard, shard by shard in primary key order, holding at most two
+        chunks in memory. Ordering and slicing of the query are ignored.
+        """
+        if self._grouping() is not None:
+            raise ShardException('Grouped queries cannot be streamed across shards.')
+        if chunk_size < 1:
+            raise ShardException('chunk_size must be at least 1.')
+
+        pending = None
+        for i, table_suffix in enumerate(self.suffixes):
+            if pending is not None:
+                rows, last_pk = pending.result()
+            else:
+                rows, last_pk = self._fetch_chunk(table_suffix, None, chunk_size)
+            pending = None
+            if prefetch and i + 1 < len(self.suffixes):
+                pending = run_in_background(self._fetch_chunk, self.suffixes[i + 1], None, chunk_size)
+
+            while len(rows) > 0:
+                for row in rows:
+                    yield row
+                if len(rows) < chunk_size:
+                    break
+                rows, last_pk = self._fetch_chunk(table_suffix, last_pk, chunk_size)
+
+    def _parallel(self, func):
+        results = []
+        for table_suffix, result, err in parallel_map(func, self.suffixes, self.workers):
+            if err is not None:
+                raise ShardException('Query on shard %s failed: %s' % (table_suffix, err)) from err
+            results.append(result)
+        return results
+
+    async def _aparallel(self, func):
+        if self._suffixes == 'all':
+            self._suffixes = await run_sync(self.manager.shard_suffixes)(db=self.db)
+        results = []
+        for table_suffix, result, err in await async_map(func, self._suffixes, self.workers):
+            if err is not None:
+                raise ShardException('Query on shard %s failed: %s' % (table_suffix, err)) from err
+            results.append(result)
+        return results
+
+    def _aggregate_query(self, args, kwargs):
+        """
+        (query of one shard, combine(shard results)) of an aggregate across shards.
+        """
+        if self._low_mark or self._high_mark is not None:
+            raise ShardException('Cannot aggregate a sliced query across shards.')
+        if self._grouping() is not None:
+            raise ShardException('Cannot aggregate a grouped query across shards.')
+        partials, shard_aggregates = split_aggregates(args, kwargs)
+
+        def combine(rows):
+            return dict((partial.alias, partial.combine(rows)) for partial in partials)
+        return lambda table_suffix: self.shard_queryset(table_suffix).aggregate(**shard_aggregates), combine
+
+    def aggregate(self, *args, **kwargs):
+        """
+        Aggregate over every shard. Each shard computes partial aggregates in SQL.
+        """
+        query, combine = self._aggregate_query(args, kwargs)
+        return combine(self._parallel(query))
+
+    async def aaggregate(self, *args, **kwargs):
+        query, combine = self._aggregate_query(args, kwargs)
+        return combine(await self._aparallel(query))
+
+    def _counts_rows(self):
+        return self._result_cache is not None or self._low_mark or self._high_mark is not None \
+            or self._grouping() is not None
+
+    def _count_shard(self, table_suffix):
+        return self.shard_queryset(table_suffix).count()
+
+    def count(self):
+        """
+        Total number of rows in every shard, counted by each shard in SQL.
+        """
+        if self._counts_rows():
+            return len(self)
+        return sum(self._parallel(self._count_shard))
+
+    async def acount(self):
+        if self._counts_rows():
+            await self._afetch_all()
+            return len(self._result_cache)
+        return sum(await self._aparallel(self._count_shard))
+
+    @staticmethod
+    def _is_aggregate_annotation(args, kwargs):
+        expressions = list(args) + list(kwargs.values())
+        return any(getattr(expression, 'contains_aggregate', False) for expression in expressions)
+
+    def _grouping(self):
+        """
+        Index of the values(...).annotate(<aggregates>) operation that groups rows, or None.
+        """
+        seen_values = False
+        for i, (name, args, kwargs) in enumerate(self._operations):
+            if name == 'values':
+                seen_values = True
+            elif name == 'annotate' and seen_values and self._is_aggregate_annotation(args, kwargs):
+                return i
+        return None
+
+    def _grouped_query(self, index):
+        """
+        values(...).annotate(...) across shards: every shard groups its own rows, then the partial
+        groups are merged by their values and the aggregates combined.
+        Returns (query of one shard, combine(shard results)).
+        """
+        shard_operations = list(self._operations[:index])
+        partials = []
+        shard_aggregates = dict()
+        for name, args, kwargs in self._operations[index:]:
+            if name == 'annotate' and self._is_aggregate_annotation(args, kwargs):
+                annotate_partials, annotate_aggregates = split_aggregates(args, kwargs)
+                partials.extend(annotate_partials)
+                shard_aggregates.update(annotate_aggregates)
+            elif name != 'order_by':
+                raise ShardException('%s() after a grouped annotate() is not supported across shards.' % name)
+        shard_operations.append(('annotate', (), shard_aggregates))
+
+        def fetch(table_suffix):
+            queryset = self.manager.shard(table_suffix, db=self.db)
+            for name, args, kwargs in shard_operations:
+                queryset = getattr(queryset, name)(*args, **kwargs)
+            return list(queryset.order_by())
+
+        def combine(shard_results):
+            groups = dict()
+            for rows in shard_results:
+                for row in rows:
+                    key = tuple((k, v) for k, v in row.items() if k not in shard_aggregates)
+                    groups.setdefault(key, []).append(row)
+
+            results = []
+            for key, rows in groups.items():
+                result = dict(key)
+                for partial in partials:
+                    result[partial.alias] = partial.combine(rows)
+                results.append(result)
+            return results
+        return fetch, combine
+
+    def _ordering(self):
+        """
+        Fields of the last order_by(), or the model's Meta.ordering when order_by() wasn't called.
+        """
+        ordering = None
+        for name, args, kwargs in self._operations:
+            if name == 'order_by':
+                ordering = list(args)
+        if ordering is None:
+            ordering = self._default_ordering()
+        return ordering
+
+    def _default_ordering(self):
+        """
+        The model's Meta.ordering if no order_by() was recorded and the shards' rows can be merged by
+        it, else []. Like Django, grouped queries leave it out. Orderings by expressions, relations or
+        fields that aren't selected are left out too, and the shards are read one after the other.
+        """
+        meta = getattr(self.manager.model, '_meta')
+        ordering = list(meta.ordering)
+        if not ordering or self._grouping() is not None:
+            return []
+        if any(name == 'order_by' for name, args, kwargs in self._operations):
+            return []
+        kind, fields = self._values_fields()
+        if kind == 'values':
+            selected = fields or [field.attname for field in meta.concrete_fields]
+            for order in ordering:
+                name = order.lstrip('-+') if isinstance(order, str) else None
+                if (meta.pk.name if name == 'pk' else name) not in selected:
+                    return []
+        try:
+            self._key_function(ordering)
+        except ShardException:
+            return []
+        return ordering
+
+    def _values_fields(self):
+        """
+        (kind, fields) of the last values()/values_list() call, or (None, None) for model instances.
+        """
+        kind, fields = None, None
+        for name, args, kwargs in self._operations:
+            if name in ('values', 'values_list'):
+                kind, fields = name, list(args)
+                if name == 'values_list' and kwargs.get('flat'):
+                    kind = 'flat'
+                elif name == 'values_list' and kwargs.get('named'):
+                    kind = 'named'
+        return kind, fields
+
+    def _key_function(self, ordering):
+        meta = getattr(self.manager.model, '_meta')
+        kind, fields = self._values_fields()
+        names = []
+        descending = []
+        for order in ordering:
+            if not isinstance(order, str) or order == '?':
+                raise ShardException('Only field name ordering can be merged across shards: %r' % (order,))
+            descending.append(order.startswith('-'))
+            names.append(order.lstrip('-+'))
+
+        getters = []
+        for name in names:
+            if name == 'pk' and kind is not None:
+                name = meta.pk.name
+            if kind == 'values':
+                getters.append(lambda row, name=name: row[name])
+            elif kind in ('values_list', 'named', 'flat'):
+                if not fields or name not in fields:
+                    raise ShardException('Ordering field "%s" must be selected to merge values_list() rows.' % name)
+                if kind == 'flat':
+                    getters.append(lambda row: row)
+                else:
+                    getters.append(lambda row, index=fields.index(name): row[index])
+            else:
+                if '__' in name:
+                    raise ShardException('Ordering across relations cannot be merged: %s' % name)
+                attname = meta.pk.attname if name == 'pk' else meta.get_field(name).attname
+                getters.append(lambda row, attname=attname: getattr(row, attname))
+
+        def key(row):
+            return OrderKey(tuple(getter(row) for getter in getters), descending)
+        return key
+
+    def _fetch_shard(self, table_suffix):
+        queryset = self.shard_queryset(table_suffix)
+        if self._high_mark is not None:
+            # LIMIT pushdown: no shard can contribute more than OFFSET + LIMIT rows.
+            queryset = queryset[:self._high_mark]
+        return list(queryset)
+
+    def _fetch_query(self):
+        """
+        (query of one shard, combine(shard results)) returning the rows of the query.
+        """
+        ordering = self._ordering()
+        key = self._key_function(ordering) if ordering else None
+
+        grouping = self._grouping()
+        if grouping is not None:
+            fetch, combine_groups = self._grouped_query(grouping)
+
+            def combine(shard_results):
+                rows = combine_groups(shard_results)
+                if key is not None:
+                    rows.sort(key=key)
+                return rows[self._low_mark:self._high_mark]
+            return fetch, combine
+
+        def combine(shard_results):
+            if key is not None:
+                merged = heapq.merge(*shard_results, key=key)
+            else:
+                merged = (row for rows in shard_results for row in rows)
+            return list(islice(merged, self._low_mark, self._high_mark))
+        return self._fetch_shard, combine
+
+    def _fetch_all(self):
+        if self._result_cache is not None:
+            return
+        if self._high_mark is not None and self._high_mark <= self._low_mark:
+            self._result_cache = []
+            return
+        fetch, combine = self._fetch_query()
+        self._result_cache = combine(self._parallel(fetch))
+
+    async def _afetch_all(self):
+        if self._result_cache is not None:
+            return
+        if self._high_mark is not None and self._high_mark <= self._low_mark:
+            self._result_cache = []
+            return
+        fetch, combine = self._fetch_query()
+        self._result_cache = combine(await self._aparallel(fetch))
@@ -0,0 +1,417 @@
+from collections import OrderedDict
+from django.db import connections
+import hashlib
+import re
+import threading
+
+
+'''
+
+    In-memory snapshot of table schemas for shard migrations.
+
+    Columns, indexes and foreign keys of the source tables and all their shards are read with a few
+    set-based INFORMATION_SCHEMA queries, instead of one query per shard per check. Every existence
+    and diff check runs against the snapshot, and the snapshot is updated as DDL is planned.
+
+    AlterPlan collects the resulting clauses so every shard is altered with one ALTER TABLE statement.
+    Fingerprints of the normalized schemas show which shards drifted from their source table.
+
+'''
+
+
+# Tables per INFORMATION_SCHEMA query, to keep the IN (...) list a reasonable size.
+TABLES_PER_QUERY = 500
+
+
+# Expression defaults that are written without parentheses: CURRENT_TIMESTAMP, NOW(6), current_timestamp().
+TIMESTAMP_DEFAULT = re.compile(r'^(current_timestamp|now|localtime|localtimestamp)(\(\d*\))?$', re.IGNORECASE)
+NUMBER = re.compile(r'^-?\d+(\.\d+)?(e[-+]?\d+)?$', re.IGNORECASE)
+
+
+def is_expression_default(definition):
+    """
+    True if the column default is an expression: DEFAULT_GENERATED in EXTRA (MySQL 8), or
+    CURRENT_TIMESTAMP, which MySQL 5.7 reports without it.
+    """
+    return 'DEFAULT_GENERATED' in definition.get('extra', '').upper() or \
+        TIMESTAMP_DEFAULT.match(str(definition['default'])) is not None
+
+
+def mariadb_default(default):
+    """
+    (default, extra) of a MariaDB COLUMN_DEFAULT, which quotes literals, reports no default as 'NULL'
+    and expressions as they are written, in the form MySQL reports them.
+    """
+    if default is None or default == 'NULL':
+        return None, ''
+    if len(default) >= 2 and default[0] == default[-1] == "'":
+        return default[1:-1].replace("''", "'"), ''
+    if NUMBER.match(default):
+        return default, ''
+    return default, 'DEFAULT_GENERATED'
+
+
+def column_signature(definition):
+    """
+    Comparable form of a snapshot column: type, nullable, default and EXTRA.
+    """
+    default = definition['default']
+    return (str(definition['type']).lower(), definition['nullable'], None if default is None else str(default),
+            definition.get('extra', '').lower())
+
+
+def column_definition(definition):
+    """
+    Column definition SQL from a snapshot column: type, NOT NULL, DEFAULT and ON UPDATE.
+    """
+    sql = definition['type']
+    if not definition['nullable']:
+        sql += ' NOT NULL'
+    default = definition['default']
+    if default is not None and is_expression_default(definition):
+        sql += ' DEFAULT %s' % (default if TIMESTAMP_DEFAULT.match(str(default)) else '(%s)' % default)
+    elif default is not None:
+        sql += " DEFAULT '%s'" % str(default).replace("'", "''")
+    on_update = re.search(r'on update (\S+)', definition.get('extra', ''), re.IGNORECASE)
+    if on_update is not None:
+        sql += ' ON UPDATE %s' % on_update.group(1)
+    return sql
+
+
+class SchemaSnapshot:
+    """
+    Schema of many tables in one database, keyed by table name:
+        columns:      {column: {'type': 'varchar(50)', 'nullable': True, 'default': None, 'extra': ''}}
+        indexes:      {key name: {'unique': True, 'columns': ['a', 'b']}}
+        foreign_keys: {constraint name: {'column': 'team_id', 'table': 'app_team', 'ref_column': 'id'}}
+    """
+    def __init__(self, db='default'):
+        self.db = db
+        self.tables = dict()
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def empty_table():
+        return {'columns': dict(), 'indexes': dict(), 'foreign_keys': dict()}
+
+    def load(self, tables):
+        """
+        Read the schema of every table not in the snapshot yet.
+        """
+        with self._lock:
+            missing = [table for table in dict.fromkeys(tables) if table not in self.tables]
+        if len(missing) == 0:
+            return self
+
+        loaded = dict((table, self.empty_table()) for table in missing)
+        with connections[self.db].cursor() as cursor:
+            cursor.execute('SELECT VERSION()')
+            mariadb = 'mariadb' in cursor.fetchone()[0].lower()
+            for i in range(0, len(missing), TABLES_PER_QUERY):
+                chunk = missing[i:i + TABLES_PER_QUERY]
+                placeholders = ', '.join(['%s'] * len(chunk))
+
+                cursor.execute('''
+                    SELECT TABLE_NAME, COLUMN_NAME, COLUMN_TYPE, IS_NULLABLE, COLUMN_DEFAULT, EXTRA
+                    FROM INFORMATION_SCHEMA.COLUMNS
+                    WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME IN (%s)
+                    ORDER BY TABLE_NAME, ORDINAL_POSITION''' % placeholders, chunk)
+                for table, column, column_type, nullable, default, extra in cursor.fetchall():
+                    extra = extra or ''
+                    if mariadb:
+                        default, generated = mariadb_default(default)
+                        extra = ('%s %s' % (generated, extra)).strip()
+                    loaded[table]['columns'][column] = {
+                        'type': column_type, 'nullable': nullable == 'YES', 'default': default, 'extra': extra}
+
+                cursor.execute('''
+                    SELECT TABLE_NAME, INDEX_NAME, NON_UNIQUE, COLUMN_NAME
+                    FROM INFORMATION_SCHEMA.STATISTICS
+                    WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME IN (%s)
+                    ORDER BY TABLE_NAME, INDEX_NAME, SEQ_IN_INDEX''' % placeholders, chunk)
+                for table, index_name, non_unique, column in cursor.fetchall():
+                    index = loaded[table]['indexes'].setdefault(
+                        index_name, {'unique': str(non_unique) == '0', 'columns': []})
+                    index['columns'].append(column)
+
+                cursor.execute('''
+                    SELECT TABLE_NAME, CONSTRAINT_NAME, COLUMN_NAME, REFERENCED_TABLE_NAME, REFERENCED_COLUMN_NAME
+                    FROM INFORMATION_SCHEMA.KEY_COLUMN_USAGE
+                    WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME IN (%s)
+                    AND REFERENCED_TABLE_NAME IS NOT NULL''' % placeholders, chunk)
+                for table, constraint, column, ref_table, ref_column in cursor.fetchall():
+                    loaded[table]['foreign_keys'][constraint] = {
+                        'column': column, 'table': ref_table, 'ref_column': ref_column}
+
+        with self._lock:
+            self.tables.update(loaded)
+        return self
+
+    def table(self, table):
+        with self._lock:
+            return self.tables.setdefault(table, self.empty_table())
+
+    # Checks
+
+    def column(self, table, column):
+        """
+        Column definition, or None if the table has no such column.
+        """
+        return self.table(table)['columns'].get(column)
+
+    def find_column(self, table, field_name):
+        """
+        (column name, definition) of a field, also trying the <field>_id column of foreign keys.
+        Returns (None, None) when neither exists.
+        """
+        for column in (field_name, '%s_id' % field_name):
+            definition = self.column(table, column)
+            if definition is not None:
+                return column, definition
+        return None, None
+
+    def indexes_on(self, table, column, include_uniq=False):
+        """
+        {key name: index} of the indexes using a column, without the primary key and, unless
+        include_uniq, without the unique together (_uniq) indexes.
+        """
+        indexes = dict()
+        for name, index in self.table(table)['indexes'].items():
+            if name == 'PRIMARY' or column not in index['columns']:
+                continue
+            if not include_uniq and name.endswith('_uniq'):
+                continue
+            indexes[name] = index
+        return indexes
+
+    def unique_together_indexes(self, table):
+        return [name for name, index in self.table(table)['indexes'].items()
+                if index['unique'] and name.endswith('_uniq')]
+
+    def foreign_keys_on(self, table, column):
+        return [name for name, fk in self.table(table)['foreign_keys'].items() if fk['column'] == column]
+
+    def normalized(self, table):
+        """
+        Name-independent form of a table schema: column definitions, indexes as (unique, columns) and
+        foreign keys as (column, table, column). Column order and generated key names are ignored.
+        """
+        schema = self.table(table)
+        columns = sorted((name,) + column_signature(c) for name, c in schema['columns'].items())
+        indexes = sorted((name == 'PRIMARY', index['unique'], tuple(index['columns']))
+                         for name, index in schema['indexes'].items())
+        foreign_keys = sorted((fk['column'], fk['table'], fk['ref_column']) for fk in schema['foreign_keys'].values())
+        return columns, indexes, foreign_keys
+
+    def fingerprint(self, table):
+        """
+        sha1 of the normalized schema; shards that match their source table have the same fingerprint.
+        """
+        return hashlib.sha1(repr(self.normalized(table)).encode('utf-8')).hexdigest()
+
+    def repair(self, source_table, table, plan):
+        """
+        Add the clauses that make table match source_table to an AlterPlan, and update the snapshot.
+        Primary keys are compared by the fingerprint but never changed.
+        """
+        source = self.table(source_table)
+        shard = self.table(table)
+        primary_key = source['indexes'].get('PRIMARY', {'columns': []})['columns']
+
+        # Foreign keys first, so columns they use can be dropped.
+        source_fks = set((fk['column'], fk['table'], fk['ref_column']) for fk in source['foreign_keys'].values())
+        shard_fks = set()
+        for name, fk in list(shard['foreign_keys'].items()):
+            key = (fk['column'], fk['table'], fk['ref_column'])
+            if key not in source_fks or key in shard_fks:
+                plan.drop_foreign_key(table, name)
+                self.drop_foreign_key(table, name)
+            else:
+                shard_fks.add(key)
+
+        for column, definition in source['columns'].items():
+            current = shard['columns'].get(column)
+            if current is None:
+                plan.add_column(table, column, column_definition(definition))
+                self.add_column(table, column, definition)
+            elif column not in primary_key and \
+                    column_signature(current) != column_signature(definition):
+                plan.modify_column(table, column, column_definition(definition))
+                self.modify_column(table, column, **definition)
+        for column in list(shard['columns'].keys()):
+            if column not in source['columns']:
+                plan.drop_column(table, column)
+                self.drop_column(table, column)
+
+        source_indexes = dict(((index['unique'], tuple(index['columns'])), name)
+                              for name, index in source['indexes'].items() if name != 'PRIMARY')
+        shard_indexes = set()
+        for name, index in list(shard['indexes'].items()):
+            key = (index['unique'], tuple(index['columns']))
+            if name == 'PRIMARY':
+                continue
+            if key not in source_indexes or key in shard_indexes:
+                plan.drop_index(table, name)
+                self.drop_index(table, name)
+            else:
+                shard_indexes.add(key)
+        for key, name in source_indexes.items():
+            if key not in shard_indexes:
+                plan.add_index(table, name, key[1], unique=key[0])
+                self.add_index(table, name, key[1], unique=key[0])
+
+        for column, ref_table, ref_column in source_fks - shard_fks:
+            plan.add_foreign_key(table, column, ref_table, ref_column)
+            self.add_foreign_key(table, '%s_%s_fk' % (table, column), column, ref_table, ref_column)
+
+    # Updates, applied while planning as each clause is added to the AlterPlan, so later changes of the
+    # same run see the planned schema. A failed ALTER leaves the snapshot ahead of the shard; snapshots
+    # are loaded fresh for every run.
+
+    def add_column(self, table, column, definition):
+        with self._lock:
+            self.table(table)['columns'][column] = dict(definition)
+
+    def modify_column(self, table, column, **changes):
+        with self._lock:
+            definition = self.table(table)['columns'].get(column)
+            if definition is not None:
+                definition.update(changes)
+
+    def drop_column(self, table, column):
+        with self._lock:
+            schema = self.table(table)
+            schema['columns'].pop(column, None)
+            for name in list(schema['indexes'].keys()):
+                index = schema['indexes'][name]
+                if column in index['columns']:
+                    index['columns'].remove(column)
+                    if len(index['columns']) == 0:
+                        del schema['indexes'][name]
+            for name in self.foreign_keys_on(table, column):
+                del schema['foreign_keys'][name]
+
+    def rename_column(self, table, old_column, new_column, column_type=None):
+        with self._lock:
+            schema = self.table(table)
+            definition = schema['columns'].pop(old_column, None)
+            if definition is not None:
+                if column_type is not None:
+                    definition['type'] = column_type
+                schema['columns'][new_column] = definition
+            for index in schema['indexes'].values():
+                index['columns'] = [new_column if c == old_column else c for c in index['columns']]
+            for fk in schema['foreign_keys'].values():
+                if fk['column'] == old_column:
+                    fk['column'] = new_column
+
+    def add_index(self, table, name, columns, unique=False):
+        with self._lock:
+            self.table(table)['indexes'][name] = {'unique': unique, 'columns': list(columns)}
+
+    def drop_index(self, table, name):
+        with self._lock:
+            self.table(table)['indexes'].pop(name, None)
+
+    def add_foreign_key(self, table, name, column, ref_table, ref_column):
+        with self._lock:
+            self.table(table)['foreign_keys'][name] = {'column': column, 'table': ref_table, 'ref_column': ref_column}
+
+    def drop_foreign_key(self, table, name):
+        with self._lock:
+            self.table(table)['foreign_keys'].pop(name, None)
+
+
+class AlterPlan:
+    """
+    Pending shard DDL, compiled into one ALTER TABLE statement per table. Clauses for the same
+    column or index are merged, so a column added and then modified in the same run is added once
+    with its final definition, and a column added and then dropped is never touched. Changes to a
+    column renamed in the same run are folded into its CHANGE clause, since MySQL resolves every
+    clause of a statement against the columns the table had before it.
+    """
+    def __init__(self):
+        self.tables = OrderedDict()
+        # {table: {new column: old column}} of pending CHANGE clauses.
+        self.renames = dict()
+
+    def clauses(self, table):
+        return self.tables.setdefault(table, OrderedDict())
+
+    def renamed_from(self, table, column):
+        """
+        The current name of a column that a pending CHANGE renames to column, or None.
+        """
+        return self.renames.get(table, {}).get(column)
+
+    def add_column(self, table, column, definition):
+        self.clauses(table)[('add', column)] = 'ADD COLUMN %s %s' % (column, definition)
+
+    def modify_column(self, table, column, definition):
+        clauses = self.clauses(table)
+        old_column = self.renamed_from(table, column)
+        if ('add', column) in clauses:
+            self.add_column(table, column, definition)
+        elif old_column is not None:
+            clauses[('change', old_column)] = 'CHANGE %s %s %s' % (old_column, column, definition)
+        else:
+            clauses[('modify', column)] = 'MODIFY %s %s' % (column, definition)
+
+    def change_column(self, table, old_column, new_column, definition):
+        clauses = self.clauses(table)
+        original = self.renamed_from(table, old_column)
+        if ('add', old_column) in clauses:
+            del clauses[('add', old_column)]
+            self.add_column(table, new_column, definition)
+            return
+        if original is not None:
+            # Renamed twice in one run: one CHANGE from the original name.
+            del self.renames[table][old_column]
+            old_column = original
+        else:
+            clauses.pop(('modify', old_column), None)
+        clauses[('change', old_column)] = 'CHANGE %s %s %s' % (old_column, new_column, definition)
+        self.renames.setdefault(table, dict())[new_column] = old_column
+
+    def drop_column(self, table, column):
+        clauses = self.clauses(table)
+        clauses.pop(('modify', column), None)
+        clauses.pop(('foreign key', column), None)
+        old_column = self.renamed_from(table, column)
+        if old_column is not None:
+            # Renamed and dropped in one run: drop it under its current name.
+            del self.renames[table][column]
+            del clauses[('change', old_column)]
+            clauses[('drop', old_column)] = 'DROP COLUMN %s' % old_column
+        elif clauses.pop(('add', column), None) is None:
+            clauses[('drop', column)] = 'DROP COLUMN %s' % column
+
+    def add_index(self, table, name, columns, unique=False):
+        # Index columns name the table after the statement, so columns renamed in it use their new name.
+        clauses = self.clauses(table)
+        new_names = dict((old, new) for new, old in self.renames.get(table, {}).items()
+                         if ('add', old) not in clauses)
+        clauses[('index', name)] = 'ADD %s %s (%s)' % (
+            'UNIQUE INDEX' if unique else 'INDEX', name, ', '.join(new_names.get(c, c) for c in columns))
+
+    def drop_index(self, table, name):
+        clauses = self.clauses(table)
+        if clauses.pop(('index', name), None) is None:
+            clauses[('drop index', name)] = 'DROP INDEX %s' % name
+
+    def add_foreign_key(self, table, column, ref_table, ref_column):
+        self.clauses(table)[('foreign key', column)] = 'ADD FOREIGN KEY (%s) REFERENCES %s(%s)' % (
+            column, ref_table, ref_column)
+
+    def drop_foreign_key(self, table, name):
+        self.clauses(table)[('drop foreign key', name)] = 'DROP FOREIGN KEY %s' % name
+
+    def statements(self):
+        """
+        {table: ALTER TABLE statement} for every table with pending changes.
+        """
+        return OrderedDict((table, 'ALTER TABLE %s %s;' % (table, ', '.join(clauses.values())))
+                           for table, clauses in self.tables.items() if len(clauses) > 0)
+
+    def __len__(self):
+        return len(self.statements())
@@ -1,3 +1,803 @@
-from django.test import TestCase
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.db import connection, models
+from django.db.models import Avg, Count, Max, Min, StdDev, Sum
+from django.test import SimpleTestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from . import bulk, ledger, scatter
+from .aggregates import PartialAggregate
+from .bulk import load_rows
+from .catalog import SHARD_CATALOG
+from .exceptions import ShardException
+from .ledger import ShardLedger, ledger_table
+from .management.commands.migrate import Command as MigrateCommand
+from .managers import ShardedModel
+from .placement import placement_databases, shard_databases
+from .querycache import QUERY_CACHE, ShardQueryCache, invalidate_shard, invalidating
+from .replicas import recently_written
+from .resharding import Resharder
+from .routing import ConsistentHashRouter, LookupRouter, ModuloRouter, RangeRouter
+from .scatter import OrderKey
+from .schema import AlterPlan, SchemaSnapshot, column_definition, mariadb_default
+from .utils import ShardModelCache
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import redirect_stdout
+from unittest import mock
+import contextvars
+import copy
+import datetime
+import io
+import os
+import tempfile
+import threading
 
-# Create your tests here.
+
+class LoadedEvent(ShardedModel):
+    created = models.DateTimeField()
+    data = models.JSONField(null=True)
+
+    class Meta:
+        app_label = 'django_table_sharding'
+
+
+class TaggedItem(ShardedModel):
+    related = models.ManyToManyField('self', blank=True)
+
+    class Meta:
+        app_label = 'django_table_sharding'
+
+
+class ShardCatalogTest(SimpleTestCase):
+    def test_shard_tables(self):
+        self.assertEqual(SHARD_CATALOG.model_for_table('django_table_sharding_taggeditem_3'), (TaggedItem, '3'))
+
+    def test_many_to_many_tables_are_not_shards(self):
+        self.assertEqual(SHARD_CATALOG.model_for_table('django_table_sharding_taggeditem_related'), (None, None))
+
+
+class LoadRowsInsertFallbackTest(TransactionTestCase):
+    """
+    Without LOAD DATA LOCAL INFILE, load_rows() inserts the values it already converted for the file.
+    """
+    def setUp(self):
+        with connection.schema_editor() as editor:
+            editor.create_model(LoadedEvent)
+
+    def tearDown(self):
+        with connection.schema_editor() as editor:
+            editor.delete_model(LoadedEvent)
+
+    @override_settings(USE_TZ=True, TIME_ZONE='America/New_York')
+    def test_values_are_converted_once(self):
+        created = datetime.datetime(2024, 1, 1, 12, 0, tzinfo=datetime.timezone.utc)
+        table = getattr(LoadedEvent, '_meta').db_table
+        report = load_rows(LoadedEvent, table, [{'created': created, 'data': {'a': 1}}], columns=['created', 'data'])
+        if connection.vendor != 'mysql':
+            self.assertEqual(report['method'], 'insert')
+        self.assertEqual(report['rows'], 1)
+
+        event = LoadedEvent.objects.get()
+        self.assertEqual(event.created, created)
+        self.assertEqual(event.data, {'a': 1})
+
+    def test_load_file_removed_on_error(self):
+        files = []
+        named_temporary_file = tempfile.NamedTemporaryFile
+
+        def temporary_file(*args, **kwargs):
+            files.append(named_temporary_file(*args, **kwargs))
+            return files[-1]
+
+        rows = [{'created': datetime.datetime(2024, 1, 1), 'data': None}, {'created': 'not a date'}]
+        with mock.patch.object(bulk.tempfile, 'NamedTemporaryFile', temporary_file):
+            with self.assertRaises(Exception):
+                bulk.write_load_file(LoadedEvent, rows, ['created', 'data'])
+        self.assertEqual(len(files), 1)
+        self.assertFalse(os.path.exists(files[0].name))
+
+
+class AlterPlanTest(SimpleTestCase):
+    def test_add_then_modify(self):
+        plan = AlterPlan()
+        plan.add_column('t', 'a', 'int(11)')
+        plan.modify_column('t', 'a', "int(11) DEFAULT '5'")
+        self.assertEqual(plan.statements(), {'t': "ALTER TABLE t ADD COLUMN a int(11) DEFAULT '5';"})
+
+    def test_add_then_drop(self):
+        plan = AlterPlan()
+        plan.add_column('t', 'a', 'int(11)')
+        plan.drop_column('t', 'a')
+        self.assertEqual(len(plan), 0)
+
+    def test_rename_then_modify(self):
+        plan = AlterPlan()
+        plan.change_column('t', 'old', 'new', 'int(11)')
+        plan.modify_column('t', 'new', "int(11) DEFAULT '5'")
+        self.assertEqual(plan.statements(), {'t': "ALTER TABLE t CHANGE old new int(11) DEFAULT '5';"})
+
+    def test_rename_twice(self):
+        plan = AlterPlan()
+        plan.change_column('t', 'a', 'b', 'int(11)')
+        plan.change_column('t', 'b', 'c', 'int(11)')
+        plan.modify_column('t', 'c', 'bigint(20)')
+        self.assertEqual(plan.statements(), {'t': 'ALTER TABLE t CHANGE a c bigint(20);'})
+
+    def test_rename_then_drop(self):
+        plan = AlterPlan()
+        plan.change_column('t', 'old', 'new', 'int(11)')
+        plan.drop_column('t', 'new')
+        self.assertEqual(plan.statements(), {'t': 'ALTER TABLE t DROP COLUMN old;'})
+
+    def test_rename_then_index(self):
+        plan = AlterPlan()
+        plan.change_column('t', 'old', 'new', 'int(11)')
+        plan.add_index('t', 't_new_idx', ['old'])
+        self.assertEqual(plan.statements(), {'t': 'ALTER TABLE t CHANGE old new int(11), ADD INDEX t_new_idx (new);'})
+
+    def test_add_then_drop_index(self):
+        plan = AlterPlan()
+        plan.add_index('t', 't_a_idx', ['a'])
+        plan.drop_index('t', 't_a_idx')
+        self.assertEqual(len(plan), 0)
+
+
+class ShardRouterTest(SimpleTestCase):
+    def test_modulo_router(self):
+        router = ModuloRouter(3, start=1)
+        self.assertEqual(router.suffixes(), ['1', '2', '3'])
+        self.assertEqual([router.route(key) for key in (0, 1, 2, 3)], ['1', '2', '3', '1'])
+        self.assertEqual(router.route('tenant'), router.route('tenant'))
+        with self.assertRaises(ValueError):
+            ModuloRouter(0)
+
+    def test_consistent_hash_router(self):
+        router = ConsistentHashRouter([1, 2, 3])
+        routes = dict((key, router.route(key)) for key in range(1000))
+        self.assertEqual(set(routes.values()), {'1', '2', '3'})
+
+        # Adding a shard only moves keys to the new shard.
+        grown = ConsistentHashRouter([1, 2, 3, 4])
+        moved = [key for key, suffix in routes.items() if grown.route(key) != suffix]
+        self.assertTrue(all(grown.route(key) == '4' for key in moved))
+        self.assertLess(len(moved), 500)
+
+    def test_range_router(self):
+        router = RangeRouter([(1000, 1), (5000, 2), (None, 3)])
+        self.assertEqual([router.route(key) for key in (0, 999, 1000, 4999, 5000)], ['1', '1', '2', '2', '3'])
+        self.assertEqual(router.suffixes(), ['1', '2', '3'])
+        with self.assertRaises(KeyError):
+            RangeRouter([(1000, 1)]).route(1000)
+        with self.assertRaises(ValueError):
+            RangeRouter([(None, 1), (None, 2)])
+
+    def test_lookup_router(self):
+        router = LookupRouter({'acme': 1, 'globex': 2}, default=3)
+        self.assertEqual([router.route(key) for key in ('acme', 'globex', 'initech')], ['1', '2', '3'])
+        self.assertEqual(router.suffixes(), ['1', '2', '3'])
+        with self.assertRaises(KeyError):
+            LookupRouter({'acme': 1}).route('initech')
+
+
+class MergeOrderTest(SimpleTestCase):
+    def test_order_key(self):
+        self.assertTrue(OrderKey((1, 'b'), (False, True)) < OrderKey((1, 'a'), (False, True)))
+        self.assertFalse(OrderKey((1, 'a'), (False, True)) < OrderKey((1, 'a'), (False, True)))
+        # NULL sorts first ascending and last descending, like MySQL.
+        self.assertTrue(OrderKey((None,), (False,)) < OrderKey((0,), (False,)))
+        self.assertTrue(OrderKey((0,), (True,)) < OrderKey((None,), (True,)))
+
+    def test_merge_sorted_shards(self):
+        queryset = LoadedEvent.objects.across_shards(['1', '2', '3'])
+        queryset = queryset.values('id', 'data').order_by('-data', 'id')[1:4]
+        fetch, combine = queryset._fetch_query()
+        shard_results = [
+            [{'id': 1, 'data': 9}, {'id': 4, 'data': 5}, {'id': 7, 'data': None}],
+            [{'id': 2, 'data': 9}, {'id': 5, 'data': 3}],
+            [{'id': 3, 'data': 6}, {'id': 6, 'data': 5}],
+        ]
+        self.assertEqual([row['id'] for row in combine(shard_results)], [2, 3, 4])
+
+    def test_merge_by_meta_ordering(self):
+        shard_results = [
+            [{'id': 1, 'data': 9}, {'id': 4, 'data': 5}, {'id': 7, 'data': None}],
+            [{'id': 2, 'data': 9}, {'id': 5, 'data': 3}],
+            [{'id': 3, 'data': 6}, {'id': 6, 'data': 5}],
+        ]
+        with mock.patch.object(getattr(LoadedEvent, '_meta'), 'ordering', ['-data', 'id']):
+            queryset = LoadedEvent.objects.across_shards(['1', '2', '3']).values('id', 'data')
+            fetch, combine = queryset[1:4]._fetch_query()
+            self.assertEqual([row['id'] for row in combine(shard_results)], [2, 3, 4])
+
+            # order_by() without fields turns the ordering off, like it does in Django.
+            fetch, combine = queryset.order_by()[1:4]._fetch_query()
+            self.assertEqual([row['id'] for row in combine(shard_results)], [4, 7, 2])
+
+            # Rows without the ordering fields can't be merged, the shards are read one after the other.
+            queryset = LoadedEvent.objects.across_shards(['1', '2', '3']).values_list('id', flat=True)
+            self.assertEqual(queryset._ordering(), [])
+            self.assertFalse(queryset.shard_queryset('1').query.order_by)
+
+
+class PartialAggregateTest(SimpleTestCase):
+    def test_combine(self):
+        rows = [{'n': 2, 's': 10, 'lo': 1, 'hi': 7}, {'n': 0, 's': None, 'lo': None, 'hi': None},
+                {'n': 3, 's': 5, 'lo': 0, 'hi': 4}]
+        self.assertEqual(PartialAggregate('n', Count('id')).combine(rows), 5)
+        self.assertEqual(PartialAggregate('s', Sum('id')).combine(rows), 15)
+        self.assertEqual(PartialAggregate('lo', Min('id')).combine(rows), 0)
+        self.assertEqual(PartialAggregate('hi', Max('id')).combine(rows), 7)
+        self.assertIsNone(PartialAggregate('s', Sum('id')).combine([{'s': None}]))
+
+    def test_average_of_averages(self):
+        average = PartialAggregate('avg', Avg('id'))
+        self.assertEqual(set(average.shard_aggregates), {'avg__shard_sum', 'avg__shard_count'})
+        rows = [{'avg__shard_sum': 10, 'avg__shard_count': 1}, {'avg__shard_sum': 20, 'avg__shard_count': 4},
+                {'avg__shard_sum': None, 'avg__shard_count': 0}]
+        self.assertEqual(average.combine(rows), 6)
+        self.assertIsNone(average.combine(rows[2:]))
+
+    def test_distinct_and_unsupported_aggregates(self):
+        with self.assertRaises(ShardException):
+            PartialAggregate('n', Count('id', distinct=True))
+        with self.assertRaises(ShardException):
+            PartialAggregate('v', StdDev('id'))
+
+
+class ShardTablesTestCase(TransactionTestCase):
+    """
+    Creates the shard tables of LoadedEvent for suffixes around every test.
+    """
+    suffixes = ('1', '2')
+
+    def setUp(self):
+        with connection.schema_editor() as editor:
+            for suffix in self.suffixes:
+                editor.create_model(LoadedEvent.objects.shard(suffix).model)
+
+    def tearDown(self):
+        with connection.schema_editor() as editor:
+            for suffix in self.suffixes:
+                editor.delete_model(LoadedEvent.objects.shard(suffix).model)
+
+
+class RoutedWriteTest(ShardTablesTestCase):
+    """
+    Writes made on pool threads still send this context's next reads of the shards to the primary.
+    """
+
+    def test_writes_are_recorded_in_the_calling_context(self):
+        created = datetime.datetime(2024, 1, 1, 12, 0)
+        rows = [{'created': created, 'data': {'shard': suffix}} for suffix in self.suffixes]
+
+        def write():
+            report = LoadedEvent.objects.bulk_create_routed(rows, key=lambda row: row['data']['shard'], workers=2)
+            return report, [recently_written(LoadedEvent, suffix) for suffix in self.suffixes]
+
+        # A fresh context has no read-your-writes scope (no ReadYourWritesMiddleware).
+        report, written = contextvars.Context().run(write)
+        self.assertEqual(report['inserted'], 2)
+        self.assertEqual(written, [True, True])
+
+    def test_failed_shards_are_reported(self):
+        created = datetime.datetime(2024, 1, 1, 12, 0)
+        rows = [{'created': created, 'data': {'shard': suffix}} for suffix in ('1', '3', '3')]
+        with self.assertLogs('django_table_sharding.managers', 'ERROR') as logs:
+            report = LoadedEvent.objects.bulk_create_routed(rows, key=lambda row: row['data']['shard'], workers=2)
+        self.assertEqual((report['inserted'], report['failed']), (1, 2))
+        self.assertEqual(report['shards']['1'], {'rows': 1, 'inserted': 1, 'error': None})
+        error = report['shards']['3']['error']
+        self.assertTrue(error.startswith('OperationalError: '), error)
+        self.assertNotIn('Traceback', error)
+        self.assertIn('Traceback', logs.output[0])
+
+
+class BrokenCache(LocMemCache):
+    def incr(self, key, delta=1, version=None):
+        raise ConnectionError('cache is down')
+
+
+class QueryCacheInvalidationTest(SimpleTestCase):
+    shard = 'django_table_sharding.loadedevent:1'
+
+    def setUp(self):
+        QUERY_CACHE.clear()
+
+    def tearDown(self):
+        QUERY_CACHE.clear()
+
+    @override_settings(SHARDING_QUERY_CACHE_ENABLED=False,
+                       CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+                                           'LOCATION': 'disabled'}})
+    def test_disabled_cache_is_not_touched(self):
+        invalidate_shard(LoadedEvent, '1')
+        self.assertIsNone(caches['default'].get(ShardQueryCache.generation_key(self.shard)))
+
+    @override_settings(SHARDING_QUERY_CACHE_ENABLED=True,
+                       CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+                                           'LOCATION': 'enabled'}})
+    def test_enabled_cache_bumps_the_generation(self):
+        generation = QUERY_CACHE.generation(self.shard)
+        invalidate_shard(LoadedEvent, '1')
+        self.assertEqual(caches['default'].get(ShardQueryCache.generation_key(self.shard)), generation + 1)
+
+    @override_settings(SHARDING_QUERY_CACHE_ENABLED=True,
+                       CACHES={'default': {'BACKEND': 'django_table_sharding.tests.BrokenCache'}})
+    def test_cache_errors_are_logged(self):
+        generation = QUERY_CACHE.generation(self.shard)
+        with self.assertLogs('django_table_sharding.querycache', 'ERROR'):
+            with invalidating(LoadedEvent, '1'):
+                pass
+        self.assertNotEqual(QUERY_CACHE.generation(self.shard), generation)
+
+
+class ColumnDefinitionTest(SimpleTestCase):
+    def test_literal_defaults_are_quoted(self):
+        definition = {'type': 'varchar(20)', 'nullable': False, 'default': "it's", 'extra': ''}
+        self.assertEqual(column_definition(definition), "varchar(20) NOT NULL DEFAULT 'it''s'")
+        self.assertEqual(column_definition({'type': 'int(11)', 'nullable': True, 'default': None}), 'int(11)')
+
+    def test_expression_defaults_are_not_quoted(self):
+        definition = {'type': 'datetime(6)', 'nullable': False, 'default': 'CURRENT_TIMESTAMP(6)',
+                      'extra': 'DEFAULT_GENERATED on update CURRENT_TIMESTAMP(6)'}
+        self.assertEqual(column_definition(definition),
+                         'datetime(6) NOT NULL DEFAULT CURRENT_TIMESTAMP(6) ON UPDATE CURRENT_TIMESTAMP(6)')
+        # MySQL 5.7 reports CURRENT_TIMESTAMP without DEFAULT_GENERATED.
+        definition = {'type': 'timestamp', 'nullable': False, 'default': 'CURRENT_TIMESTAMP', 'extra': ''}
+        self.assertEqual(column_definition(definition), 'timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP')
+        definition = {'type': 'double', 'nullable': True, 'default': 'rand()', 'extra': 'DEFAULT_GENERATED'}
+        self.assertEqual(column_definition(definition), 'double DEFAULT (rand())')
+
+    def test_mariadb_defaults(self):
+        self.assertEqual(mariadb_default("'it''s'"), ("it's", ''))
+        self.assertEqual(mariadb_default('NULL'), (None, ''))
+        self.assertEqual(mariadb_default('5'), ('5', ''))
+        self.assertEqual(mariadb_default('current_timestamp()'), ('current_timestamp()', 'DEFAULT_GENERATED'))
+        default, extra = mariadb_default('current_timestamp()')
+        definition = {'type': 'datetime', 'nullable': False, 'default': default, 'extra': extra}
+        self.assertEqual(column_definition(definition), 'datetime NOT NULL DEFAULT current_timestamp()')
+
+
+class ReshardTest(ShardTablesTestCase):
+    created = datetime.datetime(2024, 1, 1, 12, 0)
+
+    def setUp(self):
+        super().setUp()
+        rows = [{'id': pk, 'created': self.created, 'data': {'n': pk}} for pk in (1, 2, 3)]
+        LoadedEvent.objects.bulk_create('1', rows)
+        self.resharder = Resharder(LoadedEvent, '1', ['2'], route=lambda row, pk_name: '2')
+
+    def tearDown(self):
+        super().tearDown()
+        with connection.cursor() as cursor:
+            cursor.execute('DROP TABLE IF EXISTS %s' % ledger_table())
+        ledger._ENSURED.clear()
+
+    def data(self, suffix):
+        return dict(LoadedEvent.objects.shard(suffix).values_list('id', 'data'))
+
+    def test_copy_verify_delete(self):
+        with redirect_stdout(io.StringIO()):
+            report = self.resharder.copy()
+        self.assertEqual(report['copied'], 3)
+        self.assertEqual(self.data('2'), {1: {'n': 1}, 2: {'n': 2}, 3: {'n': 3}})
+
+        # A re-run finds its own rows and leaves them alone.
+        with redirect_stdout(io.StringIO()):
+            self.assertEqual(self.resharder.copy()['copied'], 3)
+
+        LoadedEvent.objects.shard('1').filter(pk=3).update(data={'n': 30})
+        report = self.resharder.delete_moved()
+        self.assertEqual((report['deleted'], report['unverified']), (2, 1))
+        self.assertEqual(self.data('1'), {3: {'n': 30}})
+        self.assertEqual(self.data('2'), {1: {'n': 1}, 2: {'n': 2}, 3: {'n': 3}})
+
+    def test_primary_key_collision(self):
+        LoadedEvent.objects.bulk_create('2', [{'id': 2, 'created': self.created, 'data': {'other': True}}])
+        with redirect_stdout(io.StringIO()), self.assertRaises(ShardException):
+            self.resharder.copy()
+        self.assertEqual(self.data('2'), {2: {'other': True}})
+        self.assertEqual(self.resharder.delete_moved()['deleted'], 0)
+        self.assertEqual(len(self.data('1')), 3)
+
+
+class MigrateUniqueTogetherTest(SimpleTestCase):
+    def command(self, source_indexes, shard_indexes):
+        command = MigrateCommand()
+        command.plan = AlterPlan()
+        snapshot = SchemaSnapshot()
+        snapshot.tables['t'] = dict(SchemaSnapshot.empty_table(), indexes=source_indexes)
+        snapshot.tables['t_1'] = dict(SchemaSnapshot.empty_table(), indexes=shard_indexes)
+        command.snapshots = {'default': snapshot}
+        command.get_sharded_tables = lambda cursor, db_table, db='default': ['t_1']
+        return command
+
+    def test_shards_end_with_the_source_unique_togethers(self):
+        # The run added (a, c) and later replaced it with (a, b): the source only has (a, b).
+        command = self.command(
+            {'t_a_b_0f1e_uniq': {'unique': True, 'columns': ['a', 'b']}},
+            {'a_c_uniq': {'unique': True, 'columns': ['a', 'c']}})
+        command.copy_unique_togethers('t')
+        self.assertEqual(command.plan.statements(),
+                         {'t_1': 'ALTER TABLE t_1 DROP INDEX a_c_uniq, ADD UNIQUE INDEX a_b_uniq (a, b);'})
+
+    def test_removed_unique_together_is_dropped(self):
+        command = self.command(dict(), {'a_b_uniq': {'unique': True, 'columns': ['a', 'b']}})
+        command.copy_unique_togethers('t')
+        self.assertEqual(command.plan.statements(), {'t_1': 'ALTER TABLE t_1 DROP INDEX a_b_uniq;'})
+
+    def test_matching_shard_is_left_alone(self):
+        index = {'unique': True, 'columns': ['a', 'b']}
+        command = self.command({'t_a_b_0f1e_uniq': index}, {'a_b_uniq': dict(index)})
+        command.copy_unique_togethers('t')
+        self.assertEqual(len(command.plan), 0)
+
+
+class LedgerTest(TransactionTestCase):
+    databases = {'default'}
+
+    def setUp(self):
+        ledger._ENSURED.clear()
+        self.ledger = ShardLedger('default')
+
+    def tearDown(self):
+        with connection.cursor() as cursor:
+            cursor.execute('DROP TABLE IF EXISTS %s' % ledger_table())
+        ledger._ENSURED.clear()
+
+    def command(self):
+        command = MigrateCommand()
+        command.ledger = self.ledger
+        command.shard_concurrency = 1
+        command.shard_failures = []
+        command.throttle = None
+        return command
+
+    def test_table_is_created_once(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.ledger.pending_runs()
+            self.ledger.record_run('a' * 40, ['app.0002'], {'model_changes': []})
+            ShardLedger('default').pending_runs()
+        self.assertEqual(len([query for query in queries if 'CREATE TABLE' in query['sql']]), 1)
+
+    def test_pending_runs(self):
+        self.ledger.record_run('a' * 40, ['app.0002'], {'model_changes': [['t', 'c']]})
+        self.ledger.record_run('b' * 40, ['app.0003'], {'model_changes': []})
+        # Recording a run again replaces it.
+        self.ledger.record_run('a' * 40, ['app.0002'], {'model_changes': [['t', 'c']]})
+        self.assertEqual(sorted(self.ledger.pending_runs()), [
+            ('a' * 40, ['app.0002'], {'model_changes': [['t', 'c']]}),
+            ('b' * 40, ['app.0003'], {'model_changes': []})])
+
+        self.ledger.finish_run('a' * 40)
+        self.assertEqual([run[0] for run in self.ledger.pending_runs()], ['b' * 40])
+
+    def test_done_shards(self):
+        self.ledger.record_run('a' * 40, [], dict())
+        self.ledger.mark_done('a' * 40, 't_1', 'alter')
+        self.ledger.mark_done('a' * 40, 't_1', 'alter')
+        self.ledger.mark_done('a' * 40, 't_2', 'alter@node2')
+        self.ledger.mark_done('b' * 40, 't_3', 'alter')
+        self.assertEqual(self.ledger.done('a' * 40), {('t_1', 'alter'), ('t_2', 'alter@node2')})
+        self.assertEqual(self.ledger.done('c' * 40), set())
+
+    def test_copied_ranges(self):
+        self.ledger.ensure_table()
+        self.ledger.record_copy('a' * 40, 't_2', 1, 100)
+        self.ledger.record_copy('a' * 40, 't_2', 101, 200)
+        self.ledger.mark_done('a' * 40, 't_2', 'alter')
+        self.assertEqual(sorted(self.ledger.copied_ranges('a' * 40, 't_2')), [(1, 100), (101, 200)])
+        self.assertEqual(self.ledger.copied_ranges('a' * 40, 't_3'), [])
+
+    def test_done_shards_are_skipped(self):
+        tables = [LoadedEvent.objects.shard(suffix).model._meta.db_table for suffix in ('1', '2')]
+        self.ledger.record_run('a' * 40, [], dict())
+        self.ledger.mark_done('a' * 40, tables[0], 'alter')
+
+        command = self.command()
+        command.ledger_operation = 'alter'
+        command.skip_tables = set(table for table, operation in self.ledger.done('a' * 40)
+                                  if operation == command.ledger_operation)
+        with mock.patch.object(SHARD_CATALOG, 'tables_for_source', return_value=tables):
+            self.assertEqual(command.get_sharded_tables(None, 'source', db='default'), tables[1:])
+
+        executed = []
+        command.plan = AlterPlan()
+        command.plan.add_column(tables[1], 'extra', 'int(11) NULL')
+        command.run_sql = lambda cursor, sql, raise_errors=False: executed.append(sql)
+        with redirect_stdout(io.StringIO()):
+            command.apply_plan('a' * 40, db='default')
+        self.assertEqual(len(executed), 1)
+        self.assertEqual(self.ledger.done('a' * 40), {(tables[0], 'alter'), (tables[1], 'alter')})
+
+    def test_empty_run_is_finished(self):
+        changes = {'model_changes': [], 'add_unique_togethers': [], 'remove_unique_togethers': [],
+                   'rename_fields': []}
+        self.ledger.record_run('a' * 40, [], changes)
+        self.command().migrate_shards('a' * 40, changes, db='default')
+        self.assertEqual(self.ledger.pending_runs(), [])
+
+
+def placed_on_node(table_suffix):
+    return 'node2'
+
+
+class PlacementTest(SimpleTestCase):
+    @override_settings(DATABASES={'default': {}, 'node2': {}, 'replica1': {}, 'replica2': {}, 'lagging': {}},
+                       SHARDING_REPLICAS={'default': [{'alias': 'replica1', 'weight': 3}], 'node2': ['replica2']},
+                       SHARDING_THROTTLE_REPLICAS=['lagging'])
+    def test_callable_placement_skips_replicas(self):
+        with mock.patch.object(LoadedEvent, 'shard_placement', staticmethod(placed_on_node), create=True):
+            self.assertEqual(shard_databases(LoadedEvent), ['default', 'node2'])
+            self.assertEqual(placement_databases([LoadedEvent]), ['default', 'node2'])
+
+
+class ShardConcurrencyTest(SimpleTestCase):
+    databases = {'default'}
+
+    @override_settings(SHARDING_POOL_SIZE=2)
+    def test_concurrency_is_not_capped_by_the_worker_pool(self):
+        command = MigrateCommand()
+        command.shard_concurrency = 4
+        command.shard_failures = []
+        barrier = threading.Barrier(4, timeout=5)
+
+        def alter(table, cursor):
+            # Only passes when all 4 shards run at the same time.
+            barrier.wait()
+            if table == 't_4':
+                raise ValueError('failed')
+
+        with redirect_stdout(io.StringIO()):
+            finished = command.for_each_shard(['t_1', 't_2', 't_3', 't_4'], 'alter', alter)
+        self.assertEqual(finished, ['t_1', 't_2', 't_3'])
+        self.assertEqual([(table, operation) for table, operation, err in command.shard_failures], [('t_4', 'alter')])
+
+
+class BulkCreateTest(ShardTablesTestCase):
+    created = datetime.datetime(2024, 1, 1, 12, 0)
+
+    def inserts(self, queries):
+        return [query for query in queries if query['sql'].startswith('INSERT')]
+
+    def test_rows_with_different_columns(self):
+        rows = [
+            {'created': self.created},
+            {'created': self.created, 'data': {'a': 1}},
+            {'id': 10, 'created': self.created, 'data': None},
+            {'data': {'b': 2}, 'created': self.created},
+        ]
+        original = copy.deepcopy(rows)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(LoadedEvent.objects.bulk_create('1', rows), 4)
+        # One statement per set of columns: (created), (created, data), (id, created).
+        self.assertEqual(len(self.inserts(queries)), 3)
+        self.assertEqual(rows, original)
+        self.assertEqual(sorted(LoadedEvent.objects.shard('1').values_list('data', flat=True), key=str),
+                         [None, None, {'a': 1}, {'b': 2}])
+        self.assertTrue(LoadedEvent.objects.shard('1').filter(pk=10).exists())
+
+    def test_batch_size(self):
+        rows = [{'created': self.created, 'data': {'n': n}} for n in range(5)]
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(LoadedEvent.objects.bulk_create('1', rows, batch_size=2), 5)
+        self.assertEqual(len(self.inserts(queries)), 3)
+
+    def test_statements_fit_in_max_allowed_packet(self):
+        rows = [{'created': self.created, 'data': {'text': 'x' * 1000}} for _ in range(5)]
+        with mock.patch.dict(bulk._MAX_PACKET, {'default': 3000}), CaptureQueriesContext(connection) as queries:
+            self.assertEqual(LoadedEvent.objects.bulk_create('1', rows), 5)
+        # 3000 * PACKET_FILL leaves room for two 1 KB rows per statement.
+        self.assertEqual(len(self.inserts(queries)), 3)
+        self.assertEqual(LoadedEvent.objects.shard('1').count(), 5)
+
+
+class BulkUpdateTest(ShardTablesTestCase):
+    created = datetime.datetime(2024, 1, 1, 12, 0)
+
+    def setUp(self):
+        super().setUp()
+        rows = [{'id': pk, 'created': self.created, 'data': {'n': pk}} for pk in (1, 2, 3)]
+        LoadedEvent.objects.bulk_create('1', rows)
+
+    def test_case_update(self):
+        event = LoadedEvent.objects.shard('1').get(pk=1)
+        event.data = {'n': 10}
+        with CaptureQueriesContext(connection) as queries:
+            updated = LoadedEvent.objects.bulk_update('1', [event, {'id': 3, 'data': {'n': 30}}], ['data'])
+        self.assertEqual(updated, 2)
+        self.assertEqual(len([query for query in queries if query['sql'].startswith('UPDATE')]), 1)
+        self.assertEqual(dict(LoadedEvent.objects.shard('1').values_list('id', 'data')),
+                         {1: {'n': 10}, 2: {'n': 2}, 3: {'n': 30}})
+
+    def test_missing_values(self):
+        with self.assertRaises(ShardException):
+            LoadedEvent.objects.bulk_update('1', [{'id': 1}], ['data'])
+        with self.assertRaises(ShardException):
+            LoadedEvent.objects.bulk_update('1', [{'data': {}}], ['data'])
+
+
+class LongKey(ShardedModel):
+    key = models.CharField(primary_key=True, max_length=600)
+    a = models.CharField(max_length=10, default='')
+    b = models.CharField(max_length=10, default='')
+    c = models.CharField(max_length=10, default='')
+
+    class Meta:
+        app_label = 'django_table_sharding'
+
+
+class BulkUpdateBatchTest(TransactionTestCase):
+    def setUp(self):
+        with connection.schema_editor() as editor:
+            editor.create_model(LongKey.objects.shard('1').model)
+
+    def tearDown(self):
+        with connection.schema_editor() as editor:
+            editor.delete_model(LongKey.objects.shard('1').model)
+
+    def test_batches_count_every_pk_binding(self):
+        rows = [{'key': '%s' % n * 500, 'a': 'a', 'b': 'b', 'c': 'c'} for n in range(8)]
+        LongKey.objects.bulk_create('1', rows)
+        updates = [dict(row, a='x', b='y', c='z') for row in rows]
+        with mock.patch.dict(bulk._MAX_PACKET, {'default': 6250}), CaptureQueriesContext(connection) as queries:
+            self.assertEqual(LongKey.objects.bulk_update('1', updates, ['a', 'b', 'c']), 8)
+        statements = [query['sql'] for query in queries if query['sql'].startswith('UPDATE')]
+        # Each pk is bound four times, so only two 500 character keys fit in 6250 * PACKET_FILL bytes.
+        self.assertEqual(len(statements), 4)
+        self.assertTrue(all(len(sql) <= 5000 for sql in statements))
+        self.assertEqual(set(LongKey.objects.shard('1').values_list('a', 'b', 'c')), {('x', 'y', 'z')})
+
+
+class UpsertSqlTest(SimpleTestCase):
+    # The statements are captured, but write_rows() still opens a transaction.
+    databases = {'default'}
+
+    def test_upsert_sql(self):
+        prefix, row_sql, suffix = bulk.upsert_sql('t', ('id', 'a', 'b'), ('a', 'b'))
+        self.assertEqual(prefix, 'INSERT INTO "t" ("id", "a", "b") VALUES ')
+        self.assertEqual(row_sql, '(%s, %s, %s)')
+        self.assertEqual(suffix, ' ON DUPLICATE KEY UPDATE "a" = VALUES("a"), "b" = VALUES("b")')
+
+    def test_upsert_statements(self):
+        statements = []
+
+        def execute_rows(cursor, prefix, row_sql, suffix, columns, rows, batch_size=None, db='default'):
+            statements.append((prefix + row_sql + suffix, rows))
+            return len(rows)
+
+        rows = [{'id': 1, 'data': None}, {'id': 2, 'data': {'a': 1}}, {'id': 3}]
+        with mock.patch.object(bulk, 'execute_rows', execute_rows):
+            bulk.upsert_rows(LoadedEvent, 't', rows)
+            bulk.upsert_rows(LoadedEvent, 't', rows[:2], update_fields=['created'])
+        self.assertEqual(statements, [
+            # None is kept, so an upsert sets the column back to NULL; the pk is never updated.
+            ('INSERT INTO "t" ("id", "data") VALUES (%s, %s) ON DUPLICATE KEY UPDATE "data" = VALUES("data")',
+             [(1, None), (2, '{"a": 1}')]),
+            # A row without columns to update only inserts.
+            ('INSERT IGNORE INTO "t" ("id") VALUES (%s)', [(3,)]),
+            # update_fields the rows don't set leave nothing to update.
+            ('INSERT IGNORE INTO "t" ("id", "data") VALUES (%s, %s)', [(1, None), (2, '{"a": 1}')]),
+        ])
+
+
+class ShardModelCacheTest(SimpleTestCase):
+    def test_hits_and_misses(self):
+        cache = ShardModelCache(max_size=2)
+        lookups = []
+        cache.on_lookup = lambda model, table_suffix, hit: lookups.append((table_suffix, hit))
+        first = cache.get(LoadedEvent, 1, 'django_table_sharding_loadedevent_1')
+        self.assertIs(cache.get(LoadedEvent, '1', 'django_table_sharding_loadedevent_1'), first)
+        self.assertIsNot(cache.get(LoadedEvent, 1, 'django_table_sharding_loadedevent_1', db='node2'), first)
+        self.assertEqual(lookups, [(1, False), ('1', True), (1, False)])
+        self.assertEqual(cache.stats(), {'size': 2, 'max_size': 2, 'hits': 1, 'misses': 2, 'evictions': 0})
+
+    def test_least_recently_used_is_evicted(self):
+        cache = ShardModelCache(max_size=2)
+        one = cache.get(LoadedEvent, 1, 'django_table_sharding_loadedevent_1')
+        two = cache.get(LoadedEvent, 2, 'django_table_sharding_loadedevent_2')
+        cache.get(LoadedEvent, 1, 'django_table_sharding_loadedevent_1')
+        cache.get(LoadedEvent, 3, 'django_table_sharding_loadedevent_3')
+        self.assertEqual(cache.stats()['evictions'], 1)
+        self.assertIs(cache.get(LoadedEvent, 1, 'django_table_sharding_loadedevent_1'), one)
+
+        # Shard 2 was evicted: it is rebuilt as a new, equivalent class.
+        rebuilt = cache.get(LoadedEvent, 2, 'django_table_sharding_loadedevent_2')
+        self.assertIsNot(rebuilt, two)
+        meta = getattr(rebuilt, '_meta')
+        self.assertEqual(meta.db_table, 'django_table_sharding_loadedevent_2')
+        self.assertEqual([field.attname for field in meta.concrete_fields],
+                         [field.attname for field in getattr(LoadedEvent, '_meta').concrete_fields])
+        self.assertEqual((rebuilt._shard_source, rebuilt._shard_suffix, rebuilt._shard_db),
+                         (LoadedEvent, '2', 'default'))
+
+
+class ManagerIsolationTest(ShardTablesTestCase):
+    created = datetime.datetime(2024, 1, 1, 12, 0)
+
+    def test_shards_do_not_share_state(self):
+        one = LoadedEvent.objects.shard('1')
+        two = LoadedEvent.objects.shard('2')
+        self.assertEqual(getattr(one.model, '_meta').db_table, 'django_table_sharding_loadedevent_1')
+        self.assertEqual(getattr(two.model, '_meta').db_table, 'django_table_sharding_loadedevent_2')
+        # The source model and its manager are never changed by shard().
+        self.assertIs(LoadedEvent.objects.model, LoadedEvent)
+        self.assertEqual(getattr(LoadedEvent, '_meta').db_table, 'django_table_sharding_loadedevent')
+
+    def test_save_stays_on_its_shard(self):
+        event = LoadedEvent.objects.shard('1').model(created=self.created, data={'n': 1})
+        event.save()
+        self.assertEqual(LoadedEvent.objects.shard('1').count(), 1)
+        self.assertEqual(LoadedEvent.objects.shard('2').count(), 0)
+
+        other = LoadedEvent.objects.shard('2').model(created=self.created, data={'n': 2})
+        other.save()
+        event = LoadedEvent.objects.shard('1').get()
+        event.data = {'n': 10}
+        event.save()
+        self.assertEqual(list(LoadedEvent.objects.shard('1').values_list('data', flat=True)), [{'n': 10}])
+        self.assertEqual(list(LoadedEvent.objects.shard('2').values_list('data', flat=True)), [{'n': 2}])
+
+    def test_concurrent_shard_querysets(self):
+        def table(suffix):
+            return getattr(LoadedEvent.objects.shard(suffix).model, '_meta').db_table
+
+        suffixes = [str(n % 7) for n in range(200)]
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            tables = list(pool.map(table, suffixes))
+        self.assertEqual(tables, ['django_table_sharding_loadedevent_%s' % suffix for suffix in suffixes])
+
+
+class ShardIteratorTest(ShardTablesTestCase):
+    suffixes = ('1', '2', '3')
+    created = datetime.datetime(2024, 1, 1, 12, 0)
+
+    def setUp(self):
+        super().setUp()
+        # Inserted out of order; shard 2 stays empty.
+        for suffix, pks in (('1', (5, 1, 3, 2, 4)), ('3', (9, 7, 6, 8))):
+            rows = [{'id': pk, 'created': self.created, 'data': {'n': pk}} for pk in pks]
+            LoadedEvent.objects.bulk_create(suffix, rows)
+
+    def test_keyset_iteration(self):
+        for chunk_size in (1, 2, 4, 5, 100):
+            rows = list(LoadedEvent.objects.iter_shards(['1', '2', '3'], chunk_size=chunk_size))
+            self.assertEqual([row.pk for row in rows], [1, 2, 3, 4, 5, 6, 7, 8, 9], chunk_size)
+            self.assertEqual([getattr(row, '_meta').db_table[-1] for row in rows], ['1'] * 5 + ['3'] * 4)
+
+    def test_filtered_values(self):
+        queryset = LoadedEvent.objects.across_shards(['3', '2', '1']).filter(id__gte=3).values('id', 'data')
+        self.assertEqual([row['id'] for row in queryset.iterator(chunk_size=2)], [6, 7, 8, 9, 3, 4, 5])
+
+    def test_prefetch(self):
+        prefetched = []
+        background = scatter.run_in_background
+
+        def run_in_background(func, *args):
+            prefetched.append(args[0])
+            return background(func, *args)
+
+        with mock.patch.object(scatter, 'run_in_background', run_in_background):
+            rows = list(LoadedEvent.objects.across_shards(['1', '2', '3']).iterator(chunk_size=2))
+            self.assertEqual(prefetched, ['2', '3'])
+            self.assertEqual([row.pk for row in rows], [1, 2, 3, 4, 5, 6, 7, 8, 9])
+
+            del prefetched[:]
+            rows = list(LoadedEvent.objects.across_shards(['1', '2', '3']).iterator(chunk_size=2, prefetch=False))
+            self.assertEqual(prefetched, [])
+            self.assertEqual([row.pk for row in rows], [1, 2, 3, 4, 5, 6, 7, 8, 9])
+
+    def test_invalid_chunk_size(self):
+        with self.assertRaises(ShardException):
+            list(LoadedEvent.objects.iter_shards(['1'], chunk_size=0))
+
+
+class MetaOrderingTest(ShardTablesTestCase):
+    def test_shards_are_merged_by_meta_ordering(self):
+        for suffix, days in (('1', (1, 4, 5)), ('2', (2, 3, 6))):
+            rows = [{'created': datetime.datetime(2024, 1, day), 'data': {'day': day}} for day in days]
+            LoadedEvent.objects.bulk_create(suffix, rows)
+
+        with mock.patch.object(getattr(LoadedEvent, '_meta'), 'ordering', ['-created']):
+            queryset = LoadedEvent.objects.across_shards(['1', '2'])
+            self.assertEqual([event.data['day'] for event in queryset], [6, 5, 4, 3, 2, 1])
+            self.assertEqual([event.data['day'] for event in queryset[1:3]], [5, 4])
@@ -1,6 +1,13 @@
-from django.db import models
+from django.conf import settings
+from django.db import close_old_connections, models
 from django.apps.registry import apps
 from django.db.models.expressions import Col
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+import contextvars
+import queue
+import random
+import threading
 
 
 def chunks(source_list, batch_size):
@@ -9,6 +16,120 @@ def chunks(source_list, batch_size):
         yield source_list[i:i+batch_size]
 
 
+def max_workers(requested=None):
+    """Number of worker threads to use for shard fan out."""
+    if requested is not None:
+        return max(1, int(requested))
+    return max(1, int(getattr(settings, 'SHARDING_MAX_WORKERS', 8)))
+
+
+_POOL = None
+_POOL_LOCK = threading.Lock()
+_pool_thread = threading.local()
+
+
+def _mark_pool_thread():
+    _pool_thread.active = True
+
+
+def in_pool_thread():
+    return getattr(_pool_thread, 'active', False)
+
+
+def worker_pool():
+    """
+    The process wide pool of worker threads for shard fan out, SHARDING_POOL_SIZE threads (default 32).
+    Threads live as long as the process and keep their database connections between calls; connections
+    are closed like Django closes them after a request, when unusable or older than CONN_MAX_AGE.
+    """
+    global _POOL
+    if _POOL is None:
+        with _POOL_LOCK:
+            if _POOL is None:
+                _POOL = ThreadPoolExecutor(
+                    max_workers=max(1, int(getattr(settings, 'SHARDING_POOL_SIZE', 32))),
+                    thread_name_prefix='sharding', initializer=_mark_pool_thread)
+    return _POOL
+
+
+def start_workers(func, items, workers=None):
+    """
+    Submit up to `workers` pool tasks that call func(item) for every item, each in a copy of the
+    caller's context. Returns (futures of the tasks, results), results being filled with
+    (item, result, exception) in item order as the tasks run.
+    """
+    items = list(items)
+    results = [None] * len(items)
+    work = queue.Queue()
+    for i, item in enumerate(items):
+        work.put((i, item))
+
+    def drain(context):
+        try:
+            while True:
+                try:
+                    i, item = work.get_nowait()
+                except queue.Empty:
+                    break
+                try:
+                    results[i] = (item, context.run(func, item), None)
+                except Exception as err:
+                    results[i] = (item, None, err)
+        finally:
+            close_old_connections()
+
+    pool = worker_pool()
+    futures = [pool.submit(drain, contextvars.copy_context())
+               for _ in range(min(max_workers(workers), len(items)))]
+    return futures, results
+
+
+def parallel_map(func, items, workers=None):
+    """
+    Call func(item) for every item on at most `workers` threads of the worker pool.
+    Each pool thread uses its own database connections (Django connections are per thread). Workers
+    run in a copy of the caller's context, so context variables (e.g. recent shard writes) are seen
+    by func. Returns a list of (item, result, exception) in item order.
+    With one worker or one item, or when called from a pool thread, everything runs in the calling thread.
+    """
+    items = list(items)
+    if min(max_workers(workers), len(items)) <= 1 or in_pool_thread():
+        results = []
+        for item in items:
+            try:
+                results.append((item, func(item), None))
+            except Exception as err:
+                results.append((item, None, err))
+        return results
+
+    futures, results = start_workers(func, items, workers)
+    wait(futures)
+    return results
+
+
+def run_in_background(func, *args, **kwargs):
+    """
+    Call func on a worker pool thread, and return a Future of the result.
+    From a pool thread, func runs right away in the calling thread so the pool can't deadlock.
+    """
+    if in_pool_thread():
+        future = Future()
+        try:
+            future.set_result(func(*args, **kwargs))
+        except Exception as err:
+            future.set_exception(err)
+        return future
+
+    context = contextvars.copy_context()
+
+    def run():
+        try:
+            return context.run(func, *args, **kwargs)
+        finally:
+            close_old_connections()
+    return worker_pool().submit(run)
+
+
 class ModelRegistry:
     """
     For removing temporary models created by sharding.
@@ -62,14 +183,16 @@ def copy_model(name, model_to_copy, db_table, options=None):
     attrs['__module__'] = module
     attrs['Meta'] = Meta
 
-    # Prepare to copy all fields from existing model.
+    # Prepare to copy all fields from existing model. Fields are cloned so building the copy never
+    # touches the field instances (and their cached columns) of the original model.
     if fields:
-        names = types = []
-        copy_meta = getattr(model_to_copy, '_meta')
+        field_dict = dict()
         for item in copy_meta.concrete_fields:
-            names.append(item.name)
-            types.append(item)
-        field_dict = dict(zip(names, types))
+            _, path, args, kwargs = item.deconstruct()
+            if item.is_relation:
+                # Do not add reverse accessors for every copy to the related model.
+                kwargs['related_name'] = '+'
+            field_dict[item.name] = item.__class__(*args, **kwargs)
         attrs.update(field_dict)
 
     model = type(name, (models.Model,), attrs)
@@ -82,3 +205,63 @@ def copy_model(name, model_to_copy, db_table, options=None):
         f.cached_col = Col(db_table, f)
 
     return model
+
+
+class ShardModelCache:
+    """
+    Bounded LRU cache of shard model classes keyed by (base model, suffix, db).
+    Building a model class through ModelBase is expensive, so every shard only pays for it once.
+    """
+    def __init__(self, max_size=1024):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # Optional hook called as on_lookup(model, table_suffix, hit) for every get().
+        self.on_lookup = None
+        self._models = OrderedDict()
+        self._lock = threading.RLock()
+
+    def get(self, model, table_suffix, db_table, db='default'):
+        key = (model, str(table_suffix), db)
+        with self._lock:
+            shard_model = self._models.get(key)
+            if shard_model is not None:
+                self._models.move_to_end(key)
+                self.hits += 1
+                if self.on_lookup is not None:
+                    self.on_lookup(model, table_suffix, True)
+                return shard_model
+
+            self.misses += 1
+            if self.on_lookup is not None:
+                self.on_lookup(model, table_suffix, False)
+            model_name = 'ShardedModel-%s' % random.randint(999999999, 9999999999999999)
+            shard_model = copy_model(
+                model_name,
+                model,
+                db_table,
+                options={'db_table': db_table, 'auto_created': False}
+            )
+            shard_model._shard_source = model
+            shard_model._shard_suffix = str(table_suffix)
+            shard_model._shard_db = db
+            self._models[key] = shard_model
+            while len(self._models) > self.max_size:
+                self._models.popitem(last=False)
+                self.evictions += 1
+            return shard_model
+
+    def clear(self):
+        with self._lock:
+            self._models.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._models),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }